@@ -1,5 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CardControlConfig(AppConfig):
     name = 'card_control'
+
+    # Builds the control registry, so an invalid CONTROL_DEFINITION or MANDATORY_CONTROLS fails at start up. Refer processor_control.py
+    # Warms the cache of every worker process with the most active cards. Refer warmup.py
+    def ready(self):
+        from .processor_control import get_registry
+        get_registry()
+        if settings.CACHE_WARMUP_ON_STARTUP:
+            from .warmup import warm_cache_on_first_request
+            warm_cache_on_first_request()
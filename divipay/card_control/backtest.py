@@ -0,0 +1,189 @@
+import itertools
+from django.conf import settings
+from . import export
+from .messages import Messages
+from .models import Control, InternedLookup
+from .operation_control import OPERATOR_FUNCTIONS, ControlOperator
+from .processor_control import ControlType, compile_controls, get_registry, group_controls, _reject
+from .processor_txn import TxnStatus
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Backtest of the controls against historical transactions, used by the backtest_controls command
+# Tells how many of the past transactions the current controls (or the given ones) would reject, per control
+#
+# Transactions are read BACKTEST_CHUNK_SIZE rows at a time into columnar NumPy arrays: amount as integers, merchant,
+# merchant category (ids of their interned values) and reason dictionary encoded (distinct values, and the code of the value of every row)
+# Cards with the same controls share a compiled plan, and every rule of a plan is evaluated at once for all the rows of
+# its cards: amounts are compared with NumPy ufuncs, rules on encoded columns are evaluated once per distinct value and
+# looked up by code. Rules are applied in plan order and a row is counted against the first rule it fails, like ControlPlan.evaluate
+# Velocity controls depend on the spend of the card when the transaction was made and are not backtested
+
+# Key of the rows rejected because a mandatory control is not configured
+MANDATORY = "MANDATORY"
+
+# Columns compared by the rules, by variable_name of CONTROL_DEFINITION
+NUMERIC_COLUMNS = ("amount", )
+ENCODED_COLUMNS = ("merchant", "merchant_category")
+FIELDS = ("card", "amount", "merchant", "merchant_category", "status", "reason")
+
+if np is not None:
+    NUMPY_OPERATORS = {
+            OPERATOR_FUNCTIONS[ControlOperator.EQ] : np.equal,
+            OPERATOR_FUNCTIONS[ControlOperator.LTE] : np.less_equal,
+            OPERATOR_FUNCTIONS[ControlOperator.GTE] : np.greater_equal,
+            OPERATOR_FUNCTIONS[ControlOperator.LT] : np.less,
+            OPERATOR_FUNCTIONS[ControlOperator.GT] : np.greater,
+            OPERATOR_FUNCTIONS[ControlOperator.IN] : lambda column, values: np.isin(column, list(values)),
+            _reject : lambda column, value: np.zeros(len(column), dtype=bool)
+    }
+
+class BacktestResult(object):
+    def __init__(self):
+        self.total = 0
+        self.approved_before = 0
+        self.approved_after = 0
+        # approved when they were made, rejected by the controls now
+        self.newly_rejected = 0
+        # rejected by a control when they were made, approved by the controls now
+        self.newly_approved = 0
+        # control name : [rejected, newly rejected]
+        self.controls = dict()
+        # controls which were not backtested
+        self.skipped = set()
+
+    def count(self, control_name, rejected, newly_rejected):
+        counts = self.controls.setdefault(control_name, [0, 0])
+        counts[0] += rejected
+        counts[1] += newly_rejected
+
+# Backtests the controls against the transactions matching the filters (see export.parse_filters)
+# overrides replaces the controls of cards for the backtest, as {card id : {control name : [control values]}}
+# The override values are looked up without being interned (refer processor_control.group_controls), a backtest writes nothing
+def backtest(filters, overrides = None, chunk_size = None):
+    chunk_size = settings.BACKTEST_CHUNK_SIZE if chunk_size is None else chunk_size
+    plans = PlanCache({card_id : group_controls([(control_name, value) for control_name, values in controls.items() for value in values])
+                       for card_id, controls in (overrides or {}).items()})
+    result = BacktestResult()
+    rows = export.filter_txns(**filters).values_list(*FIELDS).iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        evaluate_chunk(Chunk(chunk), plans, result)
+    return result
+
+# Compiled plans of the cards, cards with the same controls share a plan
+class PlanCache(object):
+    def __init__(self, overrides):
+        self.overrides = overrides
+        # card id : index of its plan in plans
+        self.card_plans = dict()
+        # controls : index of their plan in plans
+        self.plan_indexes = dict()
+        self.plans = []
+
+    # Returns the plan index of every card, the controls of the cards not seen before are loaded with bulk queries
+    def get_plan_indexes(self, card_ids):
+        missing = [card_id for card_id in card_ids if card_id not in self.card_plans]
+        if missing:
+            grouped_controls = Control.load_grouped_controls(missing)
+            for card_id in missing:
+                controls = self.overrides.get(card_id, grouped_controls[card_id])
+                key = frozenset(controls.items())
+                index = self.plan_indexes.get(key)
+                if index is None:
+                    index = self.plan_indexes[key] = len(self.plans)
+                    self.plans.append(compile_controls(controls))
+                self.card_plans[card_id] = index
+        return np.array([self.card_plans[card_id] for card_id in card_ids], dtype=np.int64)
+
+# Columns of a chunk of transaction rows (in the order of FIELDS)
+class Chunk(object):
+    def __init__(self, rows):
+        columns = dict(zip(FIELDS, zip(*rows)))
+        self.size = len(rows)
+        self.cards, self.card_codes = encode(columns["card"])
+        self.numeric = {name : np.array(columns[name], dtype=np.int64) for name in NUMERIC_COLUMNS}
+        self.encoded = {name : encode(columns[name]) for name in ENCODED_COLUMNS}
+        self.approved = np.array(columns["status"], dtype=object) == TxnStatus.A.name
+        reasons, reason_codes = encode(columns["reason"])
+        self.control_rejected = np.array([is_control_rejection(reason) for reason in reasons], dtype=bool)[reason_codes]
+
+# Dictionary encoding of a column, returns the distinct values and the code of every row
+def encode(values):
+    codes = dict()
+    row_codes = np.fromiter((codes.setdefault(value, len(codes)) for value in values), dtype=np.int64, count=len(values))
+    return list(codes), row_codes
+
+# Whether the reason of a rejection is a control which is backtested
+def is_control_rejection(reason):
+    if reason is None:
+        return False
+    if reason in get_registry().mandatory_messages:
+        return True
+    if reason.startswith(Messages.Control.FAILED_TO_COMPLY):
+        control_def = settings.CONTROL_DEFINITION.get(reason[len(Messages.Control.FAILED_TO_COMPLY):], {})
+        return control_def.get("type") != ControlType.Velocity.name
+    return False
+
+def evaluate_chunk(chunk, plans, result):
+    # rows sorted by plan, so the rows of a plan are a slice
+    row_plans = plans.get_plan_indexes(chunk.cards)[chunk.card_codes]
+    order = np.argsort(row_plans, kind="stable")
+    plan_indexes, starts = np.unique(row_plans[order], return_index=True)
+    ends = list(starts[1:]) + [chunk.size]
+    approved = np.zeros(chunk.size, dtype=bool)
+    for plan_index, start, end in zip(plan_indexes, starts, ends):
+        rows = order[start:end]
+        approved[rows] = evaluate_plan(plans.plans[plan_index], chunk, rows, result)
+
+    result.total += chunk.size
+    result.approved_before += int(chunk.approved.sum())
+    result.approved_after += int(approved.sum())
+    result.newly_rejected += int((chunk.approved & ~approved).sum())
+    result.newly_approved += int((chunk.control_rejected & approved).sum())
+
+# Vectorized ControlPlan.evaluate for the given rows, returns whether every row passes the controls
+def evaluate_plan(controls_plan, chunk, rows, result):
+    was_approved = chunk.approved[rows]
+    if controls_plan.missing_mandatory is not None:
+        result.count(MANDATORY, len(rows), int(was_approved.sum()))
+        return np.zeros(len(rows), dtype=bool)
+    result.skipped.update(rule.control_name for rule in controls_plan.velocity_rules)
+
+    passing = np.ones(len(rows), dtype=bool)
+    for rule in controls_plan.rules:
+        rule_passing = evaluate_rule(rule, chunk, rows)
+        if rule_passing is None:
+            result.skipped.add(rule.control_name)
+            continue
+        failed = passing & ~rule_passing
+        result.count(rule.control_name, int(failed.sum()), int((failed & was_approved).sum()))
+        passing &= rule_passing
+    return passing
+
+# Whether every row passes the rule, None if the rule compares a value which is not stored with the transactions
+def evaluate_rule(rule, chunk, rows):
+    if rule.variable_name in chunk.numeric:
+        column = chunk.numeric[rule.variable_name][rows]
+        numpy_operator = NUMPY_OPERATORS.get(rule.operator)
+        if numpy_operator is not None and rule.coerce is int:
+            return numpy_operator(column, rule.value)
+        return np.fromiter((rule_passes(rule, value, rule.coerce) for value in column.tolist()), dtype=bool, count=len(column))
+    if rule.variable_name in chunk.encoded:
+        values, codes = chunk.encoded[rule.variable_name]
+        # values of interned variables are already the ids compared by the rule
+        coerce = None if isinstance(rule.coerce, InternedLookup) else rule.coerce
+        return np.fromiter((rule_passes(rule, value, coerce) for value in values), dtype=bool, count=len(values))[codes[rows]]
+    return None
+
+# ControlPlan.evaluate of a single rule and value, the value is compared as it is when coerce is None
+def rule_passes(rule, value, coerce):
+    try:
+        return rule.operator(value if coerce is None else coerce(value), rule.value) is True
+    except (ValueError, TypeError):
+        return False
@@ -0,0 +1,43 @@
+import base64
+import pickle
+from contextlib import contextmanager
+from django.core.cache.backends import db
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import connections, router, transaction
+
+# Database cache backend whose add and incr are atomic across processes, used as the shared tier of TieredCache
+# Django's DatabaseCache adds an expired key and increments a value with a read followed by a write, so two workers can
+# both take the same lock (control cache single flight, circuit breaker trial call) or get the same sequence number
+# (invalidation log of TieredCache). Here the row of the key is locked first with a no-op update, which also takes the
+# write lock of an SQLite database, and the read and the write are made in the same database transaction
+# incr keeps the expiry of the key, Django's sets the default timeout again
+# The table is in a database of its own (refer db_router.py), so these database transactions never nest in the ones of the app
+class DatabaseCache(db.DatabaseCache):
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self.lock(key, version):
+            return super().add(key, value, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        with self.lock(key, version) as cursor:
+            value = self.get(key, self._missing_key, version=version)
+            if value is self._missing_key:
+                raise ValueError("Key '%s' not found" % key)
+            value += delta
+            pickled = base64.b64encode(pickle.dumps(value, self.pickle_protocol)).decode('latin1')
+            cursor.execute("UPDATE %s SET value = %%s WHERE cache_key = %%s" % self.quoted_table(cursor),
+                           [pickled, self.make_key(key, version=version)])
+        return value
+
+    # Query = update cache set expires = expires where cache_key = ?, in a database transaction held until the block exits
+    @contextmanager
+    def lock(self, key, version):
+        cache_key = self.make_key(key, version=version)
+        self.validate_key(cache_key)
+        db_alias = router.db_for_write(self.cache_model_class)
+        with transaction.atomic(using=db_alias), connections[db_alias].cursor() as cursor:
+            cursor.execute("UPDATE %s SET expires = expires WHERE cache_key = %%s" % self.quoted_table(cursor), [cache_key])
+            yield cursor
+
+    def quoted_table(self, cursor):
+        return cursor.db.ops.quote_name(self._table)
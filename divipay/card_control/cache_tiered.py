@@ -0,0 +1,215 @@
+import pickle
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.exceptions import ImproperlyConfigured
+
+_MISSING = object()
+
+# Two tier cache backend
+# A small LRU in the worker process sits in front of a shared cache backend (configured as another alias in CACHES)
+# so hot keys like card_ and group_control_ are served without a round trip to the shared cache.
+#
+# Writes (set / add / delete / incr / clear) go to the shared cache and are published to the other workers
+# through an invalidation log kept in the shared cache:
+#   tiered_seq      - sequence number of the last invalidation
+#   tiered_seq_<n>  - (n, worker token, key) invalidated at sequence n
+# Every worker reads tiered_seq at most once per SYNC_INTERVAL seconds and evicts the keys logged since its last sync.
+# Local entries also expire after LOCAL_TIMEOUT seconds, which bounds staleness if an invalidation is lost.
+# The shared backend must add and incr atomically (refer cache_db.py) and hold the log without culling it,
+# so its MAX_ENTRIES has to be larger than LOG_SIZE plus LOCAL_MAX_ENTRIES
+#
+# OPTIONS
+#   LOCAL_MAX_ENTRIES   - entries kept in the worker process, least recently used are evicted first
+#   LOCAL_TIMEOUT       - seconds an entry is served from the worker process
+#   SYNC_INTERVAL       - seconds between two reads of the invalidation log
+#   LOG_SIZE            - invalidations kept in the log. A worker which falls further behind clears its local tier
+#   WRITE_ONCE_PREFIXES - prefixes of keys whose value never changes once written (e.g. transaction decisions),
+#                         writing them is not published as no worker can hold another value
+class TieredCache(BaseCache):
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+    SEQ_KEY = "tiered_seq"
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._shared_alias = location
+        self._local_max_entries = int(options.get('LOCAL_MAX_ENTRIES', 1000))
+        self._local_timeout = float(options.get('LOCAL_TIMEOUT', 5))
+        self._sync_interval = float(options.get('SYNC_INTERVAL', 0.5))
+        self._log_size = int(options.get('LOG_SIZE', 1000))
+        self._write_once_prefixes = tuple(options.get('WRITE_ONCE_PREFIXES', ()))
+        self._shared_checked = False
+        self._token = uuid.uuid4().hex
+        self._local = OrderedDict()
+        self._lock = Lock()
+        self._last_seq = None
+        self._next_sync = 0
+
+    @property
+    def shared(self):
+        shared = caches[self._shared_alias]
+        if not self._shared_checked:
+            max_entries = getattr(shared, '_max_entries', None)
+            if max_entries is not None and max_entries <= self._log_size + self._local_max_entries:
+                raise ImproperlyConfigured("MAX_ENTRIES of the {} cache ({}) must be larger than LOG_SIZE plus LOCAL_MAX_ENTRIES ({})"
+                                           .format(self._shared_alias, max_entries, self._log_size + self._local_max_entries))
+            self._shared_checked = True
+        return shared
+
+    def get(self, key, default=None, version=None):
+        value = self.get_local(key, version=version)
+        if value is not _MISSING:
+            return value
+        value = self.shared.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            return default
+        self._set_local(self.make_key(key, version=version), value)
+        return value
+
+    def get_many(self, keys, version=None):
+        result = dict()
+        missing_keys = []
+        for key in keys:
+            value = self.get_local(key, version=version)
+            if value is _MISSING:
+                missing_keys.append(key)
+            else:
+                result[key] = value
+        if missing_keys:
+            shared_result = self.shared.get_many(missing_keys, version=version)
+            for key, value in shared_result.items():
+                self._set_local(self.make_key(key, version=version), value)
+            result.update(shared_result)
+        return result
+
+    # Returns the value from the local tier only, _MISSING if it is not there
+    def get_local(self, key, version=None):
+        local_key = self.make_key(key, version=version)
+        self.validate_key(local_key)
+        self._sync()
+        with self._lock:
+            entry = self._local.get(local_key)
+            if entry is None:
+                return _MISSING
+            if entry[0] <= time.monotonic():
+                del self._local[local_key]
+                return _MISSING
+            self._local.move_to_end(local_key)
+        return pickle.loads(entry[1])
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout, version=version)
+        local_key = self.make_key(key, version=version)
+        if not key.startswith(self._write_once_prefixes):
+            self._publish([local_key])
+        self._set_local(local_key, value)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed_keys = self.shared.set_many(data, timeout, version=version)
+        local_keys = [self.make_key(key, version=version) for key in data]
+        self._publish([local_key for key, local_key in zip(data, local_keys) if not key.startswith(self._write_once_prefixes)])
+        for key, local_key in zip(data, local_keys):
+            if not failed_keys or key not in failed_keys:
+                self._set_local(local_key, data[key])
+        return failed_keys
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.shared.add(key, value, timeout, version=version)
+        if added:
+            local_key = self.make_key(key, version=version)
+            if not key.startswith(self._write_once_prefixes):
+                self._publish([local_key])
+            self._set_local(local_key, value)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(key, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self.shared.incr(key, delta, version=version)
+        self._invalidate([self.make_key(key, version=version)])
+        return value
+
+    def delete(self, key, version=None):
+        deleted = self.shared.delete(key, version=version)
+        self._invalidate([self.make_key(key, version=version)])
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self.shared.delete_many(keys, version=version)
+        self._invalidate([self.make_key(key, version=version) for key in keys])
+
+    def has_key(self, key, version=None):
+        return self.get_local(key, version=version) is not _MISSING or self.shared.has_key(key, version=version)
+
+    def clear(self):
+        # clearing the shared cache also drops tiered_seq, every worker clears its local tier on its next sync
+        self.shared.clear()
+        with self._lock:
+            self._local.clear()
+            self._last_seq = None
+
+    def _set_local(self, local_key, value):
+        pickled = pickle.dumps(value, self.pickle_protocol)
+        with self._lock:
+            self._local[local_key] = (time.monotonic() + self._local_timeout, pickled)
+            self._local.move_to_end(local_key)
+            while len(self._local) > self._local_max_entries:
+                self._local.popitem(last=False)
+
+    def _invalidate(self, local_keys):
+        with self._lock:
+            for local_key in local_keys:
+                self._local.pop(local_key, None)
+        self._publish(local_keys)
+
+    # Appends the keys to the invalidation log so the other workers evict them
+    def _publish(self, local_keys):
+        if not local_keys:
+            return
+        shared = self.shared
+        try:
+            last_seq = shared.incr(TieredCache.SEQ_KEY, len(local_keys))
+        except ValueError:
+            shared.add(TieredCache.SEQ_KEY, 0, timeout=None)
+            last_seq = shared.incr(TieredCache.SEQ_KEY, len(local_keys))
+        first_seq = last_seq - len(local_keys) + 1
+        log_entries = {self._log_key(seq) : (seq, self._token, local_key)
+                       for seq, local_key in enumerate(local_keys, first_seq)}
+        shared.set_many(log_entries, timeout=None)
+
+    # Evicts the keys invalidated by the other workers since the last sync
+    def _sync(self):
+        now = time.monotonic()
+        if now < self._next_sync:
+            return
+        self._next_sync = now + self._sync_interval
+        shared = self.shared
+        seq = shared.get(TieredCache.SEQ_KEY)
+        last_seq = self._last_seq
+        if seq == last_seq:
+            return
+        if seq is None or last_seq is None or seq < last_seq or seq - last_seq > self._log_size:
+            # log was lost or this worker fell too far behind
+            with self._lock:
+                self._local.clear()
+        else:
+            log_keys = {self._log_key(n) : n for n in range(last_seq + 1, seq + 1)}
+            log_entries = shared.get_many(list(log_keys))
+            with self._lock:
+                if any(log_entries.get(log_key, (None,))[0] != n for log_key, n in log_keys.items()):
+                    # entries missing or already overwritten by newer invalidations
+                    self._local.clear()
+                else:
+                    for n, token, local_key in log_entries.values():
+                        if token != self._token:
+                            self._local.pop(local_key, None)
+        self._last_seq = seq
+
+    def _log_key(self, seq):
+        return TieredCache.SEQ_KEY + "_" + str(seq % self._log_size)
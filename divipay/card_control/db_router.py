@@ -0,0 +1,24 @@
+# Database router sending the table of the shared cache (card_control.cache_db.DatabaseCache) to the 'cache' database
+# The cache then reads and writes through a connection of its own: a cache write made inside a transaction of the 'default'
+# database neither joins it nor is rolled back with it, and the row lock taken by add / incr is released as soon as they return
+# Django's database caches are models of the django_cache app label. Refer DATABASES and CACHES in settings.py
+class CacheRouter(object):
+    CACHE_APP_LABEL = "django_cache"
+    CACHE_DATABASE = "cache"
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == CacheRouter.CACHE_APP_LABEL:
+            return CacheRouter.CACHE_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    # The cache table is only created in the cache database (python manage.py createcachetable --database cache)
+    # and the models of the apps are never migrated there
+    def allow_migrate(self, db, app_label, model_name = None, **hints):
+        if app_label == CacheRouter.CACHE_APP_LABEL:
+            return db == CacheRouter.CACHE_DATABASE
+        if db == CacheRouter.CACHE_DATABASE:
+            return False
+        return None
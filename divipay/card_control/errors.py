@@ -7,6 +7,14 @@ class Unavailable(Error):
     def __init__(self):
         self.message = Messages.Common.CONNECTION_ERROR
 
+class CircuitOpen(Unavailable):
+    def __init__(self):
+        self.message = Messages.Common.CIRCUIT_OPEN
+
+class BulkheadFull(Unavailable):
+    def __init__(self):
+        self.message = Messages.Common.TOO_MANY_CALLS
+
 class DiviPayError(Error):
     def __init__(self, code, message):
         self.code = code
@@ -0,0 +1,83 @@
+import csv
+import datetime
+import json
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .models import INTERNED_VARIABLES, Transaction, TXN_STATUS_CHOICES
+from .utility import to_major_units
+
+# Streaming export of transactions as CSV or NDJSON
+# Rows are read with a server side cursor (QuerySet.iterator) EXPORT_CHUNK_SIZE at a time and written line by line,
+# so the result set is never held in memory. Used by views_txn.export_txns and the export_txns command
+FIELDS = ("id", "card", "amount", "merchant", "merchant_category", "status", "reason", "created_at", "updated_at")
+# merchant names and categories are read from their interned values, refer models.InternedValue
+COLUMNS = tuple(field + "__value" if field in INTERNED_VARIABLES else field for field in FIELDS)
+FORMATS = ("csv", "ndjson")
+CONTENT_TYPES = {
+    "csv" : "text/csv",
+    "ndjson" : "application/x-ndjson"
+}
+
+# Returns the filters of the export from request / command parameters, raises ValueError if any of them is not valid
+# card, status (A / R), created_from (inclusive) and created_to (exclusive) as ISO dates or date times
+def parse_filters(card = None, status = None, created_from = None, created_to = None):
+    if status is not None and status not in dict(TXN_STATUS_CHOICES):
+        raise ValueError(status)
+    return {
+        "card" : card or None,
+        "status" : status,
+        "created_from" : parse_date_or_datetime(created_from),
+        "created_to" : parse_date_or_datetime(created_to)
+    }
+
+# dates are midnight, date times without an offset are in the current time zone
+def parse_date_or_datetime(value):
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        parsed_date = parse_date(value)
+        if parsed_date is None:
+            raise ValueError(value)
+        parsed = datetime.datetime.combine(parsed_date, datetime.time.min)
+    if settings.USE_TZ and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+# Returns the transactions matching the filters
+# Query = select ... from transaction where card = ? and status = ? and created_at >= ? and created_at < ?
+# Served by the txn_card_created_idx index when the card is given
+def filter_txns(card = None, status = None, created_from = None, created_to = None):
+    txns = Transaction.objects.all()
+    if card is not None:
+        txns = txns.filter(card=card)
+    if status is not None:
+        txns = txns.filter(status=status)
+    if created_from is not None:
+        txns = txns.filter(created_at__gte=created_from)
+    if created_to is not None:
+        txns = txns.filter(created_at__lt=created_to)
+    return txns
+
+# Yields the lines of the export, the header first for CSV
+def export_lines(txns, export_format):
+    rows = (format_row(row) for row in txns.values_list(*COLUMNS).iterator(chunk_size=settings.EXPORT_CHUNK_SIZE))
+    if export_format == "csv":
+        writer = csv.writer(Echo())
+        yield writer.writerow(FIELDS)
+        for row in rows:
+            yield writer.writerow(row)
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(FIELDS, row))) + "\n"
+
+# amount in major units, dates in ISO 8601
+def format_row(row):
+    txn_id, card, amount, merchant, merchant_category, status, reason, created_at, updated_at = row
+    return (txn_id, card, str(to_major_units(amount)), merchant, merchant_category, status, reason, created_at.isoformat(), updated_at.isoformat())
+
+# File like object which returns what is written to it, so csv.writer formats a single row at a time
+class Echo(object):
+    def write(self, value):
+        return value
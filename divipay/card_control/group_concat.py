@@ -1,13 +0,0 @@
-from django.db.models import Aggregate, CharField
-  
-class GroupConcat(Aggregate):
-        function = 'GROUP_CONCAT'
-        template = '%(function)s(%(distinct)s%(expressions)s)'
-
-        def __init__(self, expression, distinct=False, **extra):
-                super(GroupConcat, self).__init__(
-                        expression,
-                        distinct='DISTINCT ' if distinct else '',
-                        output_field=CharField(),
-                        **extra
-                )
@@ -0,0 +1,133 @@
+import bisect
+import threading
+import time
+from django.conf import settings
+
+# Instrumentation of the authorization pipeline
+# Stage timers (count, total, max and a latency histogram) and counters are kept per worker process
+# and exported by the metrics API. Refer views_metrics.py
+#
+# Stages of a transaction
+FETCH = "fetch"
+CONTROLS_LOOKUP = "controls_lookup"
+RULE_EVALUATION = "rule_evaluation"
+BALANCE_DEBIT = "balance_debit"
+TXN_WRITE = "txn_write"
+# Balance ledger of the transaction workers. Refer ledger.py
+LEDGER_CHECKPOINT = "ledger_checkpoint"
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last bucket is unbounded
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._timers = dict()
+            self._counters = dict()
+            self._started = time.time()
+
+    def record(self, stage, elapsed):
+        elapsed_ms = elapsed * 1000
+        bucket = bisect.bisect_left(BUCKETS_MS, elapsed_ms)
+        with self._lock:
+            timer = self._timers.get(stage)
+            if timer is None:
+                # count, total ms, max ms, histogram
+                timer = self._timers[stage] = [0, 0.0, 0.0, [0] * (len(BUCKETS_MS) + 1)]
+            timer[0] += 1
+            timer[1] += elapsed_ms
+            if elapsed_ms > timer[2]:
+                timer[2] = elapsed_ms
+            timer[3][bucket] += 1
+
+    def incr(self, name, value = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def incr_many(self, names):
+        with self._lock:
+            for name in names:
+                self._counters[name] = self._counters.get(name, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            timers = {stage : {
+                        "count" : count,
+                        "total_ms" : round(total, 3),
+                        "avg_ms" : round(total / count, 3) if count else 0,
+                        "max_ms" : round(maximum, 3),
+                        "p50_ms" : percentile(histogram, count, 0.50),
+                        "p99_ms" : percentile(histogram, count, 0.99),
+                        "histogram" : dict(zip([str(bound) for bound in BUCKETS_MS] + ["inf"], histogram))
+                    } for stage, (count, total, maximum, histogram) in self._timers.items()}
+            return {
+                "since" : self._started,
+                "timers" : timers,
+                "counters" : dict(self._counters)
+            }
+
+# Upper bound of the bucket holding the given percentile
+def percentile(histogram, count, fraction):
+    if count == 0:
+        return 0
+    rank = fraction * count
+    seen = 0
+    for bound, bucket_count in zip(BUCKETS_MS, histogram):
+        seen += bucket_count
+        if seen >= rank:
+            return bound
+    return None
+
+metrics = Metrics()
+
+# Times a stage of the pipeline
+# with stage_timer(instrumentation.FETCH):
+#     ...
+class stage_timer(object):
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        if settings.CARD_CONTROL_METRICS_ENABLED:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is not None:
+            metrics.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+def incr(name, value = 1):
+    if settings.CARD_CONTROL_METRICS_ENABLED:
+        metrics.incr(name, value)
+
+# Counts the outcome of every control of the plan
+# Controls evaluated before the failed control passed, the ones after it were not evaluated
+def record_control_outcomes(controls_plan, failed_control = None):
+    if not settings.CARD_CONTROL_METRICS_ENABLED:
+        return
+    if controls_plan.missing_mandatory is not None:
+        metrics.incr("control.mandatory.failed")
+        return
+    record_rule_outcomes(controls_plan.rules, failed_control)
+
+# Counts the outcome of every velocity control of the plan
+def record_velocity_outcomes(controls_plan, failed_control = None):
+    if settings.CARD_CONTROL_METRICS_ENABLED:
+        record_rule_outcomes(controls_plan.velocity_rules, failed_control)
+
+def record_rule_outcomes(rules, failed_control):
+    names = []
+    for rule in rules:
+        if rule.control_name == failed_control:
+            names.append("control." + rule.control_name + ".failed")
+            break
+        names.append("control." + rule.control_name + ".passed")
+    metrics.incr_many(names)
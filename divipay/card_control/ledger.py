@@ -0,0 +1,285 @@
+import datetime
+import json
+import logging
+import os
+import time
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from . import errors
+from . import instrumentation
+from .instrumentation import stage_timer
+from .messages import Messages
+from .models import Card, CardSpend, LedgerCheckpoint, Transaction
+from .processor_txn import LEDGER_CARD_SET, TxnStatus, create_txn_object, evaluate_velocity, intern_txns, retrieve_control_plan
+
+logger = logging.getLogger(__name__)
+
+# In memory balance ledger for hot cards (LEDGER_CARDS in settings.py), owned by a transaction worker. Refer txn_queue.py
+#
+# A worker owns the partitions of its cards, so it is the only process authorizing transactions of these cards from the queue.
+# Their balances and velocity spend are kept in memory and debited without a database round trip, every decision is appended
+# to the write ahead log of the partition of the card, which is synced to disk before the queued transactions are deleted.
+# A checkpoint applies the logged decisions to the database in a single database transaction: transaction rows are inserted,
+# the debits are subtracted from Card.balance with a conditional update (so balance changes made outside of the ledger are kept)
+# and the CardSpend rows and the LedgerCheckpoint of every partition are updated. The logs are truncated once it commits
+# Transactions already stored are neither inserted nor debited again. When the balance of a card no longer covers its debits
+# (it was changed outside of the ledger), its transactions are approved again in order against the balance in the database
+# and the ones it does not cover are rejected
+#
+# On start up, the entries of the logs after the sequence of the LedgerCheckpoint of their partition are applied again,
+# entries up to it were applied before a crash and are skipped
+#
+# Balances of the loaded cards are read again at every checkpoint, so top ups are seen within LEDGER_CHECKPOINT_INTERVAL seconds.
+# Transactions of ledger cards are only processed through the queue, process_txn and process_txn_batch reject them
+
+# Write ahead log of a partition, a JSON line per decision. The file is created on the first entry
+class PartitionLog(object):
+    def __init__(self, partition, directory):
+        self.partition = partition
+        self.path = os.path.join(directory, "partition_{}.wal".format(partition))
+        self.file = None
+        # sequence of the last entry appended
+        self.sequence = 0
+        # entries not checkpointed yet
+        self.entries = []
+
+    # Returns the entries in the log, an entry partly written when the worker stopped is dropped
+    def read(self):
+        entries = []
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "rb") as log_file:
+            for line in log_file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Partly written entry at the end of %s dropped", self.path)
+                    break
+        return entries
+
+    def open(self):
+        self.file = open(self.path, "ab")
+
+    def append(self, entry):
+        if self.file is None:
+            self.open()
+        self.sequence += 1
+        entry["seq"] = self.sequence
+        self.file.write(json.dumps(entry).encode("utf-8") + b"\n")
+        self.entries.append(entry)
+
+    def sync(self):
+        self.file.flush()
+        if settings.LEDGER_FSYNC:
+            os.fsync(self.file.fileno())
+
+    def truncate(self):
+        if self.file is not None:
+            self.file.truncate(0)
+        self.entries = []
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class Ledger(object):
+    def __init__(self, partitions, directory = None):
+        self.directory = settings.LEDGER_DIR if directory is None else directory
+        self.logs = {partition : PartitionLog(partition, self.directory) for partition in partitions}
+        # card id : balance in minor units
+        self.balances = dict()
+        # card id : {window : (amount, count)} of self.day
+        self.spend = dict()
+        # txn id : (status, reason) of the transactions logged since the last checkpoint
+        self.decisions = dict()
+        self.day = timezone.localdate()
+        self.last_checkpoint = time.monotonic()
+
+    def owns(self, card_id):
+        return card_id in LEDGER_CARD_SET
+
+    # Opens the logs and applies the entries which were not checkpointed before the last stop
+    def recover(self):
+        os.makedirs(self.directory, exist_ok=True)
+        checkpoints = dict(LedgerCheckpoint.objects.filter(partition__in=list(self.logs)).values_list("partition", "sequence"))
+        for partition, log in self.logs.items():
+            checkpointed = checkpoints.get(partition, 0)
+            log.entries = [entry for entry in log.read() if entry["seq"] > checkpointed]
+            log.sequence = max([checkpointed] + [entry["seq"] for entry in log.entries])
+            if os.path.exists(log.path):
+                log.open()
+        replayed = sum(len(log.entries) for log in self.logs.values())
+        if replayed:
+            logger.info("Applying %d ledger entries logged before the last stop", replayed)
+        self.checkpoint()
+
+    # Authorizes the queued transactions of ledger cards in order, and syncs their decisions to the logs
+    # Transactions already decided (retried deliveries) are skipped
+    def process(self, queued_txns):
+        if timezone.localdate() != self.day:
+            # velocity spend of the new day is read from the database once the previous day is checkpointed
+            self.checkpoint()
+            self.day = timezone.localdate()
+            self.spend.clear()
+        stored_decisions = Transaction.get_decisions([txn_id for txn_id in {queued_txn.txn_id for queued_txn in queued_txns} if txn_id not in self.decisions])
+        intern_txns([queued_txn.payload for queued_txn in queued_txns])
+        decisions = dict()
+        logs = set()
+        try:
+            for queued_txn in queued_txns:
+                txn_data = queued_txn.payload
+                if txn_data["id"] in self.decisions or txn_data["id"] in stored_decisions or txn_data["id"] in decisions:
+                    instrumentation.incr("txn.duplicate")
+                    continue
+                txn_status, reason = self.authorize(txn_data)
+                decisions[txn_data["id"]] = self.decisions[txn_data["id"]] = (txn_status.name, reason)
+                log = self.logs[queued_txn.partition]
+                log.append({"txn" : txn_data, "status" : txn_status.name, "reason" : reason, "day" : self.day.isoformat()})
+                logs.add(log)
+                instrumentation.incr("txn.approved" if txn_status is TxnStatus.A else "txn.rejected")
+        finally:
+            for log in logs:
+                log.sync()
+        Transaction.cache_decisions(decisions)
+
+    def authorize(self, txn_data):
+        card_id = txn_data["card"]
+        txn_amount = txn_data["amount"]
+        with stage_timer(instrumentation.CONTROLS_LOOKUP):
+            controls_plan = retrieve_control_plan(card_id)
+        with stage_timer(instrumentation.RULE_EVALUATION):
+            try:
+                controls_plan.evaluate(txn_data)
+            except errors.ControlException as control_exception:
+                instrumentation.record_control_outcomes(controls_plan, control_exception.errors.control)
+                return (TxnStatus.R, control_exception.message)
+            instrumentation.record_control_outcomes(controls_plan)
+
+        with stage_timer(instrumentation.BALANCE_DEBIT):
+            balance = self.get_balance(card_id)
+            if balance is None:
+                return (TxnStatus.R, Messages.Card.DETAILS_NOT_FOUND)
+            if balance < txn_amount:
+                return (TxnStatus.R, Messages.Transaction.INSUFFICIENT_BALANCE)
+            spend = self.get_spend(card_id)
+            if controls_plan.velocity_rules:
+                try:
+                    evaluate_velocity(controls_plan, txn_data, spend)
+                except errors.ControlException as control_exception:
+                    return (TxnStatus.R, control_exception.message)
+            self.balances[card_id] = balance - txn_amount
+            for window in CardSpend.window_starts(self.day):
+                window_amount, window_count = spend.get(window, (0, 0))
+                spend[window] = (window_amount + txn_amount, window_count + 1)
+        return (TxnStatus.A, None)
+
+    # Balance of the card, read from the database the first time. None if the card does not exist
+    def get_balance(self, card_id):
+        balance = self.balances.get(card_id)
+        if balance is None:
+            balance = Card.objects.filter(id=card_id).values_list("balance", flat=True).first()
+            if balance is not None:
+                self.balances[card_id] = balance
+        return balance
+
+    def get_spend(self, card_id):
+        spend = self.spend.get(card_id)
+        if spend is None:
+            spend = self.spend[card_id] = CardSpend.get_spend(card_id, self.day)
+        return spend
+
+    def checkpoint_if_due(self):
+        if (time.monotonic() - self.last_checkpoint >= settings.LEDGER_CHECKPOINT_INTERVAL
+                or len(self.decisions) >= settings.LEDGER_CHECKPOINT_TXNS):
+            self.checkpoint()
+
+    # Applies the logged entries to the database and truncates the logs
+    def checkpoint(self):
+        entries = [entry for log in self.logs.values() for entry in log.entries]
+        intern_txns([entry["txn"] for entry in entries])
+        debits = dict()
+        # txn id : (status, reason) of the transactions whose logged decision was not applied, and their cards
+        changed_decisions = dict()
+        changed_cards = set()
+        with stage_timer(instrumentation.LEDGER_CHECKPOINT), transaction.atomic():
+            if entries:
+                # Rows already stored for a transaction id are left as they are and not debited
+                stored_decisions = Transaction.load_decisions([entry["txn"]["id"] for entry in entries])
+                changed_decisions.update(stored_decisions)
+                entries_by_card = dict()
+                for entry in entries:
+                    if entry["txn"]["id"] in stored_decisions:
+                        changed_cards.add(entry["txn"]["card"])
+                    else:
+                        entries_by_card.setdefault(entry["txn"]["card"], []).append(entry)
+                spend = dict()
+                txns = []
+                for card_id, card_entries in entries_by_card.items():
+                    decisions = self.debit(card_id, card_entries)
+                    for entry in card_entries:
+                        txn_data = entry["txn"]
+                        txn_status, reason = decisions[txn_data["id"]]
+                        if (txn_status, reason) != (entry["status"], entry["reason"]):
+                            changed_decisions[txn_data["id"]] = (txn_status, reason)
+                            changed_cards.add(card_id)
+                        txns.append(create_txn_object(txn_data, TxnStatus[txn_status], reason))
+                        if txn_status == TxnStatus.A.name:
+                            debits[card_id] = debits.get(card_id, 0) + txn_data["amount"]
+                            window_amount, window_count = spend.get((card_id, entry["day"]), (0, 0))
+                            spend[(card_id, entry["day"])] = (window_amount + txn_data["amount"], window_count + 1)
+                # A row inserted by another process in the meantime fails the checkpoint, which is retried with the logs as they are
+                Transaction.objects.bulk_create(txns, batch_size=settings.QUEUE_BATCH_SIZE)
+                for (card_id, day), (amount, count) in spend.items():
+                    CardSpend.record(card_id, amount, count, datetime.date.fromisoformat(day))
+                for partition, log in self.logs.items():
+                    if log.entries:
+                        LedgerCheckpoint.objects.update_or_create(partition=partition, defaults={"sequence" : log.sequence})
+            if self.balances:
+                self.balances.update(Card.objects.filter(id__in=list(self.balances)).values_list("id", "balance"))
+        if debits:
+            Card.set_cache_many(list(debits))
+            logger.debug("Ledger checkpointed %d entries of %d cards", len(entries), len(debits))
+        if changed_decisions:
+            logger.warning("%d ledger decisions were not applied as logged", len(changed_decisions))
+            Transaction.cache_decisions(changed_decisions)
+            # velocity spend of their cards is read again from the database
+            for card_id in changed_cards:
+                self.spend.pop(card_id, None)
+        for log in self.logs.values():
+            log.truncate()
+        self.decisions.clear()
+        self.last_checkpoint = time.monotonic()
+
+    # Debits the card with the amount of its approved entries and returns {txn id : (status, reason)} of the entries
+    # update card set balance = balance - amount where id = card_id and balance >= amount
+    # When the balance is not sufficient the card row is locked and the entries are approved again in order against it
+    def debit(self, card_id, card_entries):
+        decisions = {entry["txn"]["id"] : (entry["status"], entry["reason"]) for entry in card_entries}
+        approved = [entry["txn"] for entry in card_entries if entry["status"] == TxnStatus.A.name]
+        amount = sum(txn_data["amount"] for txn_data in approved)
+        if amount == 0 or Card.objects.filter(id=card_id, balance__gte=amount).update(balance=F("balance") - amount):
+            return decisions
+        balance = Card.objects.select_for_update().filter(id=card_id).values_list("balance", flat=True).first()
+        logger.warning("Balance of ledger card %s does not cover its debit of %d, approving its transactions again", card_id, amount)
+        amount = 0
+        for txn_data in approved:
+            if balance is None:
+                decisions[txn_data["id"]] = (TxnStatus.R.name, Messages.Card.DETAILS_NOT_FOUND)
+            elif balance - amount < txn_data["amount"]:
+                decisions[txn_data["id"]] = (TxnStatus.R.name, Messages.Transaction.INSUFFICIENT_BALANCE)
+            else:
+                amount += txn_data["amount"]
+        if amount:
+            Card.objects.filter(id=card_id).update(balance=F("balance") - amount)
+        return decisions
+
+    # Checkpoints the logged entries and closes the logs
+    def close(self):
+        try:
+            self.checkpoint()
+        finally:
+            for log in self.logs.values():
+                log.close()
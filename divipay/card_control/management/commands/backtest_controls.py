@@ -0,0 +1,61 @@
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from card_control import backtest, export
+
+# Backtests the controls against historical transactions, reporting how many transactions every control would reject now
+# Run it after changing CONTROL_DEFINITION, or pass the controls to try for some cards in a JSON file
+# {"<card id>" : {"MAX_AMT" : ["50"], "MER_CAT" : ["5411", "5734"]}}
+# Requires NumPy (pip install numpy)
+#
+# python manage.py backtest_controls --from 2019-07-01 --to 2019-08-01 --controls proposed.json
+class Command(BaseCommand):
+    help = "Backtests the controls against historical transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--card", help="card id")
+        parser.add_argument("--from", dest="created_from", help="created at or after, ISO date or date time")
+        parser.add_argument("--to", dest="created_to", help="created before, ISO date or date time")
+        parser.add_argument("--controls", help="JSON file with the controls replacing the ones of its cards")
+        parser.add_argument("--chunk-size", type=int, default=settings.BACKTEST_CHUNK_SIZE, help="transactions evaluated at a time")
+
+    def handle(self, *args, **options):
+        if backtest.np is None:
+            raise CommandError("NumPy is required for backtests, pip install numpy")
+        try:
+            filters = export.parse_filters(options["card"], None, options["created_from"], options["created_to"])
+        except ValueError as e:
+            raise CommandError("Not a valid filter {}".format(e))
+        overrides = self.load_overrides(options["controls"]) if options["controls"] else None
+
+        result = backtest.backtest(filters, overrides, options["chunk_size"])
+        self.stdout.write("Transactions backtested          {}".format(result.total))
+        self.stdout.write("Approved when made / now         {} / {}".format(result.approved_before, result.approved_after))
+        self.stdout.write("Approved when made, rejected now {}".format(result.newly_rejected))
+        self.stdout.write("Rejected by a control, approved  {}".format(result.newly_approved))
+        self.stdout.write("")
+        self.stdout.write("{:<12} {:>12} {:>16}".format("Control", "Rejected", "Newly rejected"))
+        for control_name, (rejected, newly_rejected) in sorted(result.controls.items()):
+            self.stdout.write("{:<12} {:>12} {:>16}".format(control_name, rejected, newly_rejected))
+        if result.skipped:
+            self.stdout.write("")
+            self.stdout.write("Not backtested: {}".format(", ".join(sorted(result.skipped))))
+
+    # {card id : {control name : [control values]}}, control values as they would be stored (strings)
+    def load_overrides(self, path):
+        try:
+            with open(path) as controls_file:
+                overrides = json.load(controls_file)
+        except (OSError, ValueError) as e:
+            raise CommandError("Controls could not be read {}".format(e))
+        if not isinstance(overrides, dict):
+            raise CommandError("Not a valid controls file, expected {card id : {control name : [control values]}}")
+        for card_id, controls in overrides.items():
+            if not isinstance(controls, dict):
+                raise CommandError("Not valid controls for card {}, expected {{control name : [control values]}}".format(card_id))
+            for control_name, control_values in controls.items():
+                if control_name not in settings.CONTROL_DEFINITION:
+                    raise CommandError("Not a valid control name {}".format(control_name))
+                if not isinstance(control_values, list) or not all(isinstance(control_value, str) for control_value in control_values):
+                    raise CommandError("Not valid values of {} for card {}, expected a list of strings".format(control_name, card_id))
+        return overrides
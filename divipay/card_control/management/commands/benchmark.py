@@ -0,0 +1,388 @@
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import django
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from card_control.instrumentation import metrics, stage_timer
+from card_control.models import Card, Control
+
+ENDPOINTS = ("card_create", "txn", "control_list", "control_create", "control_delete")
+
+# Stage timing the whole request in the server, reported with the stages of the app next to the client latency
+SERVER_STAGE = "server"
+
+# Benchmark of the authorization and control APIs
+# Runs the app in a test database behind a local HTTP server, with a local stand-in for the DiviPay API,
+# and measures throughput and p50 / p99 latency of every endpoint for every combination of
+# card count, controls per card and concurrency. Results are written as JSON so runs can be compared.
+# The server side time of the requests and of every stage (refer instrumentation.py) is reported next to the client latency,
+# so the overhead of the local HTTP servers and clients can be told apart from the time spent in the app
+#
+# python manage.py benchmark --cards 10 1000 --controls 2 10 --concurrency 1 8 --output before.json
+# python manage.py benchmark --cards 10 1000 --controls 2 10 --concurrency 1 8 --output after.json --compare before.json
+class Command(BaseCommand):
+    help = "Benchmarks the authorization and control APIs against a local stand-in for the DiviPay API"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cards", type=int, nargs="+", default=[100], help="card counts")
+        parser.add_argument("--controls", type=int, nargs="+", default=[4], help="controls per card")
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8], help="concurrent clients")
+        parser.add_argument("--requests", type=int, default=500, help="measured requests per endpoint and scenario")
+        parser.add_argument("--warmup", type=int, default=20, help="requests per endpoint and scenario before measuring")
+        parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="file to write the results to, printed when not given")
+        parser.add_argument("--compare", help="results of an earlier run to compare against")
+
+    def handle(self, *args, **options):
+        control_values = benchmark_control_values()
+        for controls_per_card in options["controls"]:
+            if not 2 <= controls_per_card <= len(control_values):
+                raise CommandError("--controls must be between 2 and {}".format(len(control_values)))
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        random.seed(options["seed"])
+
+        temp_dir = tempfile.mkdtemp(prefix="divipay_benchmark_")
+        stub = DiviPayStub()
+        server = None
+        old_config = None
+        try:
+            # SQLite in memory test databases are bound to one connection, a file lets every server thread connect
+            db_settings = connections["default"].settings_dict
+            if db_settings["ENGINE"] == "django.db.backends.sqlite3":
+                db_settings["TEST"]["NAME"] = os.path.join(temp_dir, "benchmark.sqlite3")
+                db_settings["OPTIONS"]["timeout"] = 30
+            old_config = setup_databases(verbosity=0, interactive=False)
+            with override_settings(DEBUG=False, ALLOWED_HOSTS=["127.0.0.1"], DIVIPAY_API_BASE_URL=stub.start()):
+                server = start_server()
+                if options["verbosity"] < 2:
+                    # after start_server, which configures logging again
+                    logging.getLogger("card_control").setLevel(logging.WARNING)
+                base_url = "http://127.0.0.1:{}/cardcontrol/".format(server.server_address[1])
+                user = User.objects.create(username="benchmark")
+                token = Token.objects.create(user=user).key
+                results = []
+                for card_count, controls_per_card in itertools.product(options["cards"], options["controls"]):
+                    card_ids = create_cards(user, card_count, control_values[:controls_per_card])
+                    stub.card_ids = card_ids
+                    for concurrency in options["concurrency"]:
+                        scenario = {
+                            "cards" : card_count,
+                            "controls_per_card" : controls_per_card,
+                            "concurrency" : concurrency
+                        }
+                        runner = ScenarioRunner(base_url, token, card_ids, concurrency)
+                        for endpoint in options["endpoints"]:
+                            result = runner.run(endpoint, options["warmup"], options["requests"])
+                            result.update(scenario)
+                            results.append(result)
+                            self.stdout.write(format_result(result))
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            stub.stop()
+            if old_config is not None:
+                teardown_databases(old_config, verbosity=0)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        report = {
+            "environment" : {
+                "created" : timezone.now().isoformat(),
+                "python" : platform.python_version(),
+                "django" : django.get_version(),
+                "database" : connections["default"].vendor,
+                "cache" : settings.CACHES["default"]["BACKEND"],
+                "cpu_count" : os.cpu_count(),
+                "requests" : options["requests"],
+                "warmup" : options["warmup"],
+                "seed" : options["seed"]
+            },
+            "results" : results
+        }
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                json.dump(report, output_file, indent=2)
+            self.stdout.write("Results written to " + options["output"])
+        else:
+            self.stdout.write(json.dumps(report, indent=2))
+        if baseline is not None:
+            for line in compare_results(baseline["results"], results):
+                self.stdout.write(line)
+
+# Runs every endpoint of one scenario with a fixed number of concurrent clients
+class ScenarioRunner(object):
+    def __init__(self, base_url, token, card_ids, concurrency):
+        self.base_url = base_url
+        self.headers = {"Authorization" : "Token " + token}
+        self.card_ids = card_ids
+        self.concurrency = concurrency
+        self.created_controls = []
+        self.created_controls_lock = threading.Lock()
+        self.local = threading.local()
+
+    def run(self, endpoint, warmup, count):
+        request = getattr(self, endpoint)
+        if endpoint == "control_delete":
+            # deletes the controls created by control_create, creating more when there are not enough
+            missing = warmup + count - len(self.created_controls)
+            if missing > 0:
+                self.run_requests(self.control_create, missing)
+        self.run_requests(request, warmup)
+        metrics.reset()
+        started = time.perf_counter()
+        latencies, errors = self.run_requests(request, count)
+        elapsed = time.perf_counter() - started
+        return summarize(endpoint, latencies, errors, elapsed, metrics.snapshot())
+
+    def run_requests(self, request, count):
+        remaining = itertools.count()
+        latencies = []
+        errors = []
+
+        def client():
+            session = self.session()
+            while next(remaining) < count:
+                started = time.perf_counter()
+                try:
+                    ok = request(session)
+                except requests.RequestException:
+                    ok = False
+                latencies.append(time.perf_counter() - started)
+                if not ok:
+                    errors.append(1)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for future in [executor.submit(client) for _ in range(self.concurrency)]:
+                future.result()
+        return latencies, len(errors)
+
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            session.headers.update(self.headers)
+        return session
+
+    def card_create(self, session):
+        return session.post(self.base_url + "stub/card").status_code == 201
+
+    def txn(self, session):
+        response = session.get(self.base_url + "stub/txn")
+        return response.status_code == 200 and response.json()["status"] == "Success"
+
+    def control_list(self, session):
+        card_id = random.choice(self.card_ids)
+        return session.get(self.base_url + "api/v1/card/{}/control".format(card_id)).status_code == 200
+
+    def control_create(self, session):
+        card_id = random.choice(self.card_ids)
+        body = {
+            "control_name" : "MER_NAME",
+            "control_value" : random.choice(settings.CONTROL_DEFINITION["MER_NAME"]["input_validation"]["choices"])
+        }
+        response = session.post(self.base_url + "api/v1/card/{}/control".format(card_id), json=body)
+        if response.status_code != 201:
+            return False
+        with self.created_controls_lock:
+            self.created_controls.append((card_id, response.json()["data"]["id"]))
+        return True
+
+    def control_delete(self, session):
+        with self.created_controls_lock:
+            card_id, pk = self.created_controls.pop()
+        return session.delete(self.base_url + "api/v1/card/{}/control/{}".format(card_id, pk)).status_code == 204
+
+# Local stand-in for the DiviPay API
+# POST cards/ returns a new card, GET transaction/ returns a transaction of a random benchmark card
+# which complies with the controls created by create_cards
+class DiviPayStub(object):
+    def __init__(self):
+        self.card_ids = []
+        self.server = None
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("transaction"):
+                    self.send_json(200, stub.transaction())
+                else:
+                    self.send_json(404, {"detail" : "Not found."})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if self.path.rstrip("/").endswith("cards"):
+                    self.send_json(201, stub.card())
+                else:
+                    self.send_json(404, {"detail" : "Not found."})
+
+            def send_json(self, status_code, content):
+                body = json.dumps(content).encode()
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = NoDelayHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:{}/api/".format(self.server.server_address[1])
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def card(self):
+        now = timezone.now().isoformat()
+        return {"id" : str(uuid.uuid4()), "user" : 1, "balance" : "1000000.00", "created" : now, "updated" : now}
+
+    def transaction(self):
+        now = timezone.now().isoformat()
+        return {
+            "id" : str(uuid.uuid4()),
+            "card" : random.choice(self.card_ids),
+            "amount" : "{:.2f}".format(random.uniform(1, 100)),
+            "merchant" : settings.CONTROL_DEFINITION["MER_NAME"]["input_validation"]["choices"][0],
+            "merchant_category" : settings.CONTROL_DEFINITION["MER_CAT"]["input_validation"]["choices"][0],
+            "created" : now,
+            "updated" : now
+        }
+
+# Responses are written with several small writes (headers, then body). With Nagle's algorithm the body waits for the
+# delayed ACK of the headers (~40 ms on Linux), which hides the time spent in the app. Both servers disable it
+def accept_no_delay(server):
+    connection, address = server.socket.accept()
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection, address
+
+class NoDelayHTTPServer(ThreadingHTTPServer):
+    def get_request(self):
+        return accept_no_delay(self)
+
+class NoDelayWSGIServer(ThreadedWSGIServer):
+    def get_request(self):
+        return accept_no_delay(self)
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+# Times every request in the server, from the call of the app until its response is read
+class TimedApplication(object):
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        with stage_timer(SERVER_STAGE):
+            return list(self.application(environ, start_response))
+
+def start_server():
+    server = NoDelayWSGIServer(("127.0.0.1", 0), QuietWSGIRequestHandler)
+    server.set_app(TimedApplication(get_wsgi_application()))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# (control_name, control_value) pairs in the order they are created on a card
+# The mandatory MAX_AMT and MER_CAT come first, the first merchant name and category are the ones of the stub transactions
+def benchmark_control_values():
+    merchant_names = settings.CONTROL_DEFINITION["MER_NAME"]["input_validation"]["choices"]
+    merchant_categories = settings.CONTROL_DEFINITION["MER_CAT"]["input_validation"]["choices"]
+    values = [("MAX_AMT", "100"), ("MER_CAT", merchant_categories[0]), ("MER_NAME", merchant_names[0]), ("MIN_AMT", "0")]
+    for name, category in itertools.zip_longest(merchant_names[1:], merchant_categories[1:]):
+        if category is not None:
+            values.append(("MER_CAT", category))
+        if name is not None:
+            values.append(("MER_NAME", name))
+    return values
+
+def create_cards(user, card_count, control_values):
+    now = timezone.now()
+    cards = [Card(id=str(uuid.uuid4()), user=1, balance=10 ** 12, created=now, updated=now, creator=user) for _ in range(card_count)]
+    Card.objects.bulk_create(cards)
+    Control.objects.bulk_create([Control(card=card, control_name=name, control_value=value) for card in cards for name, value in control_values])
+    return [card.id for card in cards]
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def summarize(endpoint, latencies, errors, elapsed, server_metrics):
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    return {
+        "endpoint" : endpoint,
+        "requests" : len(latencies_ms),
+        "errors" : errors,
+        "throughput_rps" : round(len(latencies_ms) / elapsed, 2) if elapsed else None,
+        "mean_ms" : round(sum(latencies_ms) / len(latencies_ms), 3) if latencies_ms else None,
+        "p50_ms" : round(percentile(latencies_ms, 0.50), 3) if latencies_ms else None,
+        "p99_ms" : round(percentile(latencies_ms, 0.99), 3) if latencies_ms else None,
+        "max_ms" : round(latencies_ms[-1], 3) if latencies_ms else None,
+        "stages" : {stage : {key : timer[key] for key in ("count", "avg_ms", "max_ms", "p50_ms", "p99_ms")}
+                    for stage, timer in server_metrics["timers"].items()}
+    }
+
+def result_key(result):
+    return (result["endpoint"], result["cards"], result["controls_per_card"], result["concurrency"])
+
+# Client latency, then the average server side time of the request and of every stage of the app
+def format_result(result):
+    line = "{:<15} cards={:<6} controls={:<3} concurrency={:<4} {:>9} req/s  p50={:>8} ms  p99={:>8} ms  errors={}".format(
+        result["endpoint"], result["cards"], result["controls_per_card"], result["concurrency"],
+        result["throughput_rps"], result["p50_ms"], result["p99_ms"], result["errors"])
+    stages = result["stages"]
+    if stages:
+        server = stages.get(SERVER_STAGE)
+        timings = ["server avg={} ms".format(server["avg_ms"] if server else None)]
+        timings += ["{}={} ms".format(stage, timer["avg_ms"]) for stage, timer in sorted(stages.items()) if stage != SERVER_STAGE]
+        line += "\n{:<15} {}".format("", "  ".join(timings))
+    return line
+
+# Change of throughput and latency of every scenario present in both runs, e.g. p99 -12.5% is 12.5% faster
+def compare_results(baseline_results, results):
+    baseline = {result_key(result) : result for result in baseline_results}
+    lines = ["Compared to the baseline:"]
+    for result in results:
+        before = baseline.get(result_key(result))
+        if before is None:
+            continue
+        changes = []
+        for field in ("throughput_rps", "p50_ms", "p99_ms"):
+            if before[field] and result[field] is not None:
+                changes.append("{} {:+.1f}%".format(field, (result[field] - before[field]) * 100.0 / before[field]))
+        lines.append("{:<15} cards={:<6} controls={:<3} concurrency={:<4} {}".format(*result_key(result), "  ".join(changes)))
+    return lines
@@ -0,0 +1,29 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from card_control import export
+
+# Exports transactions as CSV or NDJSON, streaming them to a file or stdout
+#
+# python manage.py export_txns --from 2019-07-01 --to 2019-08-01 --format csv --output july.csv
+class Command(BaseCommand):
+    help = "Exports transactions as CSV or NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--card", help="card id")
+        parser.add_argument("--status", help="A (approved) or R (rejected)")
+        parser.add_argument("--from", dest="created_from", help="created at or after, ISO date or date time")
+        parser.add_argument("--to", dest="created_to", help="created before, ISO date or date time")
+        parser.add_argument("--format", dest="export_format", choices=export.FORMATS, default="csv")
+        parser.add_argument("--output", help="file to write to, stdout when not given")
+
+    def handle(self, *args, **options):
+        try:
+            filters = export.parse_filters(options["card"], options["status"], options["created_from"], options["created_to"])
+        except ValueError as e:
+            raise CommandError("Not a valid filter {}".format(e))
+        lines = export.export_lines(export.filter_txns(**filters), options["export_format"])
+        if options["output"]:
+            with open(options["output"], "w", newline="") as output_file:
+                output_file.writelines(lines)
+        else:
+            sys.stdout.writelines(lines)
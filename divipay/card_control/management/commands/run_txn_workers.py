@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from card_control import txn_queue
+
+# Runs the transaction workers processing the queued transactions, and optionally producers pulling transactions from Divipay
+# Transactions are queued by the queue API (api/v1/txn/queue) or the producers. Refer txn_queue.py
+#
+# python manage.py run_txn_workers --workers 8 --producers 2
+class Command(BaseCommand):
+    help = "Runs a pool of worker processes processing the queued transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=settings.QUEUE_WORKERS, help="number of worker processes")
+        parser.add_argument("--producers", type=int, default=0, help="number of processes pulling transactions from Divipay into the queue")
+        parser.add_argument("--batch-size", type=int, default=settings.QUEUE_BATCH_SIZE, help="transactions processed at a time by a worker")
+        parser.add_argument("--poll-interval", type=float, default=settings.QUEUE_POLL_INTERVAL, help="seconds between two polls of an empty queue")
+        parser.add_argument("--exit-when-empty", action="store_true", help="stop the workers once the queue is empty, producers are not allowed")
+
+    def handle(self, *args, **options):
+        workers = options["workers"]
+        if not 0 < workers <= settings.QUEUE_PARTITIONS:
+            raise CommandError("--workers must be between 1 and QUEUE_PARTITIONS ({})".format(settings.QUEUE_PARTITIONS))
+        if options["exit_when_empty"] and options["producers"]:
+            raise CommandError("--exit-when-empty can not be used with --producers")
+        self.stdout.write("Starting {} workers and {} producers".format(workers, options["producers"]))
+        txn_queue.run_pool(workers, options["producers"], options["batch_size"], options["poll_interval"], options["exit_when_empty"])
+        self.stdout.write("Transaction workers stopped")
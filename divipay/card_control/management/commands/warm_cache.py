@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from card_control.warmup import warm_cache
+
+# Preloads the cache with the cards and grouped controls of the most active cards
+# Useful with a shared cache (see CACHES in settings.py) right after a deploy or a cache flush,
+# a cache local to the process (LocMemCache) is warmed by CACHE_WARMUP_ON_STARTUP instead
+#
+# python manage.py warm_cache --cards 5000 --days 3
+class Command(BaseCommand):
+    help = "Preloads the cache with the cards and grouped controls of the most active cards"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cards", type=int, default=settings.CACHE_WARMUP_CARDS, help="maximum number of cards to warm")
+        parser.add_argument("--days", type=int, default=settings.CACHE_WARMUP_WINDOW_DAYS, help="cards are ranked by their transactions of the last days")
+        parser.add_argument("--seconds", type=float, default=settings.CACHE_WARMUP_SECONDS, help="time budget in seconds")
+
+    def handle(self, *args, **options):
+        warmed = warm_cache(options["cards"], options["days"], options["seconds"])
+        self.stdout.write("Cache warmed for {} cards".format(warmed))
@@ -10,12 +10,26 @@ class Messages(object):
         MULTIPLE_CHECK_FAILED = "Multiple values can not exist. Either update or delete"
         INVALID_NAME= "Not a valid control name"
         FAILED_TO_COMPLY = "Failed to comply with control "
+        BULK_APPLIED = "Controls have been applied"
+        INVALID_BULK = "Not a valid set of controls. Please refer to validation data"
+        MANDATORY_NOT_CONFIGURED = "Mandatory Control {} not configured"
         
     class Transaction(object):
         APPROVED = "Transaction has been successfully approved"
         INSUFFICIENT_BALANCE = "Insufficient balance to carry out this transaction"
         FETCH_FAILURE = "Unable to fetch transaction "
+        BATCH_PROCESSED = "Batch of transactions has been processed"
+        INVALID_BATCH = "Not a valid batch of transactions. Please refer to the transaction fields"
+        INVALID_EXPORT = "Not a valid export. Please refer to the export filters"
+        QUEUED = "Transactions have been queued"
+        QUEUE_ONLY = "Transactions of this card are only processed through the transaction queue"
         
+    class Metrics(object):
+        EXPORTED = "Metrics of this worker process"
+
     class Common(object):
         AUTHORIZATION_FAILURE = "Sorry, you are not authorized to perform this operation"
-        CONNECTION_ERROR = "Connection Error"
\ No newline at end of file
+        CONNECTION_ERROR = "Connection Error"
+        CIRCUIT_OPEN = "Service is currently unavailable. Please try again later"
+        TOO_MANY_CALLS = "Too many requests in progress. Please try again later"
+        INVALID_RESPONSE = "Not a valid JSON response"
\ No newline at end of file
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Card',
+            fields=[
+                ('id', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('user', models.IntegerField()),
+                ('balance', models.FloatField(default=0.0)),
+                ('created', models.DateTimeField()),
+                ('updated', models.DateTimeField()),
+                ('creator', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cards', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Transaction',
+            fields=[
+                ('card', models.CharField(max_length=40)),
+                ('id', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('amount', models.FloatField(default=0.0)),
+                ('merchant', models.CharField(max_length=40)),
+                ('merchant_category', models.CharField(max_length=10)),
+                ('status', models.CharField(choices=[('A', 'Approved'), ('R', 'Rejected')], max_length=1)),
+                ('reason', models.CharField(max_length=100, null=True)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Control',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('control_name', models.CharField(choices=[('MER_NAME', 'Merchant Name'), ('MER_CAT', 'Merchant Category'), ('MIN_AMT', 'Minimum Amount'), ('MAX_AMT', 'Maximum Amount'), ('COUNTRY', 'Country Name')], max_length=10)),
+                ('control_value', models.CharField(max_length=40)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('card', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='card_control.card')),
+            ],
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:51
+
+from decimal import Decimal, ROUND_HALF_UP
+from django.db import migrations, models
+
+MINOR_UNITS = 100
+
+
+def to_minor_units(amount):
+    return int((Decimal(repr(amount)) * MINOR_UNITS).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+# Balances and amounts are converted while the columns are floats (before altering them going forwards,
+# after altering them back going backwards)
+def forwards(apps, schema_editor):
+    Card = apps.get_model('card_control', 'Card')
+    Transaction = apps.get_model('card_control', 'Transaction')
+    for card in Card.objects.only('id', 'balance').iterator():
+        Card.objects.filter(id=card.id).update(balance=to_minor_units(card.balance))
+    for txn in Transaction.objects.only('id', 'amount').iterator():
+        Transaction.objects.filter(id=txn.id).update(amount=to_minor_units(txn.amount))
+
+
+def backwards(apps, schema_editor):
+    Card = apps.get_model('card_control', 'Card')
+    Transaction = apps.get_model('card_control', 'Transaction')
+    for card in Card.objects.only('id', 'balance').iterator():
+        Card.objects.filter(id=card.id).update(balance=card.balance / MINOR_UNITS)
+    for txn in Transaction.objects.only('id', 'amount').iterator():
+        Transaction.objects.filter(id=txn.id).update(amount=txn.amount / MINOR_UNITS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('card_control', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+        migrations.AlterField(
+            model_name='card',
+            name='balance',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='amount',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Builds the index without locking the table against writes on PostgreSQL, a plain AddIndex elsewhere
+class AddIndexConcurrently(migrations.AddIndex):
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+
+
+# Duplicates of single valued controls made every transaction of the card fail, only the latest one is kept
+def delete_duplicate_controls(apps, schema_editor):
+    Control = apps.get_model('card_control', 'Control')
+    duplicates = (Control.objects.filter(control_name__in=['MAX_AMT', 'MIN_AMT'])
+                  .values('card_id', 'control_name')
+                  .annotate(latest_id=models.Max('id'), count=models.Count('id'))
+                  .filter(count__gt=1))
+    for duplicate in duplicates:
+        (Control.objects.filter(card_id=duplicate['card_id'], control_name=duplicate['control_name'])
+         .exclude(id=duplicate['latest_id'])
+         .delete())
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('card_control', '0002_money_minor_units'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='transaction',
+            index=models.Index(fields=['card', 'created_at'], name='txn_card_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='control',
+            index=models.Index(fields=['card', 'control_name'], name='control_card_name_idx'),
+        ),
+        # covered by control_card_name_idx
+        migrations.AlterField(
+            model_name='control',
+            name='card',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='card_control.card'),
+        ),
+        migrations.RunPython(delete_duplicate_controls, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='control',
+            constraint=models.UniqueConstraint(condition=models.Q(('control_name__in', ['MAX_AMT', 'MIN_AMT'])), fields=('card', 'control_name'), name='control_single_value'),
+        ),
+    ]
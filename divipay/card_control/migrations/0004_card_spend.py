@@ -0,0 +1,67 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:07
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+
+# Spend of the current day and month from the approved transactions, so velocity controls count what was spent before the upgrade
+def backfill_card_spend(apps, schema_editor):
+    Card = apps.get_model('card_control', 'Card')
+    CardSpend = apps.get_model('card_control', 'CardSpend')
+    Transaction = apps.get_model('card_control', 'Transaction')
+    today = timezone.localdate()
+    for window, window_start in (('DAY', today), ('MONTH', today.replace(day=1))):
+        since = datetime.datetime.combine(window_start, datetime.time.min)
+        if settings.USE_TZ:
+            since = timezone.make_aware(since)
+        spend = (Transaction.objects.filter(status='A', created_at__gte=since, card__in=Card.objects.values('id'))
+                 .values_list('card')
+                 .annotate(amount=models.Sum('amount'), count=models.Count('id')))
+        CardSpend.objects.bulk_create([CardSpend(card_id=card_id, window=window, window_start=window_start, amount=amount, count=count)
+                                       for card_id, amount, count in spend], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('card_control', '0003_control_txn_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CardSpend',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('window', models.CharField(choices=[('DAY', 'Day'), ('MONTH', 'Month')], max_length=5)),
+                ('window_start', models.DateField()),
+                ('amount', models.BigIntegerField(default=0)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RemoveConstraint(
+            model_name='control',
+            name='control_single_value',
+        ),
+        migrations.AlterField(
+            model_name='control',
+            name='control_name',
+            field=models.CharField(choices=[('MER_NAME', 'Merchant Name'), ('MER_CAT', 'Merchant Category'), ('MIN_AMT', 'Minimum Amount'), ('MAX_AMT', 'Maximum Amount'), ('COUNTRY', 'Country Name'), ('DAY_AMT', 'Daily Spend'), ('MONTH_AMT', 'Monthly Spend'), ('DAY_TXNS', 'Daily Transactions'), ('MONTH_TXNS', 'Monthly Transactions')], max_length=10),
+        ),
+        migrations.AddConstraint(
+            model_name='control',
+            constraint=models.UniqueConstraint(condition=models.Q(('control_name__in', ['DAY_AMT', 'DAY_TXNS', 'MAX_AMT', 'MIN_AMT', 'MONTH_AMT', 'MONTH_TXNS'])), fields=('card', 'control_name'), name='control_single_value'),
+        ),
+        migrations.AddField(
+            model_name='cardspend',
+            name='card',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='card_control.card'),
+        ),
+        migrations.AddConstraint(
+            model_name='cardspend',
+            constraint=models.UniqueConstraint(fields=('card', 'window', 'window_start'), name='card_spend_window'),
+        ),
+        migrations.RunPython(backfill_card_spend, migrations.RunPython.noop),
+    ]
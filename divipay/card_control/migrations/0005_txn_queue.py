@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('card_control', '0004_card_spend'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedTxn',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('partition', models.SmallIntegerField()),
+                ('txn_id', models.CharField(max_length=40)),
+                ('card', models.CharField(max_length=40)),
+                ('payload', models.JSONField()),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(null=True)),
+                ('queued_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='queuedtxn',
+            index=models.Index(fields=['partition', 'id'], name='queued_txn_partition_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('card_control', '0005_txn_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerCheckpoint',
+            fields=[
+                ('partition', models.SmallIntegerField(primary_key=True, serialize=False)),
+                ('sequence', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
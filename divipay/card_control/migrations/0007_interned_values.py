@@ -0,0 +1,111 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+VARIABLES = ('merchant', 'merchant_category')
+
+
+# Interns the distinct merchant names and categories of the transactions and points the transactions at them,
+# then the values of the String controls on them, which are only looked up once cached controls are rebuilt
+# Values differing only by case share the id of the spelling seen first
+def intern_txn_values(apps, schema_editor):
+    InternedValue = apps.get_model('card_control', 'InternedValue')
+    Transaction = apps.get_model('card_control', 'Transaction')
+    Control = apps.get_model('card_control', 'Control')
+    for variable_name in VARIABLES:
+        ids = dict()
+        for value in Transaction.objects.order_by().values_list(variable_name, flat=True).distinct().iterator():
+            key = value.upper()
+            if key not in ids:
+                ids[key] = InternedValue.objects.create(variable_name=variable_name, key=key, value=value).id
+            Transaction.objects.filter(**{variable_name : value}).update(**{variable_name + '_ref' : ids[key]})
+        control_names = [control_name for control_name, control_def in settings.CONTROL_DEFINITION.items()
+                         if control_def['type'] == 'String' and control_def['src_comparison']['variable_name'] == variable_name]
+        for value in Control.objects.filter(control_name__in=control_names).order_by().values_list('control_value', flat=True).distinct().iterator():
+            key = value.upper()
+            if key not in ids:
+                ids[key] = InternedValue.objects.create(variable_name=variable_name, key=key, value=value).id
+
+
+def restore_txn_values(apps, schema_editor):
+    InternedValue = apps.get_model('card_control', 'InternedValue')
+    Transaction = apps.get_model('card_control', 'Transaction')
+    for variable_name in VARIABLES:
+        for interned_id, value in InternedValue.objects.filter(variable_name=variable_name).values_list('id', 'value').iterator():
+            Transaction.objects.filter(**{variable_name + '_ref' : interned_id}).update(**{variable_name : value})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('card_control', '0006_ledger_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InternedValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('variable_name', models.CharField(max_length=40)),
+                ('key', models.CharField(max_length=40)),
+                ('value', models.CharField(max_length=40)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='internedvalue',
+            constraint=models.UniqueConstraint(fields=('variable_name', 'key'), name='interned_value_key'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='merchant_ref',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='card_control.internedvalue'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='merchant_category_ref',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='card_control.internedvalue'),
+        ),
+        # so the columns can be added back empty and restored when the migration is reverted
+        migrations.AlterField(
+            model_name='transaction',
+            name='merchant',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='merchant_category',
+            field=models.CharField(max_length=10, null=True),
+        ),
+        migrations.RunPython(intern_txn_values, restore_txn_values),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='merchant',
+        ),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='merchant_category',
+        ),
+        migrations.RenameField(
+            model_name='transaction',
+            old_name='merchant_ref',
+            new_name='merchant',
+        ),
+        migrations.RenameField(
+            model_name='transaction',
+            old_name='merchant_category_ref',
+            new_name='merchant_category',
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='merchant',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='card_control.internedvalue'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='merchant_category',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='card_control.internedvalue'),
+        ),
+    ]
@@ -1,60 +1,438 @@
-from django.db import models
+import logging
+import uuid
+from django.db import models, transaction
+from django.db.models import F, Q
 from django.conf import settings
 from django.core.cache import cache
+from .processor_control import SpendWindow, StringControlProcessor, compile_controls, get_registry, group_controls
+
+logger = logging.getLogger(__name__)
 
 class Card(models.Model):
     id = models.CharField(max_length=40, primary_key=True)
     user = models.IntegerField()
-    balance = models.FloatField(default=0.0)
+    # in minor units (cents). Refer utility.to_minor_units
+    balance = models.BigIntegerField(default=0)
     created = models.DateTimeField()
     updated = models.DateTimeField()
     creator = models.ForeignKey('auth.User', related_name='cards', on_delete=models.CASCADE)
     
     CACHE_KEY_PREFIX = "card_"
+    # bumped whenever the shape of the cached card (CardRecord.FIELDS) changes, so old entries are ignored
+    CACHE_VERSION = 2
 
     # overridden to cache card details
     def save(self, *args, **kwargs):
         models.Model.save(self, *args, **kwargs)
-        cache.set(Card.CACHE_KEY_PREFIX + self.id, self)
+        Card.set_cache(CardRecord.from_card(self))
+
+    # function to return card record from cache if exists otherwise from DB
+    # Only the fields of CardRecord are loaded, no model instance is created
+    def get_record(card_id):
+        cache_result = cache.get(Card.CACHE_KEY_PREFIX + card_id, version=Card.CACHE_VERSION)
+        if cache_result is None:
+            card_record = CardRecord(*Card.objects.values_list(*CardRecord.FIELDS).get(id=card_id))
+            Card.set_cache(card_record)
+            return card_record
+        return CardRecord(*cache_result)
 
     # function to return card from cache if exists otherwise from DB
+    # The model is hydrated from the card record, fields which are not part of the record are loaded on access
     def get(card_id):
-        cache_result = cache.get(Card.CACHE_KEY_PREFIX + card_id)
-        if cache_result is None:
-            cache_result = Card.objects.get(id=card_id)
-            cache.set(Card.CACHE_KEY_PREFIX + card_id, cache_result)
-        return cache_result
+        return Card.get_record(card_id).to_card()
+    
+    # Debits the balance with a single conditional statement
+    # update card set balance = balance - amount where id = card_id and balance >= amount
+    # Returns False if the balance is not sufficient, raises Card.DoesNotExist if the card does not exist
+    # Meant to be called inside transaction.atomic(), the cached balance is only updated once it commits
+    def debit(card_id, amount):
+        if Card.objects.filter(id=card_id, balance__gte=amount).update(balance=F('balance') - amount) == 0:
+            if not Card.objects.filter(id=card_id).exists():
+                raise Card.DoesNotExist
+            return False
+        balance = Card.objects.values_list('balance', flat=True).get(id=card_id)
+        transaction.on_commit(lambda: Card.update_cached_balance(card_id, balance))
+        return True
+    
+    # Updates the balance of the cached card record, if the card is cached
+    def update_cached_balance(card_id, balance):
+        cache_result = cache.get(Card.CACHE_KEY_PREFIX + card_id, version=Card.CACHE_VERSION)
+        if cache_result is not None:
+            card_record = CardRecord(*cache_result)
+            card_record.balance = balance
+            Card.set_cache(card_record)
+    
+    def set_cache(card_record):
+        cache.set(Card.CACHE_KEY_PREFIX + card_record.id, card_record.as_tuple(), version=Card.CACHE_VERSION)
+    
+    # Loads the records of the cards from the database with a single query and caches them
+    def set_cache_many(card_ids):
+        card_records = Card.objects.filter(id__in=card_ids).values_list(*CardRecord.FIELDS)
+        cache.set_many({Card.CACHE_KEY_PREFIX + card_record[0] : card_record for card_record in card_records}, version=Card.CACHE_VERSION)
     
     def delete_cache(card_id):
-        cache.delete(Card.CACHE_KEY_PREFIX + card_id)
+        cache.delete(Card.CACHE_KEY_PREFIX + card_id, version=Card.CACHE_VERSION)
 
     def __str__(self):
             return '{0} {1} {2}'.format(self.id, self.user_id, self.balance)
         
+    get_record = staticmethod(get_record)
     get = staticmethod(get)
+    debit = staticmethod(debit)
+    update_cached_balance = staticmethod(update_cached_balance)
+    set_cache = staticmethod(set_cache)
+    set_cache_many = staticmethod(set_cache_many)
     delete_cache = staticmethod(delete_cache)
 
+# Compact representation of a card, cached as a plain tuple instead of the pickled model instance
+class CardRecord(object):
+    # in the order of the model fields, as expected by Card.from_db
+    FIELDS = ("id", "user", "balance", "updated", "creator_id")
+    __slots__ = FIELDS
+    
+    def __init__(self, id, user, balance, updated, creator_id):
+        self.id = id
+        self.user = user
+        self.balance = balance
+        self.updated = updated
+        self.creator_id = creator_id
+    
+    def from_card(card):
+        return CardRecord(card.id, card.user, card.balance, card.updated, card.creator_id)
+    
+    def as_tuple(self):
+        return (self.id, self.user, self.balance, self.updated, self.creator_id)
+    
+    # Hydrates a Card model from the record without hitting the database
+    # created is deferred and loaded from the database on access
+    def to_card(self):
+        return Card.from_db(None, CardRecord.FIELDS, self.as_tuple())
+    
+    from_card = staticmethod(from_card)
+
+# Controls which can have only one value per card, enforced by the control_single_value constraint
+SINGLE_VALUED_CONTROLS = sorted(name for name, control_def in settings.CONTROL_DEFINITION.items()
+                                if not control_def.get("input_validation", {}).get("can_multiple_exists", False))
+
 class Control(models.Model):
-    card = models.ForeignKey(Card, on_delete=models.CASCADE)
+    # indexed by control_card_name_idx, which starts with card
+    card = models.ForeignKey(Card, on_delete=models.CASCADE, db_index=False)
     control_name = models.CharField(max_length=10, choices = settings.CONTROL_MODEL_NAME_CHOICES)
     control_value = models.CharField(max_length=40)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     CACHE_KEY_PREFIX = "group_control_"
+    PLAN_CACHE_KEY_PREFIX = "control_plan_"
+    VERSION_CACHE_KEY_PREFIX = "control_version_"
+    LOCK_CACHE_KEY_PREFIX = "control_lock_"
+    # cards whose controls are loaded with a single query
+    LOAD_BATCH_SIZE = 500
+    # bumped whenever the shape of cached grouped controls / plans / versions changes, so old entries are ignored
+    CACHE_VERSION = 5
     
-    # overridden to delete cache for grouped controls
+    # overridden to intern the value (see intern_values) and rebuild cache for grouped controls
     def save(self, *args, **kwargs):
+        Control.intern_values([(self.control_name, self.control_value)])
         models.Model.save(self, *args, **kwargs)
-        cache.delete(Control.CACHE_KEY_PREFIX + self.card.id)
+        Control.refresh_cache(self.card_id)
     
-    # overridden to delete cache for grouped controls    
+    # overridden to rebuild cache for grouped controls    
     def delete(self):
-        cache.delete(Control.CACHE_KEY_PREFIX + self.card.id)
-        return models.Model.delete(self)
+        card_id = self.card_id
+        result = models.Model.delete(self)
+        Control.refresh_cache(card_id)
+        return result
+    
+    def refresh_cache(card_id):
+        Control.refresh_cache_many([card_id])
+    
+    # Write through: once the change is committed, the grouped controls and the control plans of the cards are
+    # rebuilt from the database and replace the cached ones, so transactions never find them missing after a change.
+    # The version of the cards' controls is bumped before they are loaded, refer set_cache_many
+    def refresh_cache_many(card_ids):
+        card_ids = list(card_ids)
+        transaction.on_commit(lambda: Control.rebuild_cache(card_ids))
+    
+    def rebuild_cache(card_ids):
+        Control.bump_versions(card_ids)
+        try:
+            Control.set_cache_many(card_ids)
+        except Exception:
+            # the change is already committed, fall back to clearing the cache so it is reloaded on the next transaction
+            logger.exception("Cached controls could not be rebuilt, clearing them")
+            Control.delete_cache_many(card_ids)
+    
+    # Loads the grouped controls of the cards from the database and caches them with their compiled control plans
+    # Only written for the cards whose version is still the one read before loading them. The version of a card moves on
+    # when a change of its controls is committed, and the rebuild of that change caches the controls loaded after it.
+    # A change committed while the controls are written may be overwritten with the ones loaded before it,
+    # so the cards whose version has moved on meanwhile are cleared and reloaded on their next transaction
+    def set_cache_many(card_ids):
+        versions = Control.get_cached_versions(card_ids)
+        grouped_controls_by_card = Control.load_grouped_controls(card_ids)
+        current_versions = Control.get_cached_versions(card_ids)
+        card_ids = [card_id for card_id in card_ids if current_versions.get(card_id) == versions.get(card_id)]
+        cache_entries = dict()
+        for card_id in card_ids:
+            grouped_controls = grouped_controls_by_card[card_id]
+            cache_entries[Control.CACHE_KEY_PREFIX + card_id] = grouped_controls
+            cache_entries[Control.PLAN_CACHE_KEY_PREFIX + card_id] = compile_controls(grouped_controls)
+        cache.set_many(cache_entries, version=Control.CACHE_VERSION)
+        current_versions = Control.get_cached_versions(card_ids)
+        changed_card_ids = [card_id for card_id in card_ids if current_versions.get(card_id) != versions.get(card_id)]
+        if changed_card_ids:
+            logger.info("Controls of %d cards changed while they were cached, clearing them", len(changed_card_ids))
+            Control.delete_cache_many(changed_card_ids)
+    
+    # grouped controls and the control plan compiled from them are always cleared together
+    def delete_cache_many(card_ids):
+        cache.delete_many([prefix + card_id for card_id in card_ids for prefix in (Control.CACHE_KEY_PREFIX, Control.PLAN_CACHE_KEY_PREFIX)], version=Control.CACHE_VERSION)
+    
+    # Interns the values of the String controls on merchant names and categories, with bulk queries for the values not known yet
+    # Called when controls are stored, in their database transaction, so loading the controls of a card only looks the ids up
+    def intern_values(control_rows):
+        values = dict()
+        processors = get_registry().processors
+        for control_name, control_value in control_rows:
+            processor = processors.get(control_name)
+            if isinstance(processor, StringControlProcessor) and processor.variable_name in INTERNED_VARIABLES:
+                values.setdefault(processor.variable_name, []).append(control_value)
+        for variable_name, variable_values in values.items():
+            InternedValue.intern_many(variable_name, variable_values)
+    
+    # Query = select card_id, control_name, control_value from control where card_id in (...)
+    # Returns the grouped controls of every card (see processor_control.group_controls), empty for cards without controls
+    def load_grouped_controls(card_ids):
+        control_rows = {card_id : [] for card_id in card_ids}
+        for start in range(0, len(card_ids), Control.LOAD_BATCH_SIZE):
+            rows = Control.objects.filter(card_id__in=card_ids[start:start + Control.LOAD_BATCH_SIZE]).values_list('card_id', 'control_name', 'control_value')
+            for card_id, control_name, control_value in rows:
+                control_rows[card_id].append((control_name, control_value))
+        return {card_id : group_controls(rows) for card_id, rows in control_rows.items()}
+    
+    # Version of the controls of a card, used as the ETag of the control list for conditional GETs
+    # A version lost from the cache is replaced with a new one, so clients only fetch the list again
+    def get_version(card_id):
+        key = Control.VERSION_CACHE_KEY_PREFIX + card_id
+        version = cache.get(key, version=Control.CACHE_VERSION)
+        if version is None:
+            version = Control.new_version()
+            if not cache.add(key, version, timeout=None, version=Control.CACHE_VERSION):
+                version = cache.get(key, default=version, version=Control.CACHE_VERSION)
+        return version
+    
+    # Returns {card_id : version} for the cards whose version is cached
+    def get_cached_versions(card_ids):
+        cached = cache.get_many([Control.VERSION_CACHE_KEY_PREFIX + card_id for card_id in card_ids], version=Control.CACHE_VERSION)
+        return {card_id : cached[Control.VERSION_CACHE_KEY_PREFIX + card_id] for card_id in card_ids
+                if Control.VERSION_CACHE_KEY_PREFIX + card_id in cached}
+    
+    def bump_versions(card_ids):
+        cache.set_many({Control.VERSION_CACHE_KEY_PREFIX + card_id : Control.new_version() for card_id in card_ids}, timeout=None, version=Control.CACHE_VERSION)
+    
+    def new_version():
+        return uuid.uuid4().hex
     
     def __str__(self):
         return '{0} {1}'.format(self.control_name, self.control_value)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=["card", "control_name"], name="control_card_name_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["card", "control_name"], condition=models.Q(control_name__in=SINGLE_VALUED_CONTROLS), name="control_single_value"),
+        ]
+    
+    refresh_cache = staticmethod(refresh_cache)
+    refresh_cache_many = staticmethod(refresh_cache_many)
+    rebuild_cache = staticmethod(rebuild_cache)
+    set_cache_many = staticmethod(set_cache_many)
+    delete_cache_many = staticmethod(delete_cache_many)
+    intern_values = staticmethod(intern_values)
+    load_grouped_controls = staticmethod(load_grouped_controls)
+    get_version = staticmethod(get_version)
+    get_cached_versions = staticmethod(get_cached_versions)
+    bump_versions = staticmethod(bump_versions)
+    new_version = staticmethod(new_version)
+        
+SPEND_WINDOW_CHOICES = [
+        (SpendWindow.DAY.name, 'Day'),
+        (SpendWindow.MONTH.name, 'Month')
+]
+
+# Spend of a card in a window (a calendar day / month in TIME_ZONE), used by velocity controls
+# Updated incrementally in the database transaction debiting the card, so evaluating velocity controls reads
+# a row per window instead of the transactions of the card
+class CardSpend(models.Model):
+    # indexed by card_spend_window, which starts with card
+    card = models.ForeignKey(Card, on_delete=models.CASCADE, db_index=False)
+    window = models.CharField(max_length=5, choices=SPEND_WINDOW_CHOICES)
+    window_start = models.DateField()
+    # in minor units (cents). Refer utility.to_minor_units
+    amount = models.BigIntegerField(default=0)
+    count = models.IntegerField(default=0)
+    
+    # First day of every window the given day falls in
+    def window_starts(day):
+        return {
+            SpendWindow.DAY.name : day,
+            SpendWindow.MONTH.name : day.replace(day=1)
+        }
+    
+    # Spend of the card in the windows of the given day as {window name : (amount, count)}, windows without spend are left out
+    # Query = select window, amount, count from card_spend where card_id = ? and ((window = 'DAY' and window_start = ?) or ...)
+    def get_spend(card_id, day):
+        windows = Q()
+        for window, window_start in CardSpend.window_starts(day).items():
+            windows |= Q(window=window, window_start=window_start)
+        rows = CardSpend.objects.filter(windows, card_id=card_id).values_list('window', 'amount', 'count')
+        return {window : (amount, count) for window, amount, count in rows}
+    
+    # Adds the amount and count of approved transactions to the windows of the given day
+    # Meant to be called in the database transaction debiting the card. The debit locks the card row,
+    # so two transactions of the card never create the row of the same window
+    def record(card_id, amount, count, day):
+        for window, window_start in CardSpend.window_starts(day).items():
+            updated = (CardSpend.objects.filter(card_id=card_id, window=window, window_start=window_start)
+                       .update(amount=F('amount') + amount, count=F('count') + count))
+            if updated == 0:
+                CardSpend.objects.create(card_id=card_id, window=window, window_start=window_start, amount=amount, count=count)
+    
+    def __str__(self):
+        return '{0} {1} {2} {3} {4}'.format(self.card_id, self.window, self.window_start, self.amount, self.count)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["card", "window", "window_start"], name="card_spend_window"),
+        ]
+    
+    window_starts = staticmethod(window_starts)
+    get_spend = staticmethod(get_spend)
+    record = staticmethod(record)
+
+
+# Variables of transactions whose values are interned, String controls on them hold sets of ids
+INTERNED_VARIABLES = ("merchant", "merchant_category")
+
+# ids of the interned values known to this process as {(variable_name, key) : id}
+# An id never changes once assigned, so entries are never invalidated
+INTERNED_IDS = dict()
+
+# (variable_name, key) of the values InternedValue.get_id has not found, so they are not looked up again
+# A key is removed once its id is loaded, e.g. when the value is interned. Refer InternedValue.get_id
+INTERNED_MISSES = set()
+
+# Dictionary of the merchant names and categories of transactions and String controls, an integer id per distinct value
+# Values are interned case insensitively by their upper cased key (String controls compare upper cased values),
+# value keeps the spelling the value was first interned with
+# Transactions reference the ids instead of repeating the strings, and grouped String controls hold sets of ids,
+# so matching a transaction against them is an integer set membership check
+class InternedValue(models.Model):
+    variable_name = models.CharField(max_length=40)
+    key = models.CharField(max_length=40)
+    value = models.CharField(max_length=40)
+    
+    # values whose ids are loaded with a single query
+    LOAD_BATCH_SIZE = 500
+    # values not found remembered by the process, all of them are forgotten once there are more
+    MISSES_MAX_SIZE = 10000
+    # id of the control values which are not interned, no interned value has it so it matches no transaction
+    UNKNOWN_ID = 0
+    
+    def to_key(value):
+        return str(value).upper()
+    
+    # Returns the id of the value, interning it if needed
+    def intern(variable_name, value):
+        key = InternedValue.to_key(value)
+        interned_id = INTERNED_IDS.get((variable_name, key))
+        if interned_id is None:
+            interned_id = InternedValue.intern_many(variable_name, [value])[key]
+        return interned_id
+    
+    # Interns the values with bulk queries and returns {key : id}
+    # Meant to be called outside of the database transactions processing transactions, so the ids are committed before they are used
+    def intern_many(variable_name, values):
+        first_values = dict()
+        for value in values:
+            first_values.setdefault(InternedValue.to_key(value), str(value))
+        ids = {key : INTERNED_IDS[(variable_name, key)] for key in first_values if (variable_name, key) in INTERNED_IDS}
+        missing = [key for key in first_values if key not in ids]
+        if missing:
+            ids.update(InternedValue.load_ids(variable_name, missing))
+            new_keys = [key for key in missing if key not in ids]
+            if new_keys:
+                # values interned by another process in the meantime are left as they are
+                InternedValue.objects.bulk_create([InternedValue(variable_name=variable_name, key=key, value=first_values[key]) for key in new_keys],
+                                                  ignore_conflicts=True)
+                ids.update(InternedValue.load_ids(variable_name, new_keys))
+        return ids
+    
+    # Returns the id of the value, None if it is not interned
+    # Values not found are remembered, until this process interns them. The transactions are interned before their controls are
+    # evaluated (refer processor_txn.intern_txns), so a value interned by another process is looked up again before it is used
+    def get_id(variable_name, value):
+        key = InternedValue.to_key(value)
+        interned_id = INTERNED_IDS.get((variable_name, key))
+        if interned_id is None and (variable_name, key) not in INTERNED_MISSES:
+            interned_id = InternedValue.load_ids(variable_name, [key]).get(key)
+            if interned_id is None:
+                if len(INTERNED_MISSES) >= InternedValue.MISSES_MAX_SIZE:
+                    INTERNED_MISSES.clear()
+                INTERNED_MISSES.add((variable_name, key))
+        return interned_id
+    
+    # Returns {key : id} of the values which are interned, with bulk queries for the ones not known to the process
+    # Unlike get_id, values remembered as not found are looked up again. Used for the values of controls, which are interned
+    # when the controls are stored, possibly by another process
+    def get_ids(variable_name, values):
+        keys = {InternedValue.to_key(value) for value in values}
+        ids = {key : INTERNED_IDS[(variable_name, key)] for key in keys if (variable_name, key) in INTERNED_IDS}
+        missing = [key for key in keys if key not in ids]
+        if missing:
+            ids.update(InternedValue.load_ids(variable_name, missing))
+        return ids
+    
+    # Query = select key, id from interned_value where variable_name = ? and key in (...)
+    # The ids are remembered by the process once the database transaction commits, ids interned in a rolled back one are forgotten
+    def load_ids(variable_name, keys):
+        ids = dict()
+        for start in range(0, len(keys), InternedValue.LOAD_BATCH_SIZE):
+            ids.update(InternedValue.objects.filter(variable_name=variable_name, key__in=keys[start:start + InternedValue.LOAD_BATCH_SIZE])
+                       .values_list('key', 'id'))
+        if ids:
+            INTERNED_MISSES.difference_update((variable_name, key) for key in ids)
+            transaction.on_commit(lambda: INTERNED_IDS.update({(variable_name, key) : interned_id for key, interned_id in ids.items()}))
+        return ids
+    
+    def __str__(self):
+        return '{0} {1} {2}'.format(self.id, self.variable_name, self.value)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["variable_name", "key"], name="interned_value_key"),
+        ]
+    
+    to_key = staticmethod(to_key)
+    intern = staticmethod(intern)
+    intern_many = staticmethod(intern_many)
+    get_id = staticmethod(get_id)
+    get_ids = staticmethod(get_ids)
+    load_ids = staticmethod(load_ids)
+
+# coerce of compiled String controls on interned variables (see processor_control.StringControlProcessor)
+# Returns the id of the incoming value, None if it was never interned and so can not be one of the control values
+# A class instead of a closure so compiled control plans can be cached
+class InternedLookup(object):
+    __slots__ = ("variable_name", )
+    
+    def __init__(self, variable_name):
+        self.variable_name = variable_name
+    
+    def __call__(self, value):
+        return InternedValue.get_id(self.variable_name, value)
         
 TXN_STATUS_CHOICES = [
         ('A', 'Approved'),
@@ -64,10 +442,94 @@ TXN_STATUS_CHOICES = [
 class Transaction(models.Model):
     card = models.CharField(max_length=40)
     id = models.CharField(max_length=40, primary_key=True)
-    amount = models.FloatField(default=0.0)
-    merchant = models.CharField(max_length=40)
-    merchant_category = models.CharField(max_length=10)
+    # in minor units (cents). Refer utility.to_minor_units
+    amount = models.BigIntegerField(default=0)
+    # interned, refer InternedValue
+    merchant = models.ForeignKey(InternedValue, on_delete=models.PROTECT, related_name='+', db_index=False)
+    merchant_category = models.ForeignKey(InternedValue, on_delete=models.PROTECT, related_name='+', db_index=False)
     status = models.CharField(max_length=1, choices=TXN_STATUS_CHOICES)
     reason = models.CharField(max_length = 100, null=True)
     created_at = models.DateTimeField()
-    updated_at = models.DateTimeField()
\ No newline at end of file
+    updated_at = models.DateTimeField()
+    
+    # Decisions are cached by transaction id so retried deliveries are answered without touching the card
+    # A decision never changes once stored, the cache entry only expires after TXN_DEDUPE_CACHE_TIMEOUT seconds
+    DECISION_CACHE_KEY_PREFIX = "txn_decision_"
+    DECISION_CACHE_VERSION = 1
+    
+    # Inserts the transaction, raises IntegrityError if a transaction with the same id is already stored
+    # Meant to be called in the database transaction debiting the card, so the debit is rolled back for a duplicate
+    # The decision is cached once the insert commits
+    def record(txn):
+        txn.save(force_insert=True)
+        decision = (txn.status, txn.reason)
+        transaction.on_commit(lambda: Transaction.cache_decisions({txn.id : decision}))
+    
+    # Returns the stored (status, reason) of the transaction from cache if exists otherwise from DB, None for a new transaction
+    def get_decision(txn_id):
+        return Transaction.get_decisions([txn_id]).get(txn_id)
+    
+    # Returns {txn id : (status, reason)} for the transactions already stored
+    # Query = select id, status, reason from transaction where id in (...), for the ids not cached, served by the primary key
+    def get_decisions(txn_ids):
+        cached = cache.get_many([Transaction.DECISION_CACHE_KEY_PREFIX + txn_id for txn_id in txn_ids], version=Transaction.DECISION_CACHE_VERSION)
+        decisions = {txn_id : cached[Transaction.DECISION_CACHE_KEY_PREFIX + txn_id] for txn_id in txn_ids
+                     if Transaction.DECISION_CACHE_KEY_PREFIX + txn_id in cached}
+        missing = [txn_id for txn_id in txn_ids if txn_id not in decisions]
+        if missing:
+            stored = Transaction.load_decisions(missing)
+            Transaction.cache_decisions(stored)
+            decisions.update(stored)
+        return decisions
+    
+    # Returns {txn id : (status, reason)} for the transactions stored in the database, bypassing the cache
+    def load_decisions(txn_ids):
+        rows = Transaction.objects.filter(id__in=txn_ids).values_list('id', 'status', 'reason')
+        return {txn_id : (txn_status, reason) for txn_id, txn_status, reason in rows}
+    
+    def cache_decisions(decisions):
+        if decisions:
+            cache.set_many({Transaction.DECISION_CACHE_KEY_PREFIX + txn_id : decision for txn_id, decision in decisions.items()},
+                           timeout=settings.TXN_DEDUPE_CACHE_TIMEOUT, version=Transaction.DECISION_CACHE_VERSION)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=["card", "created_at"], name="txn_card_created_idx"),
+        ]
+    
+    record = staticmethod(record)
+    get_decision = staticmethod(get_decision)
+    get_decisions = staticmethod(get_decisions)
+    load_decisions = staticmethod(load_decisions)
+    cache_decisions = staticmethod(cache_decisions)
+# Transaction waiting to be processed by the transaction workers. Refer txn_queue.py
+# Rows are deleted once processed, the ones failing QUEUE_MAX_ATTEMPTS times are kept with their last error
+class QueuedTxn(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    # of the card, refer txn_queue.partition_for
+    partition = models.SmallIntegerField()
+    txn_id = models.CharField(max_length=40)
+    card = models.CharField(max_length=40)
+    # transaction as received, amount in minor units (cents)
+    payload = models.JSONField()
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(null=True)
+    queued_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return '{0} {1} {2} {3}'.format(self.id, self.txn_id, self.card, self.attempts)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=["partition", "id"], name="queued_txn_partition_idx"),
+        ]
+
+# Last write ahead log entry of a partition applied to the database by the balance ledger. Refer ledger.py
+# Updated in the database transaction applying the entries, so entries are applied exactly once after a crash
+class LedgerCheckpoint(models.Model):
+    partition = models.SmallIntegerField(primary_key=True)
+    sequence = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return '{0} {1}'.format(self.partition, self.sequence)
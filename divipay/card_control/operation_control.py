@@ -1,4 +1,5 @@
 from enum import Enum
+import operator
 
 class ControlOperator(Enum):
     IN = 1
@@ -8,47 +9,16 @@ class ControlOperator(Enum):
     LT = 5
     GT = 6
         
-class ControlOperation(object):
-    def __init__(self, control_operator):
-            self.control_operator = control_operator
-    def factory(control_operator):
-        if control_operator == ControlOperator.IN:
-                return InControlOperator(control_operator)
-        if control_operator == ControlOperator.EQ:
-                return EqualControlOperator(control_operator)
-        if control_operator == ControlOperator.LTE:
-                return LessThanEqualControlOperator(control_operator)
-        if control_operator == ControlOperator.GTE:
-                return GreaterThanEqualControlOperator(control_operator)
-        if control_operator == ControlOperator.GT:
-                return GreaterThanControlOperator(control_operator)
-        if control_operator == ControlOperator.LT:
-                return LessThanEqualControlOperator(control_operator)
-        assert 0, "Bad Control Operation Creation: " + type
-    factory = staticmethod(factory)
-        
-class InControlOperator(ControlOperation):
-        def process(self, op1, op2):
-            return op1 in op2
-
-                    
-class EqualControlOperator(ControlOperation):
-        def process(self, op1, op2):
-            return op1 == op2
-        
-class LessThanEqualControlOperator(ControlOperation):
-        def process(self, op1, op2):
-            return op1 <= op2
-        
-class GreaterThanEqualControlOperator(ControlOperation):
-        def process(self, op1, op2):
-            return op1 >= op2
-        
-class LessThanControlOperator(ControlOperation):
-        def process(self, op1, op2):
-            return op1 < op2        
+# Plain callables for every operator, resolved once while compiling a control plan
+# op1 is the incoming transaction value, op2 is the value configured for the control
+def _in(op1, op2):
+    return op1 in op2
 
-class GreaterThanControlOperator(ControlOperation):
-        def process(self, op1, op2):
-            return op1 > op2
-                
\ No newline at end of file
+OPERATOR_FUNCTIONS = {
+        ControlOperator.IN : _in,
+        ControlOperator.EQ : operator.eq,
+        ControlOperator.LTE : operator.le,
+        ControlOperator.GTE : operator.ge,
+        ControlOperator.LT : operator.lt,
+        ControlOperator.GT : operator.gt
+}
@@ -0,0 +1,10 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+# Keyset pagination of controls, pages are read with "where id > last id of the previous page order by id"
+# so every page costs the same however deep the client pages
+class ControlCursorPagination(CursorPagination):
+    ordering = "id"
+    page_size = settings.CONTROL_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = settings.CONTROL_MAX_PAGE_SIZE
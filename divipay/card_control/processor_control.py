@@ -1,123 +1,337 @@
 from enum import Enum
+from collections import namedtuple
 from django.conf import settings
-from .operation_control import ControlOperation
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from .operation_control import OPERATOR_FUNCTIONS
 from .errors import ControlException, ControlExceptionPayload
 from .messages import Messages
+from .utility import to_minor_units
 from card_control.operation_control import ControlOperator
 
 class ControlType(Enum):
-    # Only two types supported for now
     String = 1
     Integer = 2
-    
-    
-def processControls(source_data, controls):
+    # Amounts, compared as integer minor units
+    Money = 3
+    # Spend (variable_name amount) or number of transactions (variable_name count) of the card in a window
+    Velocity = 4
+
+
+# Windows of the per card spend aggregates used by velocity controls. Refer models.CardSpend
+class SpendWindow(Enum):
+    DAY = 1
+    MONTH = 2
+
+
+# Groups (control_name, control_value) pairs of a card into a frozenset of normalized values per control name
+# e.g. {"MER_NAME" : frozenset({3, 7}), "MAX_AMT" : frozenset({10000})}
+# Nothing is written: merchant names and categories are interned when their controls are stored (refer models.Control.intern_values)
+# and their ids are only looked up here, with a query per control name for the values not known to the process
+def group_controls(control_rows):
+    processors = get_registry().processors
+    control_values = dict()
+    for control_name, control_value in control_rows:
+        control_values.setdefault(control_name, []).append(control_value)
+    return {control_name : frozenset(processors[control_name].normalize_many(values)) for control_name, values in control_values.items()}
+
+
+# Compiles the grouped controls of a card (see group_controls) into a ControlPlan
+# Control definitions are looked up, operators resolved and control values parsed once here,
+# so the plan can be cached per card and evaluated for every transaction without any setup
+def compile_controls(controls):
+    registry = get_registry()
     # Check whether mandatory controls are configured for this card are not
-    mandatory_check_result = check_mandatory_controls_presence(settings.MANDATORY_CONTROLS, controls)
-    if mandatory_check_result is not None:
-        raise ControlException("Mandatory Control {} not configured".format(mandatory_check_result), ControlExceptionPayload(mandatory_check_result))
-    
-    for control in controls:
-            control_def = settings.CONTROL_DEFINITION[control]
-            if ControlProcessor.factory(control_def).process(controls.get(control), source_data) is not True:
-                    exceptionPayload = ControlExceptionPayload(control)
-                    message = Messages.Control.FAILED_TO_COMPLY + control
-                    raise ControlException(message, exceptionPayload)
-    return True
-
-
-def check_mandatory_controls_presence(mandatory_controls_list, existing_controls_list):
-    # Mandatory controls are defined as [control_1, control_2, [control_3, control_4]]
-    # the controls mentioned as sub_list means either of the controls sub_list should be configured
-    # e.g. control_1 and control_2 should be configured
-    # It is ok if either of control_3 or control_4 is configured
-    for mandatory_control in mandatory_controls_list:
-        if isinstance(mandatory_control, str):
-            if mandatory_control not in existing_controls_list:
-                return mandatory_control
-        elif isinstance(mandatory_control, list):
-            result = False
-            for single_mandatory_control in mandatory_control:
-                if single_mandatory_control in existing_controls_list:
-                    result = True
-                    break
-            if result == False:
+    missing_mandatory = registry.missing_mandatory(controls)
+    compiled_rules = [registry.processors[control].compile(control, controls.get(control)) for control in controls]
+    rules = tuple(rule for rule in compiled_rules if isinstance(rule, CompiledRule))
+    velocity_rules = tuple(rule for rule in compiled_rules if isinstance(rule, VelocityRule))
+    return ControlPlan(rules, missing_mandatory, velocity_rules)
+
+
+# A single compiled control
+# coerce converts the incoming transaction value, operator is one of OPERATOR_FUNCTIONS
+# and value is the pre-parsed control value it is compared against
+CompiledRule = namedtuple("CompiledRule", ["control_name", "variable_name", "coerce", "operator", "value", "message"])
+
+# A single compiled velocity control
+# variable_name is the aggregate of the window compared against value, amount (minor units) or count
+VelocityRule = namedtuple("VelocityRule", ["control_name", "window", "variable_name", "operator", "value", "message"])
+
+
+# Immutable evaluation plan for the controls of a card
+# Velocity rules depend on the spend of the card and are evaluated separately, see evaluate_velocity
+class ControlPlan(object):
+    __slots__ = ("rules", "missing_mandatory", "velocity_rules")
+
+    def __init__(self, rules, missing_mandatory = None, velocity_rules = ()):
+        self.rules = rules
+        self.missing_mandatory = missing_mandatory
+        self.velocity_rules = velocity_rules
+
+    # Matches the source data against every rule and raises ControlException on the first failure
+    def evaluate(self, source_data):
+        if self.missing_mandatory is not None:
+            raise ControlException(Messages.Control.MANDATORY_NOT_CONFIGURED.format(self.missing_mandatory), ControlExceptionPayload(self.missing_mandatory))
+
+        for rule in self.rules:
+            try:
+                result = rule.operator(rule.coerce(source_data[rule.variable_name]), rule.value)
+            except (ValueError, TypeError):
+                result = False
+            if result is not True:
+                raise ControlException(rule.message, ControlExceptionPayload(rule.control_name))
+        return True
+
+    # Matches the spend of the card including this transaction against every velocity rule
+    # spend is the spend of the card in every window before this transaction as {window name : (amount, count)}
+    # It is read in the database transaction debiting the card, after the card row is locked. Refer processor_txn.py
+    def evaluate_velocity(self, source_data, spend):
+        for rule in self.velocity_rules:
+            window_amount, window_count = spend.get(rule.window, (0, 0))
+            if rule.variable_name == VelocityControlProcessor.AMOUNT:
+                projected = window_amount + source_data["amount"]
+            else:
+                projected = window_count + 1
+            if rule.operator(projected, rule.value) is not True:
+                raise ControlException(rule.message, ControlExceptionPayload(rule.control_name))
+        return True
+
+
+# Used in place of the operator when a control value can not be parsed, so the control always fails
+def _reject(op1, op2):
+    return False
+
+
+# Control processors and mandatory controls built once from CONTROL_DEFINITION and MANDATORY_CONTROLS (settings.py)
+# Built when the app is ready (refer apps.py), so a bad definition fails at start up instead of at the first request using it
+# Processors parse their definition once: String choices are kept as a set of upper cased values and Integer / Money bounds are parsed
+# Mandatory controls are defined as [control_1, control_2, [control_3, control_4]]
+# the controls mentioned as sub_list means either of the controls sub_list should be configured
+# Every control name has a bit and every entry of MANDATORY_CONTROLS a mask of the bits of its controls,
+# an entry is configured when the mask of the controls of the card has any of its bits set
+class ControlRegistry(object):
+    def __init__(self, control_definition, mandatory_controls):
+        self.processors = dict()
+        for control_name, control_def in control_definition.items():
+            try:
+                self.processors[control_name] = ControlProcessor.factory(control_def)
+            except (ImproperlyConfigured, KeyError, TypeError, ValueError) as e:
+                raise ImproperlyConfigured("Invalid definition of control {} in CONTROL_DEFINITION: {!r}".format(control_name, e))
+        self.bits = {control_name : 1 << index for index, control_name in enumerate(control_definition)}
+        # (mask, entry of MANDATORY_CONTROLS) in the order they are checked
+        self.mandatory = []
+        for mandatory_control in mandatory_controls:
+            control_names = [mandatory_control] if isinstance(mandatory_control, str) else mandatory_control
+            if not isinstance(control_names, list) or not control_names:
+                raise ImproperlyConfigured("Invalid entry {!r} in MANDATORY_CONTROLS".format(mandatory_control))
+            mask = 0
+            for control_name in control_names:
+                if control_name not in self.bits:
+                    raise ImproperlyConfigured("Mandatory control {} is not defined in CONTROL_DEFINITION".format(control_name))
+                mask |= self.bits[control_name]
+            self.mandatory.append((mask, mandatory_control))
+        # reasons of the transactions rejected because an entry of MANDATORY_CONTROLS is not configured, refer ControlPlan.evaluate
+        self.mandatory_messages = frozenset(Messages.Control.MANDATORY_NOT_CONFIGURED.format(mandatory_control) for mask, mandatory_control in self.mandatory)
+
+    # Mask of the configured control names, names which are not defined have no bit
+    def mask(self, control_names):
+        mask = 0
+        for control_name in control_names:
+            mask |= self.bits.get(control_name, 0)
+        return mask
+
+    # Returns the first entry of MANDATORY_CONTROLS not configured in the controls, None if they are all configured
+    def missing_mandatory(self, controls):
+        mask = self.mask(controls)
+        for mandatory_mask, mandatory_control in self.mandatory:
+            if not mask & mandatory_mask:
                 return mandatory_control
-    return None
+        return None
+
+
+registry = None
+
+def get_registry():
+    global registry
+    if registry is None:
+        registry = ControlRegistry(settings.CONTROL_DEFINITION, settings.MANDATORY_CONTROLS)
+    return registry
+
+# Processor of a control defined in CONTROL_DEFINITION
+def get_processor(control_name):
+    return get_registry().processors[control_name]
+
+# Rebuilds the registry when the control settings are overridden e.g. by override_settings
+@receiver(setting_changed)
+def reset_registry(setting, **kwargs):
+    global registry
+    if setting in ("CONTROL_DEFINITION", "MANDATORY_CONTROLS"):
+        registry = None
 
 
 # Factory Design pattern to instantiate the right control processor basis the type of control
 class ControlProcessor(object):
     def __init__(self, control_def):
         self.control_def = control_def
+        # Fails on a definition without a variable or with an unknown operator
+        self.variable_name = control_def["src_comparison"]["variable_name"]
+        self.operator = ControlOperator[control_def["src_comparison"]["operator"]]
+        self.input_validation = control_def.get("input_validation", {})
     def factory(control_def):
         if control_def["type"] == ControlType.String.name:
                 return StringControlProcessor(control_def)
         if control_def["type"] == ControlType.Integer.name:
                 return IntegerControlProcessor(control_def)
-        assert 0, "Bad Control Processor Creation: " + type
+        if control_def["type"] == ControlType.Money.name:
+                return MoneyControlProcessor(control_def)
+        if control_def["type"] == ControlType.Velocity.name:
+                return VelocityControlProcessor(control_def)
+        raise ImproperlyConfigured("Bad Control Processor Creation: unknown control type {!r}".format(control_def["type"]))
     factory = staticmethod(factory)
+
+    # Normalizes the values of a control, see normalize
+    def normalize_many(self, controlValues):
+        return [self.normalize(controlValue) for controlValue in controlValues]
+
+    # IN compares the incoming value against the whole set of control values,
+    # any other operator needs exactly one valid control value otherwise the rule always fails
+    def compiled_rule(self, control_name, coerce, values):
+        operator = self.operator
+        if operator == ControlOperator.IN:
+            operator_function, value = OPERATOR_FUNCTIONS[operator], values
+        elif len(values) == 1 and None not in values:
+            operator_function, value = OPERATOR_FUNCTIONS[operator], next(iter(values))
+        else:
+            operator_function, value = _reject, None
+        return CompiledRule(control_name, self.variable_name, coerce, operator_function, value,
+                            Messages.Control.FAILED_TO_COMPLY + control_name)
         
 
 class StringControlProcessor(ControlProcessor):
+    def __init__(self, control_def):
+        ControlProcessor.__init__(self, control_def)
+        # upper cased choices, None when any value is valid
+        if "choices" in self.input_validation:
+            self.choices = frozenset(str(choice).upper() for choice in self.input_validation["choices"])
+        else:
+            self.choices = None
     
-    # Processes the control and matches against the source data using the ControlOperation
-    # Control Operation processes the logical comparison between two variables
-    def process(self, controlValue, source_data):
-            print("Processing string control {}".format(self.control_def))
-            incomingValue = source_data[self.control_def["src_comparison"]["variable_name"]]
-            operator = ControlOperator[self.control_def["src_comparison"]["operator"]]
-            return ControlOperation.factory(operator).process(incomingValue.upper(), controlValue.upper())
+    # String control values are stored upper cased in the grouped controls
+    def normalize(self, controlValue):
+        return controlValue.upper()
+
+    # or as the ids of their interned values for merchant names and categories (refer models.InternedValue), looked up with a single query
+    # Values which are not interned (e.g. the overrides of a backtest) are InternedValue.UNKNOWN_ID, no transaction has been made with them
+    # models imports this module, so it is imported when the control is used
+    def normalize_many(self, controlValues):
+        from .models import INTERNED_VARIABLES, InternedValue
+        if self.variable_name not in INTERNED_VARIABLES:
+            return ControlProcessor.normalize_many(self, controlValues)
+        ids = InternedValue.get_ids(self.variable_name, controlValues)
+        return [ids.get(InternedValue.to_key(controlValue), InternedValue.UNKNOWN_ID) for controlValue in controlValues]
+
+    # Compiles the control into a rule comparing upper cased values, or the ids of the interned values
+    def compile(self, control_name, values):
+        from .models import INTERNED_VARIABLES, InternedLookup
+        if self.variable_name in INTERNED_VARIABLES:
+            return self.compiled_rule(control_name, InternedLookup(self.variable_name), values)
+        return self.compiled_rule(control_name, str.upper, values)
         
     # Validates the value of control against the configuration
+    # Checks if the input value is one of the values defined in the configuration
     def validate(self, value):
-        
-        if "input_validation" in self.control_def:
-            validation_obj = self.control_def["input_validation"]
-            if "choices" in validation_obj:                   
-                # Checks if the input value is one of the values defined in the configuration 
-                return value.upper() in [item.upper() for item in validation_obj["choices"]]
-            else:
-                return True
-        return True
+        return self.choices is None or value.upper() in self.choices
                 
                     
 class IntegerControlProcessor(ControlProcessor):
-    # Processes the control and matches against the source data using the ControlOperation
-    # Control Operation processes the logical comparison between two variables
-    def process(self, controlValue, source_data):
-            print("Processing integer control {}".format(self.control_def))
-            incomingValue = source_data[self.control_def["src_comparison"]["variable_name"]]
-            try:
-                    intIncomingValue = int(incomingValue)
-                    intControlValue = int(controlValue)
-                    operator = ControlOperator[self.control_def["src_comparison"]["operator"]]
-                    return ControlOperation.factory(operator).process(intIncomingValue, intControlValue)
-            except ValueError:
-                    return False
+    def __init__(self, control_def):
+        ControlProcessor.__init__(self, control_def)
+        # configured min_value and max_value parsed like the control values, None when not configured
+        self.min_value = self.parse_bound("min_value")
+        self.max_value = self.parse_bound("max_value")
+
+    def parse(self, value):
+        return int(value)
+
+    def parse_bound(self, name):
+        if name not in self.input_validation:
+            return None
+        try:
+            return self.parse(self.input_validation[name])
+        except (ValueError, TypeError):
+            raise ValueError("{} {!r} is not valid".format(name, self.input_validation[name]))
+
+    # Integer control values are stored parsed in the grouped controls
+    # A value which is not an integer is kept as None so the compiled rule always fails
+    def normalize(self, controlValue):
+        try:
+            return int(controlValue)
+        except ValueError:
+            return None
+
+    # Compiles the control into a rule comparing integers
+    def compile(self, control_name, values):
+        return self.compiled_rule(control_name, int, values)
     
     # Validates the value of control against the configuration
-    # Converts the value to Integer and compares against the configured min_value and max_value   
+    # Converts the value to Integer and compares against the configured min_value and max_value
     def validate(self, value):
-        result = None
         try:
-            int_value = int(value)
+            parsed_value = self.parse(value)
         except ValueError:
             return False
-        if "input_validation" in self.control_def:
-            validation_obj = self.control_def["input_validation"]
-            if "min_value" in validation_obj:
-                try:
-                    min_value = int(validation_obj["min_value"])
-                    result = (int_value >= min_value)
-                except ValueError:
-                    return False
-                if result == False:
-                    return result
-            if "max_value" in validation_obj:
-                try:
-                    max_value = int(validation_obj["max_value"])
-                    result = int_value <= max_value
-                except ValueError:
-                    return False
-        return True if result is None else result
\ No newline at end of file
+        if self.min_value is not None and parsed_value < self.min_value:
+            return False
+        if self.max_value is not None and parsed_value > self.max_value:
+            return False
+        return True
+
+
+# Money controls are configured in major units e.g. MAX_AMT 12.50, and stored in the grouped controls as minor units
+# The incoming transaction amount is converted to minor units once when the transaction is received,
+# so evaluating the control is a plain integer comparison
+class MoneyControlProcessor(IntegerControlProcessor):
+    # Money control values are stored in minor units in the grouped controls
+    def normalize(self, controlValue):
+        try:
+            return to_minor_units(controlValue)
+        except ValueError:
+            return None
+
+    # Values and the configured min_value and max_value are compared in minor units
+    def parse(self, value):
+        return to_minor_units(value)
+
+
+# Velocity controls limit the spend (variable_name amount, in major units like Money controls)
+# or the number of transactions (variable_name count) of the card in a window (DAY / MONTH)
+# e.g. "DAY_AMT" : {"type" : "Velocity", "src_comparison" : {"variable_name" : "amount", "operator" : "LTE", "window" : "DAY"}}
+# Spend is kept per card and window in models.CardSpend, so evaluating the control never reads transactions
+class VelocityControlProcessor(ControlProcessor):
+    AMOUNT = "amount"
+    COUNT = "count"
+
+    def __init__(self, control_def):
+        ControlProcessor.__init__(self, control_def)
+        # control values are parsed and validated as amounts or as integers
+        self.window = SpendWindow[control_def["src_comparison"]["window"]].name
+        if self.variable_name == VelocityControlProcessor.AMOUNT:
+            self.value_processor = MoneyControlProcessor(control_def)
+        elif self.variable_name == VelocityControlProcessor.COUNT:
+            self.value_processor = IntegerControlProcessor(control_def)
+        else:
+            raise ValueError("Velocity controls compare the amount or count of a window, not " + self.variable_name)
+
+    def normalize(self, controlValue):
+        return self.value_processor.normalize(controlValue)
+
+    # Compiles the control into a rule comparing the aggregate of the window including the transaction
+    def compile(self, control_name, values):
+        rule = self.compiled_rule(control_name, None, values)
+        return VelocityRule(control_name, self.window, rule.variable_name,
+                            rule.operator, rule.value, rule.message)
+
+    def validate(self, value):
+        return self.value_processor.validate(value)
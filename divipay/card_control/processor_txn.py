@@ -0,0 +1,345 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction, close_old_connections
+from django.db.models import F
+from django.utils import timezone
+import logging
+from enum import Enum
+from . import errors
+from . import instrumentation
+from .instrumentation import stage_timer
+from .models import INTERNED_VARIABLES, Card, CardSpend, Control, InternedValue, Transaction
+from .processor_control import compile_controls
+from .utility import create_success_response, create_fail_response, to_minor_units
+from .messages import Messages
+
+logger = logging.getLogger(__name__)
+
+# seconds between two reads of the cache while another worker loads the controls of a card
+LOCK_POLL_INTERVAL = 0.01
+
+# Cards whose balances are debited in the memory of the transaction workers (LEDGER_CARDS in settings.py). Refer ledger.py
+# process_txn and process_txn_batch reject their transactions without storing them, so they are only processed through the queue
+LEDGER_CARD_SET = frozenset(settings.LEDGER_CARDS)
+
+class TxnStatus(Enum):
+    A = 0
+    R = 1
+
+def retrieve_grouped_controls(card_id):
+    # Retrieve query result from cache
+    # This cache is rebuilt whenever a new control is added / deleted for the particular card
+    # Refer models.py 
+    cache_key = Control.CACHE_KEY_PREFIX + card_id
+    cached_controls = cache.get(cache_key, version=Control.CACHE_VERSION)
+    if cached_controls is not None:
+        return cached_controls
+    
+    # Single flight: only the worker holding the lock loads the controls, the others wait for it to cache them
+    lock_key = Control.LOCK_CACHE_KEY_PREFIX + card_id
+    if cache.add(lock_key, True, timeout=settings.CONTROL_CACHE_LOCK_TIMEOUT, version=Control.CACHE_VERSION):
+        try:
+            grouped_control_dict = load_grouped_controls(card_id)
+        finally:
+            cache.delete(lock_key, version=Control.CACHE_VERSION)
+        return grouped_control_dict
+    
+    deadline = time.monotonic() + settings.CONTROL_CACHE_LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        cached_controls = cache.get(cache_key, version=Control.CACHE_VERSION)
+        if cached_controls is not None:
+            return cached_controls
+    logger.warning("Controls of card %s were not loaded by another worker in time, loading them", card_id)
+    return load_grouped_controls(card_id)
+
+# Query = select control_name, control_value from controls where card = card_id
+# Values are grouped into a frozenset per control_name so IN controls are exact set membership checks
+# add() never replaces controls cached by the write through on commit (Control.refresh_cache), which may be newer than the ones loaded here
+def load_grouped_controls(card_id):
+    grouped_control_dict = Control.load_grouped_controls([card_id])[card_id]
+    cache.add(Control.CACHE_KEY_PREFIX + card_id, grouped_control_dict, version=Control.CACHE_VERSION)
+    return grouped_control_dict
+
+def retrieve_control_plan(card_id):
+    # Retrieve compiled plan from cache
+    # The plan is rebuilt together with the grouped controls it is compiled from
+    # Refer models.py
+    control_plan = cache.get(Control.PLAN_CACHE_KEY_PREFIX + card_id, version=Control.CACHE_VERSION)
+    if control_plan is None:
+        control_plan = compile_controls(retrieve_grouped_controls(card_id))
+        cache.add(Control.PLAN_CACHE_KEY_PREFIX + card_id, control_plan, version=Control.CACHE_VERSION)
+    return control_plan
+
+# Processes a single transaction fetched from Divipay and returns the reply for it
+# The transaction is saved in the database whether it is approved or rejected
+# A transaction already processed (a retried delivery) is answered with its stored decision, the card is not touched
+def process_txn(txn_data):
+    txn = None
+    decision = Transaction.get_decision(txn_data["id"])
+    if decision is not None:
+        return replay_decision(txn_data, decision)
+    if txn_data["card"] in LEDGER_CARD_SET:
+        logger.error("Transaction %s of ledger card %s received outside of the queue", txn_data["id"], txn_data["card"])
+        return create_fail_response(Messages.Transaction.QUEUE_ONLY)
+    try:
+        card_id = txn_data["card"]
+        # Amount is converted to minor units once, controls and the debit compare integers
+        txn_data["amount"] = txn_amount = to_minor_units(txn_data["amount"])
+        intern_txns([txn_data])
+        
+        # Retrieve compiled controls plan from cache / Database
+        with stage_timer(instrumentation.CONTROLS_LOOKUP):
+            controls_plan = retrieve_control_plan(card_id)
+        
+        # Process controls to check whether the transaction can be carried or not
+        logger.debug("Processing controls against the transaction object")
+        with stage_timer(instrumentation.RULE_EVALUATION):
+            try:
+                controls_plan.evaluate(txn_data)
+            except errors.ControlException as control_exception:
+                instrumentation.record_control_outcomes(controls_plan, control_exception.errors.control)
+                raise
+            instrumentation.record_control_outcomes(controls_plan)
+        
+        with transaction.atomic():
+            # Debit the balance if it is sufficient, in a single conditional update
+            with stage_timer(instrumentation.BALANCE_DEBIT):
+                if not Card.debit(card_id, txn_amount):
+                    raise errors.InsufficientBalanceError
+                today = timezone.localdate()
+                # Velocity controls are evaluated once the debit has locked the card row, a failure rolls the debit back
+                if controls_plan.velocity_rules:
+                    evaluate_velocity(controls_plan, txn_data, CardSpend.get_spend(card_id, today))
+                CardSpend.record(card_id, txn_amount, 1, today)
+            logger.debug("Balance updated in the database")
+            
+            # Saving transaction object in the same database transaction as the debit
+            # A concurrent delivery of the same transaction fails the insert and rolls the debit back
+            with stage_timer(instrumentation.TXN_WRITE):
+                Transaction.record(create_txn_object(txn_data, TxnStatus.A))
+        reply = create_success_response(Messages.Transaction.APPROVED)
+        instrumentation.incr("txn.approved")
+        logger.info("Transaction %s has been approved.", txn_data["id"])
+    except Card.DoesNotExist:
+        logger.error("Card does not exist, rejecting the transaction")
+        txn = create_txn_object(txn_data, TxnStatus.R, Messages.Card.DETAILS_NOT_FOUND)
+        reply = create_fail_response(Messages.Card.DETAILS_NOT_FOUND)
+    except errors.ControlException as control_exception:
+        logger.info("Control exception raised %s", control_exception.message)
+        txn = create_txn_object(txn_data, TxnStatus.R, control_exception.message)
+        reply = create_fail_response(control_exception.message, control_exception.errors.control)
+    except errors.InsufficientBalanceError as insufficient_bal_exception:
+        logger.info("Insufficient balance to carry out the transaction")
+        txn = create_txn_object(txn_data, TxnStatus.R, insufficient_bal_exception.message)
+        reply = create_fail_response(insufficient_bal_exception.message)
+    except IntegrityError as integrity_error:
+        return replay_stored_decision(txn_data, integrity_error)
+    if txn is not None:
+        # Saving transaction object in the database 
+        try:
+            with stage_timer(instrumentation.TXN_WRITE), transaction.atomic():
+                Transaction.record(txn)
+        except IntegrityError as integrity_error:
+            return replay_stored_decision(txn_data, integrity_error)
+        instrumentation.incr("txn.rejected")
+    return reply
+
+# Reply for a transaction inserted by a concurrent delivery, read from the database as the cache may not have it yet
+# The IntegrityError is raised again if it was not caused by the transaction id
+def replay_stored_decision(txn_data, integrity_error):
+    decision = Transaction.load_decisions([txn_data["id"]]).get(txn_data["id"])
+    if decision is None:
+        raise integrity_error
+    return replay_decision(txn_data, decision)
+
+# Reply for a transaction already processed, built from its stored (status, reason)
+def replay_decision(txn_data, decision):
+    txn_status, reason = decision
+    instrumentation.incr("txn.duplicate")
+    logger.info("Replaying the decision of transaction %s", txn_data["id"])
+    if txn_status == TxnStatus.A.name:
+        return create_success_response(Messages.Transaction.APPROVED)
+    return create_fail_response(reason)
+
+# process_txn for threads outside of the request / response cycle
+# Django only closes connections at the end of a request, so the connection of the thread is released here
+def process_txn_in_thread(txn_data):
+    try:
+        return process_txn(txn_data)
+    finally:
+        close_old_connections()
+
+# Processes a batch of transactions and returns the decision for each of them in the same order
+# Amounts of the transactions are expected in minor units
+# Transactions are grouped by card so controls are loaded once per card, and every card is debited for its approved
+# transactions in arrival order with a single conditional update (refer debit_txns). Approved transaction rows are written with the debit,
+# rejected ones with a single bulk insert
+# Transactions already processed get their stored decision and a transaction repeated in the batch the decision of its first delivery
+# Transactions of ledger cards are rejected and not stored, they are only processed through the queue
+def process_txn_batch(txn_data_list):
+    decisions = [None] * len(txn_data_list)
+    txns = []
+    
+    stored_decisions = Transaction.get_decisions(list({txn_data["id"] for txn_data in txn_data_list}))
+    first_indexes = dict()
+    repeats = []
+    txns_by_card = dict()
+    for index, txn_data in enumerate(txn_data_list):
+        txn_id = txn_data["id"]
+        if txn_id in stored_decisions:
+            decisions[index] = stored_decision(stored_decisions[txn_id])
+            repeats.append((index, None))
+        elif txn_data["card"] in LEDGER_CARD_SET:
+            decisions[index] = (TxnStatus.R, Messages.Transaction.QUEUE_ONLY)
+        elif txn_id in first_indexes:
+            repeats.append((index, first_indexes[txn_id]))
+        else:
+            first_indexes[txn_id] = index
+            txns_by_card.setdefault(txn_data["card"], []).append((index, txn_data))
+    intern_txns([txn_data for card_txns in txns_by_card.values() for index, txn_data in card_txns])
+    
+    for card_id, card_txns in txns_by_card.items():
+        # Process controls for every transaction of the card against the same plan
+        with stage_timer(instrumentation.CONTROLS_LOOKUP):
+            controls_plan = retrieve_control_plan(card_id)
+        approved_txns = []
+        with stage_timer(instrumentation.RULE_EVALUATION):
+            for index, txn_data in card_txns:
+                try:
+                    controls_plan.evaluate(txn_data)
+                    approved_txns.append((index, txn_data))
+                    instrumentation.record_control_outcomes(controls_plan)
+                except errors.ControlException as control_exception:
+                    decisions[index] = (TxnStatus.R, control_exception.message)
+                    instrumentation.record_control_outcomes(controls_plan, control_exception.errors.control)
+        
+        approved_rows = []
+        concurrent_decisions = dict()
+        if approved_txns:
+            with transaction.atomic():
+                with stage_timer(instrumentation.BALANCE_DEBIT):
+                    approved_txns, concurrent_decisions = debit_txns(card_id, controls_plan, approved_txns, decisions, repeats)
+                
+                # Saving the approved transaction objects in the same database transaction as the debit
+                approved_rows = [create_txn_object(txn_data, *decisions[index]) for index, txn_data in approved_txns]
+                if approved_rows:
+                    with stage_timer(instrumentation.TXN_WRITE):
+                        Transaction.objects.bulk_create(approved_rows)
+                    approved_decisions = {txn.id : (txn.status, txn.reason) for txn in approved_rows}
+                    transaction.on_commit(lambda: Transaction.cache_decisions(approved_decisions))
+        
+        for index, txn_data in card_txns:
+            if decisions[index][0] is TxnStatus.R and txn_data["id"] not in concurrent_decisions:
+                txns.append(create_txn_object(txn_data, *decisions[index]))
+        instrumentation.incr("txn.approved", len(approved_rows))
+    
+    for index, first_index in repeats:
+        if first_index is not None:
+            decisions[index] = decisions[first_index]
+    
+    # Saving rejected transaction objects in the database 
+    # Rows already stored for a transaction id are left as they are
+    with stage_timer(instrumentation.TXN_WRITE):
+        Transaction.objects.bulk_create(txns, ignore_conflicts=True)
+    instrumentation.incr("txn.rejected", len(txns))
+    instrumentation.incr("txn.duplicate", len(repeats))
+    logger.info("Processed a batch of %d transactions, %d of them already processed", len(txn_data_list), len(repeats))
+    return decisions
+
+# Debits the transactions of a card approved by its controls, in the database transaction of the caller
+# Returns the transactions approved and the stored decisions of those stored meanwhile by a concurrent delivery,
+# and sets the decisions of the others
+# Query = update card set balance = balance - amount where id = card_id and balance >= amount, for the sum of the transactions
+# The update locks the card row. The transactions stored by a concurrent delivery and those failing the velocity controls
+# against the spend read under the lock are then credited back with a second update
+# When the balance does not cover the sum, the row is locked with select for update and the transactions are approved in order
+def debit_txns(card_id, controls_plan, approved_txns, decisions, repeats):
+    total_amount = sum(txn_data["amount"] for index, txn_data in approved_txns)
+    debited = Card.objects.filter(id=card_id, balance__gte=total_amount).update(balance=F('balance') - total_amount) > 0
+    balance = None
+    if not debited:
+        balance = Card.objects.select_for_update().filter(id=card_id).values_list('balance', flat=True).first()
+        if balance is None:
+            logger.error("Card does not exist, rejecting the transactions")
+            for index, txn_data in approved_txns:
+                decisions[index] = (TxnStatus.R, Messages.Card.DETAILS_NOT_FOUND)
+            return [], dict()
+    
+    # Transactions stored by a concurrent delivery once the card row is locked are not debited again
+    concurrent_decisions = Transaction.load_decisions([txn_data["id"] for index, txn_data in approved_txns])
+    today = timezone.localdate()
+    # Velocity controls are evaluated against the spend read after the card row is locked,
+    # plus the transactions of the batch approved before
+    spend = CardSpend.get_spend(card_id, today) if controls_plan.velocity_rules else None
+    debited_txns = []
+    spent_amount = 0
+    for index, txn_data in approved_txns:
+        if txn_data["id"] in concurrent_decisions:
+            decisions[index] = stored_decision(concurrent_decisions[txn_data["id"]])
+            repeats.append((index, None))
+            continue
+        txn_amount = txn_data["amount"]
+        # Check transaction amount against card balance, covered already when the sum has been debited
+        if balance is not None and balance - spent_amount < txn_amount:
+            decisions[index] = (TxnStatus.R, Messages.Transaction.INSUFFICIENT_BALANCE)
+            continue
+        if spend is not None:
+            try:
+                evaluate_velocity(controls_plan, txn_data, spend)
+            except errors.ControlException as control_exception:
+                decisions[index] = (TxnStatus.R, control_exception.message)
+                continue
+            for window in CardSpend.window_starts(today):
+                window_amount, window_count = spend.get(window, (0, 0))
+                spend[window] = (window_amount + txn_amount, window_count + 1)
+        spent_amount += txn_amount
+        debited_txns.append((index, txn_data))
+        decisions[index] = (TxnStatus.A, None)
+    
+    # Query = update card set balance = balance + amount where id = card_id
+    # Credits back the transactions left out of the debited sum, or debits the approved ones once the row is locked
+    adjustment = (total_amount if debited else 0) - spent_amount
+    if adjustment:
+        Card.objects.filter(id=card_id).update(balance=F('balance') + adjustment)
+    if debited or spent_amount:
+        logger.debug("Balance updated in the database")
+        balance = Card.objects.values_list('balance', flat=True).get(id=card_id)
+        transaction.on_commit(lambda: Card.update_cached_balance(card_id, balance))
+    if debited_txns:
+        CardSpend.record(card_id, spent_amount, len(debited_txns), today)
+    return debited_txns, concurrent_decisions
+
+# Decision of process_txn_batch from a stored (status, reason)
+def stored_decision(decision):
+    txn_status, reason = decision
+    return (TxnStatus[txn_status], reason)
+
+# Evaluates the velocity controls of the plan against the spend of the card before this transaction
+def evaluate_velocity(controls_plan, txn_data, spend):
+    try:
+        controls_plan.evaluate_velocity(txn_data, spend)
+    except errors.ControlException as control_exception:
+        instrumentation.record_velocity_outcomes(controls_plan, control_exception.errors.control)
+        raise
+    instrumentation.record_velocity_outcomes(controls_plan)
+
+# Interns the merchant names and categories of the transactions, with bulk queries for the values not known yet
+# Called before the database transactions debiting the cards, so the transaction rows reference committed ids
+def intern_txns(txn_data_list):
+    for variable_name in INTERNED_VARIABLES:
+        InternedValue.intern_many(variable_name, [txn_data[variable_name] for txn_data in txn_data_list])
+
+def create_txn_object(txn_data, txn_status, reason = None):
+    txn = Transaction(id=txn_data["id"],
+                      card=txn_data["card"],
+                      amount=txn_data["amount"],
+                      merchant_id=InternedValue.intern("merchant", txn_data["merchant"]), 
+                      merchant_category_id=InternedValue.intern("merchant_category", txn_data["merchant_category"]),
+                      created_at=txn_data["created"], 
+                      updated_at=txn_data["updated"],
+                      status=txn_status.name, 
+                      reason=reason
+            )
+    return txn
@@ -1,7 +1,24 @@
 from rest_framework import serializers
 from .models import Card, Control
+from .utility import to_minor_units, to_major_units
+
+# Amount received / returned in major units e.g. "12.50", held as integer minor units e.g. 1250
+class MoneyField(serializers.Field):
+        default_error_messages = {
+                'invalid': 'A valid amount is required.'
+        }
+
+        def to_internal_value(self, data):
+                try:
+                        return to_minor_units(data)
+                except ValueError:
+                        self.fail('invalid')
+
+        def to_representation(self, value):
+                return str(to_major_units(value))
 
 class CardSerializer(serializers.ModelSerializer):
+        balance = MoneyField(required=False)
         class Meta:
                 model = Card
                 fields = ('id','user', 'balance', 'created', 'updated')
@@ -1,42 +1,238 @@
 from enum import Enum
+from urllib.parse import urlsplit
+import asyncio
+import threading
+import time
+import weakref
 import requests
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from . import errors
+from .messages import Messages
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TIMEOUT = 5
+
 class HTTPMethod(Enum):
     GET = 1
     POST = 2
 
-def get_service(url, headers):
-    return api_service(HTTPMethod.GET, url, headers)
+def get_service(url, headers, timeout = DEFAULT_TIMEOUT):
+    return api_service(HTTPMethod.GET, url, headers, timeout = timeout)
 
-def post_service(url, headers, body = None):
-    return api_service(HTTPMethod.POST, url, headers, body)
+def post_service(url, headers, body = None, timeout = DEFAULT_TIMEOUT):
+    return api_service(HTTPMethod.POST, url, headers, body, timeout)
 
 # Generic service method to hit any third party API
-# defines common timeout
+# timeout is either seconds or a (connect timeout, read timeout) tuple
 # Collects response and returns back    
-def api_service(httpMethod, url, headers, body = None):
+# Fails fast with errors.CircuitOpen / errors.BulkheadFull instead of waiting for the timeout when
+# the third party is down or too many calls are already in flight
+def api_service(httpMethod, url, headers, body = None, timeout = DEFAULT_TIMEOUT):
+    session = get_session(url)
+    circuit_breaker = get_circuit_breaker(url)
+    # The bulkhead is taken first, so a call rejected by it never claims the trial call of a half open circuit
+    if not __bulkhead.acquire(blocking = False):
+        raise errors.BulkheadFull()
     try:
-        logger.info("Hitting third party API {0} {1} {2} {3}".format(httpMethod, url, headers, body))
+        trial_call = circuit_breaker.before_call()
+        logger.debug("Hitting third party API %s %s", httpMethod.name, url)
         if httpMethod == HTTPMethod.GET:
-            response = requests.get(url, headers = headers, timeout = 5)
+            response = session.get(url, headers = headers, timeout = timeout)
         else:
             if body is None:
-                response = requests.post(url, headers = headers, timeout = 5)
+                response = session.post(url, headers = headers, timeout = timeout)
             else:
-                response = requests.post(url, json = body, headers = headers, timeout = 5)
+                response = session.post(url, json = body, headers = headers, timeout = timeout)
         response.raise_for_status()
-        logger.info("Success Response from third party {0}".format(response.status_code))
+        # A response which is not JSON counts as a failure of the third party
+        try:
+            content = response.json()
+        except ValueError as e:
+            logger.error("Error encountered while reading response - Not a valid JSON")
+            circuit_breaker.record_result(trial_call, False)
+            raise errors.DiviPayError(response.status_code, Messages.Common.INVALID_RESPONSE) from e
+        circuit_breaker.record_result(trial_call, True)
+        logger.debug("Success Response from third party %d", response.status_code)
         return {
             "status" : response.status_code,
-            "content" : response.json()
+            "content" : content
         }
     except (requests.ConnectionError, requests.Timeout) as e:
         logger.error("Error encountered while getting response - Unable to connect to server")
+        circuit_breaker.record_result(trial_call, False)
         raise errors.Unavailable() from e
     except requests.exceptions.HTTPError as e:
-        logger.error("Error encountered while getting response {}".format(e.response.status_code))
-        raise errors.DiviPayError(e.response.status_code, e.response.message)
\ No newline at end of file
+        logger.error("Error encountered while getting response %d", e.response.status_code)
+        # The third party is up when it answers with a client error
+        circuit_breaker.record_result(trial_call, e.response.status_code < 500)
+        raise errors.DiviPayError(e.response.status_code, e.response.reason)
+    finally:
+        __bulkhead.release()
+
+# One session per host (scheme + netloc) so connections are kept alive and reused across calls
+# instead of opening a new TCP + TLS connection for every call
+__sessions = dict()
+__sessions_lock = threading.Lock()
+
+def get_session(url):
+    url_parts = urlsplit(url)
+    host = url_parts.scheme + "://" + url_parts.netloc
+    session = __sessions.get(host)
+    if session is None:
+        with __sessions_lock:
+            session = __sessions.get(host)
+            if session is None:
+                session = create_session(host)
+                __sessions[host] = session
+    return session
+
+# Pool size and retries are configured in settings.py
+# Only idempotent GETs are retried (with backoff) on connection errors and 502 / 503 / 504 responses,
+# a POST is only retried when the connection could not be established at all
+def create_session(host):
+    retry = Retry(total = settings.HTTP_RETRIES,
+                  backoff_factor = settings.HTTP_BACKOFF_FACTOR,
+                  status_forcelist = (502, 503, 504),
+                  allowed_methods = frozenset(["GET"]),
+                  raise_on_status = False)
+    adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = settings.HTTP_POOL_SIZE, max_retries = retry)
+    session = requests.Session()
+    session.mount(host + "/", adapter)
+    return session
+
+# Bulkhead limiting the third party API calls in flight in this process (threads and event loop together)
+__bulkhead = threading.BoundedSemaphore(settings.HTTP_MAX_CONCURRENT_CALLS)
+
+# Circuit breaker per host. State is kept in the cache so it is shared by all the workers
+# closed    - calls go through, failures (connection errors, timeouts, 5xx) are counted
+# open      - after CIRCUIT_FAILURE_THRESHOLD failures within CIRCUIT_FAILURE_WINDOW seconds every call fails fast
+# half open - CIRCUIT_RESET_TIMEOUT seconds after opening, a single trial call is let through.
+#             Success closes the circuit, failure opens it again
+class CircuitBreaker(object):
+    CACHE_KEY_PREFIX = "circuit_"
+    
+    def __init__(self, name):
+        self.failures_key = CircuitBreaker.CACHE_KEY_PREFIX + name + "_failures"
+        self.opened_key = CircuitBreaker.CACHE_KEY_PREFIX + name + "_opened"
+        self.trial_key = CircuitBreaker.CACHE_KEY_PREFIX + name + "_trial"
+    
+    # Raises errors.CircuitOpen if the call should not be made
+    # returns True if the call is the trial call of a half open circuit
+    def before_call(self):
+        opened_at = cache.get(self.opened_key)
+        if opened_at is None:
+            return False
+        if time.time() - opened_at < settings.CIRCUIT_RESET_TIMEOUT:
+            raise errors.CircuitOpen()
+        # cache.add only succeeds for one of the workers
+        if not cache.add(self.trial_key, True, timeout = settings.CIRCUIT_RESET_TIMEOUT):
+            raise errors.CircuitOpen()
+        return True
+    
+    def record_result(self, trial_call, success):
+        if success:
+            if trial_call:
+                logger.info("Trial call succeeded, closing circuit")
+                cache.delete_many([self.failures_key, self.opened_key, self.trial_key])
+            return
+        if trial_call:
+            failures = settings.CIRCUIT_FAILURE_THRESHOLD
+        elif cache.add(self.failures_key, 1, timeout = settings.CIRCUIT_FAILURE_WINDOW):
+            failures = 1
+        else:
+            try:
+                failures = cache.incr(self.failures_key)
+            except ValueError:
+                # failure window expired in between
+                failures = 1
+        if failures >= settings.CIRCUIT_FAILURE_THRESHOLD:
+            logger.error("Opening circuit after %d failures", failures)
+            cache.set(self.opened_key, time.time(), timeout = None)
+            cache.delete(self.trial_key)
+
+__circuit_breakers = dict()
+
+def get_circuit_breaker(url):
+    url_parts = urlsplit(url)
+    host = url_parts.scheme + "://" + url_parts.netloc
+    circuit_breaker = __circuit_breakers.get(host)
+    if circuit_breaker is None:
+        circuit_breaker = __circuit_breakers.setdefault(host, CircuitBreaker(url_parts.netloc))
+    return circuit_breaker
+
+async def async_get_service(url, headers, timeout = DEFAULT_TIMEOUT):
+    return await async_api_service(HTTPMethod.GET, url, headers, timeout = timeout)
+
+async def async_post_service(url, headers, body = None, timeout = DEFAULT_TIMEOUT):
+    return await async_api_service(HTTPMethod.POST, url, headers, body, timeout)
+
+# Async variant of api_service, used by the async views
+# Awaiting the response does not block the worker, so a single worker can have many calls in flight
+# The circuit breaker reads and writes the cache, which may query the database, so it runs in a thread
+async def async_api_service(httpMethod, url, headers, body = None, timeout = DEFAULT_TIMEOUT):
+    client = get_async_client()
+    if isinstance(timeout, tuple):
+        timeout = httpx.Timeout(timeout[1], connect = timeout[0])
+    circuit_breaker = get_circuit_breaker(url)
+    record_result = sync_to_async(circuit_breaker.record_result, thread_sensitive = False)
+    if not __bulkhead.acquire(blocking = False):
+        raise errors.BulkheadFull()
+    try:
+        trial_call = await sync_to_async(circuit_breaker.before_call, thread_sensitive = False)()
+        logger.debug("Hitting third party API %s %s", httpMethod.name, url)
+        if httpMethod == HTTPMethod.GET:
+            response = await client.get(url, headers = headers, timeout = timeout)
+        else:
+            if body is None:
+                response = await client.post(url, headers = headers, timeout = timeout)
+            else:
+                response = await client.post(url, json = body, headers = headers, timeout = timeout)
+        response.raise_for_status()
+        try:
+            content = response.json()
+        except ValueError as e:
+            logger.error("Error encountered while reading response - Not a valid JSON")
+            await record_result(trial_call, False)
+            raise errors.DiviPayError(response.status_code, Messages.Common.INVALID_RESPONSE) from e
+        await record_result(trial_call, True)
+        logger.debug("Success Response from third party %d", response.status_code)
+        return {
+            "status" : response.status_code,
+            "content" : content
+        }
+    except httpx.TransportError as e:
+        logger.error("Error encountered while getting response - Unable to connect to server")
+        await record_result(trial_call, False)
+        raise errors.Unavailable() from e
+    except httpx.HTTPStatusError as e:
+        logger.error("Error encountered while getting response %d", e.response.status_code)
+        await record_result(trial_call, e.response.status_code < 500)
+        raise errors.DiviPayError(e.response.status_code, e.response.reason_phrase)
+    finally:
+        __bulkhead.release()
+
+# httpx clients are bound to the event loop they are used in
+# One client (and its connection pool) is kept per running loop
+__async_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+    if httpx is None:
+        raise ImproperlyConfigured("httpx is required for the async views. Install it with pip install httpx")
+    loop = asyncio.get_running_loop()
+    client = __async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(limits = httpx.Limits(max_connections = settings.HTTP_POOL_SIZE))
+        __async_clients[loop] = client
+    return client
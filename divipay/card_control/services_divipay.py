@@ -13,8 +13,8 @@ def create_card():
     card_url = settings.DIVIPAY_API_BASE_URL + 'cards/'
     try:
         logger.info("Creating a dummy card")
-        r = services.post_service(card_url, headers)
-        logger.info("Card created. Response {0}".format(r["content"]))
+        r = services.post_service(card_url, headers, timeout = settings.DIVIPAY_TIMEOUTS["cards"])
+        logger.debug("Card created. Response %s", r["content"])
         return r["content"]
     except (errors.Unavailable, errors.DiviPayError) as e:
         raise errors.CardCreationError(Messages.Card.CREATION_FAILED + e.message) from e
@@ -22,9 +22,19 @@ def create_card():
 def get_txn():
     txn_url = settings.DIVIPAY_API_BASE_URL + 'transaction/'
     try:
-        logger.info("Getting a dummy transaction")
-        r = services.get_service(txn_url, headers)
-        logger.info("Transaction received {0}".format(r["content"]))
+        logger.debug("Getting a dummy transaction")
+        r = services.get_service(txn_url, headers, timeout = settings.DIVIPAY_TIMEOUTS["transaction"])
+        logger.debug("Transaction received %s", r["content"])
         return r["content"]
     except (errors.Unavailable, errors.DiviPayError) as e:
-        raise errors.TxnFetchError(e.message) from e
\ No newline at end of file
+        raise errors.TxnFetchError(e.message) from e
+
+async def get_txn_async():
+    txn_url = settings.DIVIPAY_API_BASE_URL + 'transaction/'
+    try:
+        logger.debug("Getting a dummy transaction")
+        r = await services.async_get_service(txn_url, headers, timeout = settings.DIVIPAY_TIMEOUTS["transaction"])
+        logger.debug("Transaction received %s", r["content"])
+        return r["content"]
+    except (errors.Unavailable, errors.DiviPayError) as e:
+        raise errors.TxnFetchError(e.message) from e
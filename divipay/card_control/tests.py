@@ -1,3 +1,1316 @@
-from django.test import TestCase
+import asyncio
+import copy
+import csv
+import datetime
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+import requests
+from unittest import mock, skipIf
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from card_control import backtest, cache_tiered, errors, export, instrumentation, processor_txn, services, services_divipay, txn_queue, views_txn
+from card_control.cache_tiered import TieredCache
+from card_control.ledger import Ledger
+from card_control.messages import Messages
+from card_control.models import INTERNED_IDS, INTERNED_MISSES, Card, CardRecord, CardSpend, Control, InternedValue, LedgerCheckpoint, QueuedTxn, Transaction
+from card_control.operation_control import ControlOperator
+from card_control.processor_control import SpendWindow, compile_controls, get_processor, get_registry
+from card_control.processor_txn import process_txn, retrieve_grouped_controls
+from card_control.utility import to_major_units, to_minor_units
+from card_control.warmup import warm_cache
 
-# Create your tests here.
+BATCH_URL = "/cardcontrol/api/v1/txn/batch"
+QUEUE_URL = "/cardcontrol/api/v1/txn/queue"
+
+# Base of the tests: an authenticated API client and a card with the mandatory controls
+# The shared cache is a table of the cache database, refer db_router.py
+# The local tier of the cache and the interned ids of the process outlive the database transaction of a test, so they are cleared
+# Changes whose caches are rebuilt on commit (controls, cached balances and decisions) run their on_commit callbacks,
+# refer captureOnCommitCallbacks
+class CardControlTestCase(TestCase):
+    databases = {"default", "cache"}
+
+    def setUp(self):
+        cache.clear()
+        INTERNED_IDS.clear()
+        INTERNED_MISSES.clear()
+        self.user = User.objects.create(username="owner")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_card(self, card_id = "card", balance = 100000, controls = (("MAX_AMT", "50"), ("MER_NAME", "Coles"))):
+        now = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            card = Card.objects.create(id=card_id, user=1, balance=balance, created=now, updated=now, creator=self.user)
+            for control_name, control_value in controls:
+                Control.objects.create(card=card, control_name=control_name, control_value=control_value)
+        return card
+
+    def txn_data(self, txn_id, card_id = "card", amount = "10.00", merchant = "Coles", merchant_category = "5411"):
+        now = timezone.now().isoformat()
+        return {"id" : txn_id, "card" : card_id, "amount" : amount, "merchant" : merchant,
+                "merchant_category" : merchant_category, "created" : now, "updated" : now}
+
+    def post_batch(self, txns, url = BATCH_URL):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(url, {"transactions" : txns}, format="json")
+
+    def balance(self, card_id = "card"):
+        return Card.objects.values_list("balance", flat=True).get(id=card_id)
+
+
+class MerchantMatchTests(CardControlTestCase):
+    def statuses(self, merchants):
+        response = self.post_batch([self.txn_data("t{}".format(index), amount="1", merchant=merchant) for index, merchant in enumerate(merchants)])
+        return [txn["status"] for txn in response.data["data"]]
+
+    def test_whole_value_case_insensitive(self):
+        self.create_card(controls=(("MAX_AMT", "50"), ("MER_NAME", "Coles"), ("MER_NAME", "aws")))
+        self.assertEqual(self.statuses(["Coles", "COLES", "coles", "AWS", "Coles Express", "Col", "Colesworth", "AWS,Coles", "Woolworths"]),
+                         ["A", "A", "A", "A", "R", "R", "R", "R", "R"])
+
+    def test_merchant_category(self):
+        self.create_card(controls=(("MAX_AMT", "50"), ("MER_CAT", "5411")))
+        response = self.post_batch([self.txn_data("t1", merchant_category="5411"), self.txn_data("t2", merchant_category="541"),
+                                    self.txn_data("t3", merchant_category="54110")])
+        self.assertEqual([txn["status"] for txn in response.data["data"]], ["A", "R", "R"])
+
+
+class BatchTxnTests(CardControlTestCase):
+    def test_decisions_in_order(self):
+        self.create_card(balance=2000)
+        response = self.post_batch([self.txn_data("t1"), self.txn_data("t2", merchant="Aldi"),
+                                    self.txn_data("t3", amount="15"), self.txn_data("t4", amount=5)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(txn["id"], txn["status"], txn["reason"]) for txn in response.data["data"]], [
+            ("t1", "A", None),
+            ("t2", "R", Messages.Control.FAILED_TO_COMPLY + "MER_NAME"),
+            ("t3", "R", Messages.Transaction.INSUFFICIENT_BALANCE),
+            ("t4", "A", None)
+        ])
+        self.assertEqual(self.balance(), 500)
+        self.assertEqual(Card.get_record("card").balance, 500)
+        self.assertEqual(dict(Transaction.objects.values_list("id", "status")), {"t1" : "A", "t2" : "R", "t3" : "R", "t4" : "A"})
+
+    def test_unknown_card(self):
+        response = self.post_batch([self.txn_data("t1", card_id="missing")])
+        self.assertEqual(response.data["data"][0]["status"], "R")
+
+    def test_repeated_txns_debited_once(self):
+        self.create_card(balance=5000)
+        response = self.post_batch([self.txn_data("t1"), self.txn_data("t1"), self.txn_data("t2", amount="20")])
+        self.assertEqual([txn["status"] for txn in response.data["data"]], ["A", "A", "A"])
+        self.assertEqual(self.balance(), 2000)
+
+        # a retried delivery gets the stored decisions back
+        response = self.post_batch([self.txn_data("t2", amount="20"), self.txn_data("t3", amount="30")])
+        self.assertEqual([txn["status"] for txn in response.data["data"]], ["A", "R"])
+        self.assertEqual(response.data["data"][1]["reason"], Messages.Transaction.INSUFFICIENT_BALANCE)
+        self.assertEqual(self.balance(), 2000)
+        self.assertEqual(Transaction.objects.count(), 3)
+
+    def test_balance_short_of_the_sum(self):
+        # the sum of the batch is not covered, the transactions are approved in order against the balance
+        self.create_card(balance=3000)
+        response = self.post_batch([self.txn_data("t1"), self.txn_data("t2", amount="25"), self.txn_data("t3", amount="20")])
+        self.assertEqual([txn["status"] for txn in response.data["data"]], ["A", "R", "A"])
+        self.assertEqual(self.balance(), 0)
+        self.assertEqual(Card.get_record("card").balance, 0)
+
+    def test_invalid_fields(self):
+        self.create_card()
+        txns = [self.txn_data("t1"), self.txn_data("t2", amount=[10]), self.txn_data("t3", card_id=7), "t4",
+                dict(self.txn_data("t5"), created="yesterday"), dict(self.txn_data("t6"), amount=True)]
+        del txns[0]["merchant"]
+        for url in (BATCH_URL, QUEUE_URL):
+            response = self.post_batch(txns, url)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data["message"], Messages.Transaction.INVALID_BATCH)
+            self.assertEqual(response.data["data"], [
+                {"index" : 0, "fields" : ["merchant"]},
+                {"index" : 1, "fields" : ["amount"]},
+                {"index" : 2, "fields" : ["card"]},
+                {"index" : 3, "fields" : ["id", "card", "amount", "merchant", "merchant_category", "created", "updated"]},
+                {"index" : 4, "fields" : ["created"]},
+                {"index" : 5, "fields" : ["amount"]}
+            ])
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(self.balance(), 100000)
+
+    def test_invalid_amounts(self):
+        self.create_card()
+        amounts = ["-100", -1, 0, "0.00", "0.004", "1e20", settings.TXN_MAX_AMOUNT, "nan", "inf", "10.00"]
+        response = self.post_batch([self.txn_data("t{}".format(index), amount=amount) for index, amount in enumerate(amounts)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["data"], [{"index" : index, "fields" : ["amount"]} for index in range(len(amounts) - 1)])
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(self.balance(), 100000)
+
+        # the largest amount accepted
+        response = self.post_batch([self.txn_data("t1", amount=settings.TXN_MAX_AMOUNT // 100)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["data"][0]["reason"], Messages.Control.FAILED_TO_COMPLY + "MAX_AMT")
+
+    def test_invalid_batch(self):
+        for body in ({"transactions" : []}, {"transactions" : "t1"}, ["t1"]):
+            response = self.client.post(BATCH_URL, body, format="json")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data["message"], Messages.Transaction.INVALID_BATCH)
+
+    def test_authentication_required(self):
+        response = APIClient().post(BATCH_URL, {"transactions" : [self.txn_data("t1")]}, format="json")
+        self.assertEqual(response.status_code, 401)
+
+
+# Divipay is replaced by a mock transport of httpx. The calls read and write the state of the circuit breaker in threads,
+# so the cache is local to the process instead of the test database
+@skipIf(services.httpx is None, "httpx is not installed")
+@override_settings(CACHES={"default" : {"BACKEND" : "django.core.cache.backends.locmem.LocMemCache", "LOCATION" : "async"}}, CIRCUIT_FAILURE_THRESHOLD=1)
+class AsyncServiceTests(SimpleTestCase):
+    URL = "https://divipay.test/api/transaction/"
+
+    def setUp(self):
+        cache.clear()
+        self.requests = []
+        self.reply = lambda request: services.httpx.Response(200, json={"id" : "t1"})
+        AsyncClient = services.httpx.AsyncClient
+        transport = services.httpx.MockTransport(self.handle)
+        patcher = mock.patch.object(services.httpx, "AsyncClient", side_effect=lambda **kwargs: AsyncClient(transport=transport, **kwargs))
+        self.client_class = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handle(self, request):
+        self.requests.append(request)
+        return self.reply(request)
+
+    # makes the calls in a new event loop
+    def call(self, calls = 1):
+        async def run():
+            return [await services.async_get_service(self.URL, {"Authorization" : "Token test"}, timeout=(1, 4)) for call in range(calls)]
+        return asyncio.run(run())
+
+    def test_get(self):
+        self.assertEqual(self.call(), [{"status" : 200, "content" : {"id" : "t1"}}])
+        request = self.requests[0]
+        self.assertEqual((request.method, str(request.url), request.headers["Authorization"]), ("GET", self.URL, "Token test"))
+        self.assertEqual((request.extensions["timeout"]["connect"], request.extensions["timeout"]["read"]), (1, 4))
+
+    def test_client_per_loop(self):
+        self.call(2)
+        self.assertEqual(self.client_class.call_count, 1)
+        # a new event loop gets a client of its own
+        self.call(2)
+        self.assertEqual(self.client_class.call_count, 2)
+        self.assertEqual(len(self.requests), 4)
+
+    def test_errors(self):
+        def fail(request):
+            raise services.httpx.ConnectError("refused", request=request)
+        for reply, error in ((fail, errors.Unavailable),
+                             (lambda request: services.httpx.Response(200, content=b"<html>"), errors.DiviPayError),
+                             (lambda request: services.httpx.Response(503), errors.DiviPayError)):
+            with self.subTest(error=error):
+                cache.clear()
+                self.reply = reply
+                with self.assertRaises(error):
+                    self.call()
+                # the failure opened the circuit
+                with self.assertRaises(errors.CircuitOpen):
+                    self.call()
+
+    def test_client_errors_keep_the_circuit_closed(self):
+        self.reply = lambda request: services.httpx.Response(404)
+        with self.assertRaises(errors.DiviPayError) as raised:
+            self.call()
+        self.assertEqual(raised.exception.code, 404)
+        self.reply = lambda request: services.httpx.Response(200, json={"id" : "t1"})
+        self.assertEqual(self.call()[0]["status"], 200)
+
+    def test_async_view(self):
+        reply = {"status" : "Success", "message" : "Transaction processed"}
+        with mock.patch("card_control.views_txn.process_txn_in_thread", return_value=reply) as process_txn_in_thread:
+            response = asyncio.run(views_txn.get_dummy_txn_async(RequestFactory().get("/cardcontrol/stub/txn/async")))
+        self.assertEqual(json.loads(response.content), reply)
+        process_txn_in_thread.assert_called_once_with({"id" : "t1"})
+        self.assertEqual(str(self.requests[0].url), settings.DIVIPAY_API_BASE_URL + "transaction/")
+
+
+class SessionTests(CardControlTestCase):
+    def test_session_per_host(self):
+        session = services.get_session("https://divipay.test/api/transaction/")
+        self.assertIs(services.get_session("https://divipay.test/api/cards/"), session)
+        self.assertIsNot(services.get_session("https://other.test/api/transaction/"), session)
+        self.assertIsNot(services.get_session("http://divipay.test/api/transaction/"), session)
+        adapter = session.get_adapter("https://divipay.test/api/transaction/")
+        self.assertEqual((adapter._pool_maxsize, adapter.max_retries.total), (settings.HTTP_POOL_SIZE, settings.HTTP_RETRIES))
+
+    @override_settings(DIVIPAY_TIMEOUTS={"cards" : (1, 2), "transaction" : (3, 4)})
+    def test_timeouts_per_endpoint(self):
+        session = mock.Mock()
+        session.get.return_value = session.post.return_value = response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"id" : "t1"}'
+        with mock.patch("card_control.services.get_session", return_value=session):
+            services_divipay.get_txn()
+            services_divipay.create_card()
+        self.assertEqual(session.get.call_args.kwargs["timeout"], (3, 4))
+        self.assertEqual(session.post.call_args.kwargs["timeout"], (1, 2))
+
+
+@override_settings(CIRCUIT_FAILURE_THRESHOLD=2)
+class CircuitBreakerTests(CardControlTestCase):
+    URL = "https://divipay.test/api/transaction/"
+
+    def setUp(self):
+        super().setUp()
+        self.session = mock.Mock()
+        patcher = mock.patch("card_control.services.get_session", return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.circuit_breaker = services.get_circuit_breaker(self.URL)
+
+    def response(self, status_code, content = b'{"id" : "t1"}'):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = content
+        response.url = self.URL
+        return response
+
+    def call(self):
+        return services.get_service(self.URL, {})
+
+    def open_circuit(self):
+        self.session.get.side_effect = requests.ConnectionError
+        for attempt in range(settings.CIRCUIT_FAILURE_THRESHOLD):
+            with self.assertRaises(errors.Unavailable):
+                self.call()
+        self.session.get.side_effect = None
+
+    # as if CIRCUIT_RESET_TIMEOUT seconds had passed since the circuit opened
+    def elapse_reset_timeout(self):
+        cache.set(self.circuit_breaker.opened_key, time.time() - settings.CIRCUIT_RESET_TIMEOUT, timeout=None)
+
+    def test_opens_after_failures(self):
+        self.session.get.return_value = self.response(200)
+        self.assertEqual(self.call(), {"status" : 200, "content" : {"id" : "t1"}})
+        self.open_circuit()
+        with self.assertRaises(errors.CircuitOpen):
+            self.call()
+        self.assertEqual(self.session.get.call_count, 1 + settings.CIRCUIT_FAILURE_THRESHOLD)
+
+    def test_single_trial_call_when_half_open(self):
+        self.open_circuit()
+        self.elapse_reset_timeout()
+
+        # calls made while the trial call is in flight fail fast
+        def trial_call(*args, **kwargs):
+            with self.assertRaises(errors.CircuitOpen):
+                self.call()
+            return self.response(200)
+        self.session.get.side_effect = trial_call
+        self.assertEqual(self.call()["status"], 200)
+
+        # the trial call succeeded, the circuit is closed
+        self.session.get.side_effect = None
+        self.session.get.return_value = self.response(200)
+        self.assertEqual(self.call()["status"], 200)
+        self.assertEqual(self.session.get.call_count, settings.CIRCUIT_FAILURE_THRESHOLD + 2)
+
+    def test_failed_trial_call_opens_again(self):
+        self.open_circuit()
+        self.elapse_reset_timeout()
+        self.session.get.return_value = self.response(503)
+        with self.assertRaises(errors.DiviPayError):
+            self.call()
+        with self.assertRaises(errors.CircuitOpen):
+            self.call()
+
+    def test_invalid_json_is_a_failure(self):
+        self.session.get.return_value = self.response(200, b"<html>Application Error</html>")
+        for attempt in range(settings.CIRCUIT_FAILURE_THRESHOLD):
+            with self.assertRaises(errors.DiviPayError) as raised:
+                self.call()
+            self.assertEqual((raised.exception.code, raised.exception.message), (200, Messages.Common.INVALID_RESPONSE))
+        with self.assertRaises(errors.CircuitOpen):
+            self.call()
+
+    def test_client_errors_are_successes(self):
+        self.session.get.return_value = self.response(404)
+        for attempt in range(settings.CIRCUIT_FAILURE_THRESHOLD + 1):
+            with self.assertRaises(errors.DiviPayError) as raised:
+                self.call()
+            self.assertEqual(raised.exception.code, 404)
+
+        # a client error answers the trial call, the third party is up
+        self.open_circuit()
+        self.elapse_reset_timeout()
+        with self.assertRaises(errors.DiviPayError):
+            self.call()
+        self.session.get.return_value = self.response(200)
+        self.assertEqual(self.call()["status"], 200)
+
+    def test_bulkhead_full(self):
+        self.open_circuit()
+        self.elapse_reset_timeout()
+        with mock.patch.object(services, "__bulkhead", threading.BoundedSemaphore(1)) as bulkhead:
+            bulkhead.acquire()
+            with self.assertRaises(errors.BulkheadFull):
+                self.call()
+            bulkhead.release()
+            # the rejected call did not claim the trial call
+            self.session.get.return_value = self.response(200)
+            self.assertEqual(self.call()["status"], 200)
+            self.assertTrue(bulkhead.acquire(blocking=False))
+
+    def test_only_gets_retried(self):
+        retry = services.create_session("https://divipay.test").get_adapter(self.URL).max_retries
+        self.assertEqual(retry.total, settings.HTTP_RETRIES)
+        self.assertEqual(set(retry.status_forcelist), {502, 503, 504})
+        self.assertEqual(retry.allowed_methods, frozenset(["GET"]))
+        self.assertTrue(retry.is_retry("GET", 503))
+        self.assertFalse(retry.is_retry("POST", 503))
+        self.assertFalse(retry.is_retry("GET", 500))
+
+
+class TieredCacheTests(CardControlTestCase):
+    # A worker process, sharing the shared cache with the other ones
+    def tier(self, **options):
+        options = dict({"LOCAL_MAX_ENTRIES" : 100, "LOCAL_TIMEOUT" : 60, "SYNC_INTERVAL" : 0, "LOG_SIZE" : 100}, **options)
+        return TieredCache("shared", {"OPTIONS" : options})
+
+    def test_writes_invalidate_the_other_tiers(self):
+        a, b = self.tier(), self.tier()
+        a.set("key", 1)
+        a.set("count", 1)
+        self.assertEqual((b.get("key"), b.get("count")), (1, 1))
+        a.set("key", 2)
+        self.assertEqual(a.incr("count", 2), 3)
+        self.assertEqual((b.get("key"), b.get("count")), (2, 3))
+        a.delete("key")
+        self.assertIsNone(b.get("key"))
+        a.set_many({"key" : 4, "count" : 5})
+        self.assertEqual(b.get_many(["key", "count"]), {"key" : 4, "count" : 5})
+        a.delete_many(["key", "count"])
+        self.assertEqual(b.get_many(["key", "count"]), {})
+        self.assertFalse(b.has_key("key"))
+
+    def test_stale_reads_bounded(self):
+        now = [1000.0]
+        with mock.patch("card_control.cache_tiered.time.monotonic", lambda: now[0]):
+            a, b = self.tier(), self.tier(SYNC_INTERVAL=1, LOCAL_TIMEOUT=5)
+            a.set("key", 1)
+            self.assertEqual(b.get("key"), 1)
+            a.set("key", 2)
+            # served from the local tier until the next read of the invalidation log
+            self.assertEqual(b.get("key"), 1)
+            now[0] += 1
+            self.assertEqual(b.get("key"), 2)
+
+            # a change which is not logged is seen once the local entry expires
+            caches["shared"].set("key", 3)
+            self.assertEqual(b.get("key"), 2)
+            now[0] += 5
+            self.assertEqual(b.get("key"), 3)
+
+    def test_fallen_behind_the_log(self):
+        a, b = self.tier(LOG_SIZE=2), self.tier(LOG_SIZE=2)
+        a.set("k1", 0)
+        b.get("k1")
+        b.set("own", 0)
+        self.assertEqual(b.get_local("own"), 0)
+        a.set_many({"k1" : 1, "k2" : 2})
+        self.assertEqual(b.get_local("own"), 0)
+        a.set_many({"k1" : 1, "k2" : 2, "k3" : 3})
+        # more invalidations than the log holds, the local tier is cleared
+        self.assertIs(b.get_local("own"), cache_tiered._MISSING)
+        self.assertEqual(b.get("own"), 0)
+
+    def test_local_lru(self):
+        a = self.tier(LOCAL_MAX_ENTRIES=2)
+        a.set("k1", 1)
+        a.set("k2", 2)
+        a.get("k1")
+        a.set("k3", 3)
+        self.assertEqual((a.get_local("k1"), a.get_local("k3")), (1, 3))
+        self.assertIs(a.get_local("k2"), cache_tiered._MISSING)
+        self.assertEqual(a.get("k2"), 2)
+
+    def test_add_and_incr(self):
+        a, b = self.tier(), self.tier()
+        self.assertTrue(a.add("lock", 1))
+        self.assertFalse(b.add("lock", 2))
+        self.assertEqual(b.get("lock"), 1)
+        with self.assertRaises(ValueError):
+            a.incr("missing")
+        # an expired key is added again
+        shared = caches["shared"]
+        shared.set("expired", 1, timeout=0)
+        self.assertTrue(shared.add("expired", 2))
+        self.assertEqual(shared.get("expired"), 2)
+
+    def test_outside_of_the_database_transactions(self):
+        a = self.tier()
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            with self.assertNumQueries(0, using="default"):
+                a.set("key", 1)
+                a.add("lock", 1)
+                a.incr("key")
+            raise RuntimeError
+        # cache writes are not rolled back with the transaction they were made in
+        self.assertEqual((self.tier().get("key"), self.tier().get("lock")), (2, 1))
+
+
+class CardRecordTests(CardControlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.card = self.create_card(balance=2500)
+
+    def test_round_trip(self):
+        with self.assertNumQueries(0):
+            card_record = Card.get_record("card")
+            card = card_record.to_card()
+        self.assertEqual(card_record.as_tuple(), ("card", 1, 2500, self.card.updated, self.user.id))
+        self.assertEqual((card.id, card.user, card.balance, card.updated, card.creator_id), card_record.as_tuple())
+        self.assertFalse(card._state.adding)
+        # created is not part of the record, it is loaded on access
+        with self.assertNumQueries(1):
+            self.assertEqual(card.created, self.card.created)
+
+    def test_loaded_once_when_missing(self):
+        Card.delete_cache("card")
+        with self.assertNumQueries(1):
+            self.assertEqual(Card.get_record("card").balance, 2500)
+        with self.assertNumQueries(0):
+            self.assertEqual(Card.get_record("card").balance, 2500)
+
+    def test_entries_of_other_versions_ignored(self):
+        # an entry of an older shape of the record, cached before CACHE_VERSION was bumped
+        cache.set(Card.CACHE_KEY_PREFIX + "card", ("card", 1, 2500), version=Card.CACHE_VERSION - 1)
+        with mock.patch.object(Card, "CACHE_VERSION", Card.CACHE_VERSION + 1):
+            with self.assertNumQueries(1):
+                self.assertEqual(Card.get_record("card").as_tuple(), ("card", 1, 2500, self.card.updated, self.user.id))
+            self.assertEqual(len(cache.get(Card.CACHE_KEY_PREFIX + "card", version=Card.CACHE_VERSION)), len(CardRecord.FIELDS))
+        self.assertEqual(cache.get(Card.CACHE_KEY_PREFIX + "card", version=Card.CACHE_VERSION - 1), ("card", 1, 2500))
+
+
+class DebitTests(CardControlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_card(balance=5000, controls=(("MAX_AMT", "50"), ("MER_NAME", "Coles"), ("DAY_AMT", "25")))
+
+    def debit_txns(self, *amounts):
+        approved_txns = [(index, dict(self.txn_data("t{}".format(index)), amount=amount)) for index, amount in enumerate(amounts)]
+        decisions = [None] * len(amounts)
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            debited_txns, concurrent_decisions = processor_txn.debit_txns("card", compile_controls(retrieve_grouped_controls("card")), approved_txns, decisions, [])
+        return [txn_data["id"] for index, txn_data in debited_txns], [decision[0].name for decision in decisions]
+
+    def test_insufficient_balance_leaves_the_card_unchanged(self):
+        updated = Card.objects.values_list("updated", flat=True).get(id="card")
+        with self.captureOnCommitCallbacks(execute=True) as callbacks, transaction.atomic():
+            self.assertFalse(Card.debit("card", 5001))
+        self.assertEqual(callbacks, [])
+        self.assertEqual(Card.objects.values_list("balance", "updated").get(id="card"), (5000, updated))
+        self.assertEqual(Card.get_record("card").balance, 5000)
+        with self.assertRaises(Card.DoesNotExist):
+            Card.debit("missing", 1)
+
+    def test_debit(self):
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            self.assertTrue(Card.debit("card", 5000))
+        self.assertEqual(self.balance(), 0)
+        self.assertEqual(Card.get_record("card").balance, 0)
+
+    def test_sum_debited_at_once(self):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            self.assertEqual(self.debit_txns(1000, 500, 500), (["t0", "t1", "t2"], ["A", "A", "A"]))
+        card_updates = [query["sql"] for query in queries.captured_queries if query["sql"].startswith('UPDATE "card_control_card"')]
+        self.assertEqual(len(card_updates), 1)
+        self.assertIn('"balance" >= 2000', card_updates[0])
+        self.assertEqual(self.balance(), 3000)
+        self.assertEqual(Card.get_record("card").balance, 3000)
+
+    def test_velocity_rejections_credited_back(self):
+        # the sum of 35 is debited, the second transaction fails DAY_AMT and its amount is credited back
+        with CaptureQueriesContext(connections["default"]) as queries:
+            self.assertEqual(self.debit_txns(2000, 1000, 500), (["t0", "t2"], ["A", "R", "A"]))
+        card_updates = [query["sql"] for query in queries.captured_queries if query["sql"].startswith('UPDATE "card_control_card"')]
+        self.assertEqual(len(card_updates), 2)
+        self.assertIn('"balance" >= 3500', card_updates[0])
+        self.assertEqual(self.balance(), 2500)
+        self.assertEqual(Card.get_record("card").balance, 2500)
+
+    def test_concurrent_deliveries_credited_back(self):
+        with mock.patch("card_control.processor_txn.Transaction.load_decisions", return_value={"t1" : ("A", None)}):
+            self.assertEqual(self.debit_txns(1000, 1000), (["t0"], ["A", "A"]))
+        self.assertEqual(self.balance(), 4000)
+
+    def test_short_of_the_sum_debited_once_locked(self):
+        Card.objects.filter(id="card").update(balance=3000)
+        self.assertEqual(self.debit_txns(2000, 1500, 500), (["t0", "t2"], ["A", "R", "A"]))
+        self.assertEqual(self.balance(), 500)
+
+
+class MoneyTests(CardControlTestCase):
+    def test_to_minor_units(self):
+        for amount, minor_units in (("12.50", 1250), (12.5, 1250), (12, 1200), ("12", 1200), (0.1 + 0.2, 30),
+                                    ("0.005", 1), ("0.004", 0), ("1.005", 101), (1.005, 101), ("-1.005", -101)):
+            with self.subTest(amount=amount):
+                self.assertEqual(to_minor_units(amount), minor_units)
+        for amount in (True, False, "", "12,50", "nan", "inf", float("inf"), None):
+            with self.subTest(amount=amount), self.assertRaises(ValueError):
+                to_minor_units(amount)
+
+    def test_to_major_units(self):
+        self.assertEqual(str(to_major_units(1250)), "12.50")
+        self.assertEqual(str(to_major_units(101)), "1.01")
+        self.assertEqual(str(to_major_units(0)), "0.00")
+        for amount in ("12.50", "1.005", 0.1 + 0.2):
+            with self.subTest(amount=amount):
+                self.assertEqual(to_minor_units(to_major_units(to_minor_units(amount))), to_minor_units(amount))
+
+    def test_money_controls_compared_in_minor_units(self):
+        processor = get_processor("MAX_AMT")
+        self.assertEqual(processor.normalize_many(["50", "50.005", "fifty"]), [5000, 5001, None])
+        self.assertTrue(processor.validate("100.004"))
+        self.assertFalse(processor.validate("100.005"))
+        self.create_card()
+        amounts = ("50", "50.00", 50, 50.0, "50.004", "50.005", 50.01)
+        response = self.post_batch([self.txn_data("t{}".format(index), amount=amount, merchant="Coles") for index, amount in enumerate(amounts)])
+        self.assertEqual([result["status"] for result in response.data["data"]], ["A", "A", "A", "A", "A", "R", "R"])
+
+
+# The schema changes of migrations need a test outside of a transaction, the database is migrated back to the latest migrations after it
+class MoneyMigrationTests(TransactionTestCase):
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.migrate(("card_control", "0001_initial"))
+
+    def tearDown(self):
+        self.migrate(*self.executor.loader.graph.leaf_nodes())
+
+    def migrate(self, *targets):
+        self.executor.loader.build_graph()
+        self.executor.migrate(list(targets))
+        return self.executor.loader.project_state(list(targets)).apps
+
+    def test_forwards_and_backwards(self):
+        old_apps = self.executor.loader.project_state([("card_control", "0001_initial")]).apps
+        now = timezone.now()
+        user = old_apps.get_model("auth", "User").objects.create(username="owner")
+        old_apps.get_model("card_control", "Card").objects.create(id="card", user=1, balance=1234.56, created=now, updated=now, creator=user)
+        Transaction = old_apps.get_model("card_control", "Transaction")
+        for txn_id, amount in (("t1", 1.005), ("t2", 0.1 + 0.2), ("t3", 12.0)):
+            Transaction.objects.create(id=txn_id, card="card", amount=amount, merchant="Coles", merchant_category="5411", status="A", created_at=now, updated_at=now)
+
+        new_apps = self.migrate(("card_control", "0002_money_minor_units"))
+        self.assertEqual(new_apps.get_model("card_control", "Card").objects.get().balance, 123456)
+        self.assertEqual(dict(new_apps.get_model("card_control", "Transaction").objects.values_list("id", "amount")), {"t1" : 101, "t2" : 30, "t3" : 1200})
+
+        old_apps = self.migrate(("card_control", "0001_initial"))
+        self.assertEqual(old_apps.get_model("card_control", "Card").objects.get().balance, 1234.56)
+        self.assertEqual(dict(old_apps.get_model("card_control", "Transaction").objects.values_list("id", "amount")), {"t1" : 1.01, "t2" : 0.3, "t3" : 12.0})
+
+
+class MetricsTests(CardControlTestCase):
+    URL = "/cardcontrol/api/v1/metrics"
+
+    def setUp(self):
+        super().setUp()
+        instrumentation.metrics.reset()
+        self.addCleanup(instrumentation.metrics.reset)
+
+    def timed(self, stage, *elapsed):
+        for seconds in elapsed:
+            with mock.patch("card_control.instrumentation.time.perf_counter", side_effect=[0.0, seconds]):
+                with instrumentation.stage_timer(stage):
+                    pass
+
+    def test_stage_timer(self):
+        self.timed(instrumentation.FETCH, 0.003, 0.001, 0.0005)
+        with self.assertRaises(ValueError), instrumentation.stage_timer(instrumentation.TXN_WRITE):
+            raise ValueError("failed writes are timed too")
+        timers = instrumentation.metrics.snapshot()["timers"]
+        self.assertEqual({name : value for name, value in timers[instrumentation.FETCH].items() if name != "histogram"},
+                         {"count" : 3, "total_ms" : 4.5, "avg_ms" : 1.5, "max_ms" : 3.0, "p50_ms" : 1, "p99_ms" : 5})
+        self.assertEqual({bound for bound, count in timers[instrumentation.FETCH]["histogram"].items() if count}, {"0.5", "1", "5"})
+        self.assertEqual(timers[instrumentation.TXN_WRITE]["count"], 1)
+
+    def test_percentile_past_the_last_bucket(self):
+        self.timed(instrumentation.FETCH, 6)
+        self.assertEqual(instrumentation.metrics.snapshot()["timers"][instrumentation.FETCH]["histogram"]["inf"], 1)
+        self.assertIsNone(instrumentation.metrics.snapshot()["timers"][instrumentation.FETCH]["p99_ms"])
+
+    @override_settings(CARD_CONTROL_METRICS_ENABLED=False)
+    def test_disabled(self):
+        self.create_card()
+        self.post_batch([self.txn_data("t1")])
+        self.timed(instrumentation.FETCH, 0.001)
+        instrumentation.incr("queue.claimed")
+        self.assertEqual(instrumentation.metrics.snapshot()["timers"], {})
+        self.assertEqual(instrumentation.metrics.snapshot()["counters"], {})
+
+    def test_control_outcomes_counted(self):
+        self.create_card()
+        self.post_batch([self.txn_data("t1"), self.txn_data("t2", merchant="Aldi")])
+        self.assertEqual(instrumentation.metrics.snapshot()["counters"], {
+            "control.MAX_AMT.passed" : 2, "control.MER_NAME.passed" : 1, "control.MER_NAME.failed" : 1,
+            "txn.approved" : 1, "txn.rejected" : 1, "txn.duplicate" : 0
+        })
+        instrumentation.incr("queue.claimed", 3)
+        self.assertEqual(instrumentation.metrics.snapshot()["counters"]["queue.claimed"], 3)
+
+    def test_metrics_view(self):
+        self.create_card()
+        self.post_batch([self.txn_data("t1")])
+        self.assertEqual(self.client.get(self.URL).status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(self.URL)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["message"], Messages.Metrics.EXPORTED)
+        self.assertIn(instrumentation.CONTROLS_LOOKUP, response.data["data"]["timers"])
+        self.assertEqual(response.data["data"]["counters"]["control.MER_NAME.passed"], 1)
+
+
+class SingleValuedControlTests(CardControlTestCase):
+    def test_second_value_rejected(self):
+        self.create_card()
+        response = self.client.post("/cardcontrol/api/v1/card/card/control", {"control_name" : "max_amt", "control_value" : "20"}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["message"], Messages.Control.MULTIPLE_CHECK_FAILED)
+        # controls which can have multiple values are added
+        response = self.client.post("/cardcontrol/api/v1/card/card/control", {"control_name" : "MER_NAME", "control_value" : "AWS"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sorted(Control.objects.filter(card_id="card").values_list("control_name", "control_value")),
+                         [("MAX_AMT", "50"), ("MER_NAME", "AWS"), ("MER_NAME", "Coles")])
+
+    def test_enforced_by_the_database(self):
+        self.create_card()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Control.objects.create(card_id="card", control_name="MAX_AMT", control_value="20")
+
+
+class ControlListTests(CardControlTestCase):
+    URL = "/cardcontrol/api/v1/card/card/control"
+
+    def setUp(self):
+        super().setUp()
+        self.create_card()
+
+    def test_not_modified(self):
+        response = self.client.get(self.URL)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([control["control_value"] for control in response.data["results"]], ["50", "Coles"])
+        self.assertNotIn("Last-Modified", response)
+        response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_etag_changes_with_the_controls(self):
+        etag = self.client.get(self.URL)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.URL, {"control_name" : "MER_NAME", "control_value" : "AWS"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 3)
+        self.assertNotEqual(response["ETag"], etag)
+
+        # two changes within the same second are told apart
+        etag = response["ETag"]
+        control_id = response.data["results"][-1]["id"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.delete("{}/{}".format(self.URL, control_id)).status_code, 204)
+        response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 2)
+
+    def test_etag_changes_with_bulk_changes(self):
+        etag = self.client.get(self.URL)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/cardcontrol/api/v1/control/bulk", {"cards" : [{"card_id" : "card", "add" : [{"control_name" : "MER_CAT", "control_value" : "5411"}]}]}, format="json")
+        self.assertEqual(self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class BulkControlTests(CardControlTestCase):
+    def post_bulk(self, cards):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post("/cardcontrol/api/v1/control/bulk", {"cards" : cards}, format="json")
+
+    def test_second_value_rejected(self):
+        self.create_card()
+        self.create_card("other")
+        response = self.post_bulk([
+            {"card_id" : "card", "controls" : [{"control_name" : "MAX_AMT", "control_value" : "20"}, {"control_name" : "MAX_AMT", "control_value" : "30"}]},
+            {"card_id" : "other", "add" : [{"control_name" : "MER_NAME", "control_value" : "AWS"}]}
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["data"], [{"card_id" : "card", "index" : 1, "message" : Messages.Control.MULTIPLE_CHECK_FAILED}])
+        # nothing is written when any control is not valid
+        self.assertEqual(Control.objects.filter(control_name="MER_NAME", control_value="AWS").count(), 0)
+
+    def test_second_value_added_to_existing(self):
+        self.create_card()
+        response = self.post_bulk([{"card_id" : "card", "add" : [{"control_name" : "MAX_AMT", "control_value" : "20"}]}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["message"], Messages.Control.MULTIPLE_CHECK_FAILED)
+        self.assertEqual(list(Control.objects.filter(card_id="card", control_name="MAX_AMT").values_list("control_value", flat=True)), ["50"])
+
+    def test_replace_controls(self):
+        self.create_card()
+        response = self.post_bulk([{"card_id" : "card", "controls" : [{"control_name" : "MAX_AMT", "control_value" : "20"},
+                                                                      {"control_name" : "MER_CAT", "control_value" : "5411"}]}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(Control.objects.filter(card_id="card").values_list("control_name", "control_value")),
+                         [("MAX_AMT", "20"), ("MER_CAT", "5411")])
+        # the cached plan is rebuilt with the new controls
+        response = self.post_batch([self.txn_data("t1", amount="25", merchant="Aldi"), self.txn_data("t2", merchant="Aldi")])
+        self.assertEqual([txn["status"] for txn in response.data["data"]], ["R", "A"])
+
+
+class ControlCacheTests(CardControlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_card()
+        self.grouped_controls = Control.load_grouped_controls(["card"])["card"]
+        Control.delete_cache_many(["card"])
+
+    def cached_controls(self):
+        return cache.get(Control.CACHE_KEY_PREFIX + "card", version=Control.CACHE_VERSION)
+
+    def hold_lock(self):
+        self.assertTrue(cache.add(Control.LOCK_CACHE_KEY_PREFIX + "card", True, version=Control.CACHE_VERSION))
+
+    def test_loaded_once_under_the_lock(self):
+        self.assertEqual(retrieve_grouped_controls("card"), self.grouped_controls)
+        self.assertEqual(self.cached_controls(), self.grouped_controls)
+        self.assertIsNone(cache.get(Control.LOCK_CACHE_KEY_PREFIX + "card", version=Control.CACHE_VERSION))
+
+    def test_waits_for_the_lock_holder(self):
+        self.hold_lock()
+        # the holder caches the controls while the worker polls
+        def load_meanwhile(seconds):
+            cache.set(Control.CACHE_KEY_PREFIX + "card", self.grouped_controls, version=Control.CACHE_VERSION)
+        with mock.patch("card_control.processor_txn.time.sleep", side_effect=load_meanwhile) as sleep, self.assertNumQueries(0):
+            self.assertEqual(retrieve_grouped_controls("card"), self.grouped_controls)
+        sleep.assert_called_once_with(processor_txn.LOCK_POLL_INTERVAL)
+
+    @override_settings(CONTROL_CACHE_LOCK_WAIT=0.05)
+    def test_loaded_when_the_wait_expires(self):
+        self.hold_lock()
+        with self.assertLogs("card_control.processor_txn", "WARNING"):
+            self.assertEqual(retrieve_grouped_controls("card"), self.grouped_controls)
+        self.assertEqual(self.cached_controls(), self.grouped_controls)
+        # the lock of the other worker is left to it
+        self.assertTrue(cache.get(Control.LOCK_CACHE_KEY_PREFIX + "card", version=Control.CACHE_VERSION))
+
+    def test_not_cached_when_the_version_moves_on_while_loading(self):
+        load_grouped_controls = Control.load_grouped_controls
+        def load_and_change(card_ids):
+            Control.bump_versions(card_ids)
+            return load_grouped_controls(card_ids)
+        # never written, rather than written and cleared
+        with mock.patch.object(Control, "load_grouped_controls", side_effect=load_and_change), mock.patch.object(Control, "delete_cache_many") as delete_cache_many:
+            Control.set_cache_many(["card"])
+        self.assertIsNone(self.cached_controls())
+        delete_cache_many.assert_not_called()
+
+    def test_cleared_when_the_version_moves_on_while_caching(self):
+        def compile_and_change(grouped_controls):
+            Control.bump_versions(["card"])
+            return compile_controls(grouped_controls)
+        with mock.patch("card_control.models.compile_controls", side_effect=compile_and_change):
+            Control.rebuild_cache(["card"])
+        self.assertIsNone(self.cached_controls())
+        self.assertIsNone(cache.get(Control.PLAN_CACHE_KEY_PREFIX + "card", version=Control.CACHE_VERSION))
+
+    def test_rebuilt_with_a_new_version(self):
+        version = Control.get_version("card")
+        Control.rebuild_cache(["card"])
+        self.assertNotEqual(Control.get_version("card"), version)
+        self.assertEqual(self.cached_controls(), self.grouped_controls)
+
+    def test_cleared_when_the_rebuild_fails(self):
+        Control.set_cache_many(["card"])
+        with mock.patch.object(Control, "load_grouped_controls", side_effect=OperationalError("database is locked")), self.assertLogs("card_control.models", "ERROR"):
+            Control.rebuild_cache(["card"])
+        self.assertIsNone(self.cached_controls())
+
+
+class WarmupTests(CardControlTestCase):
+    def setUp(self):
+        super().setUp()
+        for card_id in ("busy", "calm", "idle"):
+            self.create_card(card_id)
+        self.post_batch([self.txn_data("b1", "busy"), self.txn_data("b2", "busy"), self.txn_data("b3", "busy"), self.txn_data("c1", "calm"),
+                         self.txn_data("i1", "idle"), self.txn_data("i2", "idle"), self.txn_data("i3", "idle"), self.txn_data("i4", "idle")])
+        # the transactions of the idle card are older than the window
+        Transaction.objects.filter(card="idle").update(created_at=timezone.now() - datetime.timedelta(days=settings.CACHE_WARMUP_WINDOW_DAYS + 1))
+        cache.clear()
+
+    def cached_cards(self):
+        return {card_id for card_id in ("busy", "calm", "idle")
+                if cache.get(Card.CACHE_KEY_PREFIX + card_id, version=Card.CACHE_VERSION) is not None
+                and cache.get(Control.CACHE_KEY_PREFIX + card_id, version=Control.CACHE_VERSION) is not None}
+
+    def test_most_active_cards(self):
+        self.assertEqual(warm_cache(max_cards=1), 1)
+        self.assertEqual(self.cached_cards(), {"busy"})
+        self.assertEqual(warm_cache(), 2)
+        self.assertEqual(self.cached_cards(), {"busy", "calm"})
+
+    def test_no_queries_once_warmed(self):
+        warm_cache()
+        with self.assertNumQueries(0), self.assertNumQueries(0, using="cache"):
+            for card_id in ("busy", "calm"):
+                self.assertEqual(Card.get_record(card_id).balance, 100000 - (3000 if card_id == "busy" else 1000))
+                self.assertEqual(retrieve_grouped_controls(card_id)["MAX_AMT"], frozenset([5000]))
+
+    def test_time_budget(self):
+        self.assertEqual(warm_cache(time_budget=0), 0)
+        self.assertEqual(self.cached_cards(), set())
+
+
+class ExportTests(CardControlTestCase):
+    URL = "/cardcontrol/api/v1/txn/export"
+
+    def setUp(self):
+        super().setUp()
+        self.create_card()
+        self.create_card("other")
+        self.post_batch([self.txn_data("t1", amount="12.50"), self.txn_data("t2", amount="60"), self.txn_data("t3", card_id="other")])
+        Transaction.objects.filter(id="t1").update(created_at=datetime.datetime(2019, 7, 1, 9, tzinfo=datetime.timezone.utc))
+        Transaction.objects.filter(id__in=("t2", "t3")).update(created_at=datetime.datetime(2019, 8, 1, 9, tzinfo=datetime.timezone.utc))
+        self.user.is_staff = True
+        self.user.save()
+
+    def export(self, **params):
+        response = self.client.get(self.URL, params)
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content).decode()
+
+    def test_csv(self):
+        response, content = self.export(card="card")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="transactions.csv"')
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0], list(export.FIELDS))
+        self.assertEqual(sorted((row[0], row[2], row[3], row[4], row[5]) for row in rows[1:]), [
+            ("t1", "12.50", "Coles", "5411", "A"), ("t2", "60.00", "Coles", "5411", "R")
+        ])
+
+    def test_ndjson(self):
+        response, content = self.export(output="ndjson", status="A", **{"from" : "2019-08-01", "to" : "2019-09-01"})
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([(row["id"], row["card"], row["amount"]) for row in rows], [("t3", "other", "10.00")])
+        self.assertEqual(rows[0]["created_at"], "2019-08-01T09:00:00+00:00")
+
+    def test_invalid_filters(self):
+        for params in ({"output" : "xml"}, {"status" : "X"}, {"from" : "July"}, {"to" : "2019-13-01"}):
+            with self.subTest(params=params):
+                response = self.client.get(self.URL, params)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.data["message"], Messages.Transaction.INVALID_EXPORT)
+
+    def test_admin_only(self):
+        self.user.is_staff = False
+        self.user.save()
+        self.assertEqual(self.client.get(self.URL).status_code, 403)
+
+
+class VelocityControlTests(CardControlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_card(balance=100000, controls=(("MAX_AMT", "50"), ("MER_NAME", "Coles"), ("DAY_TXNS", "2")))
+
+    def process(self, txn_data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return process_txn(txn_data)
+
+    def day_spend(self):
+        return CardSpend.objects.filter(card_id="card", window=SpendWindow.DAY.name).values_list("amount", "count").get()
+
+    def test_day_txns_single(self):
+        self.assertEqual(self.process(self.txn_data("t1"))["message"], Messages.Transaction.APPROVED)
+        self.assertEqual(self.process(self.txn_data("t2"))["message"], Messages.Transaction.APPROVED)
+        self.assertEqual(self.process(self.txn_data("t3"))["message"], Messages.Control.FAILED_TO_COMPLY + "DAY_TXNS")
+        self.assertEqual(self.balance(), 98000)
+        self.assertEqual(self.day_spend(), (2000, 2))
+
+    def test_day_txns_batch(self):
+        response = self.post_batch([self.txn_data("t1"), self.txn_data("t2", merchant="Aldi"), self.txn_data("t3"), self.txn_data("t4")])
+        self.assertEqual([(txn["status"], txn["reason"]) for txn in response.data["data"]], [
+            ("A", None),
+            ("R", Messages.Control.FAILED_TO_COMPLY + "MER_NAME"),
+            ("A", None),
+            ("R", Messages.Control.FAILED_TO_COMPLY + "DAY_TXNS")
+        ])
+        # the rejected transaction is credited back to the sum debited for the batch
+        self.assertEqual(self.balance(), 98000)
+        self.assertEqual(Card.get_record("card").balance, 98000)
+        self.assertEqual(self.day_spend(), (2000, 2))
+
+    def test_day_txns_single_then_batch(self):
+        self.process(self.txn_data("t1"))
+        response = self.post_batch([self.txn_data("t2"), self.txn_data("t3")])
+        self.assertEqual([txn["status"] for txn in response.data["data"]], ["A", "R"])
+        self.assertEqual(self.day_spend(), (2000, 2))
+
+    def test_day_amt(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Control.objects.create(card_id="card", control_name="DAY_AMT", control_value="25")
+        response = self.post_batch([self.txn_data("t1", amount="20"), self.txn_data("t2", amount="10"), self.txn_data("t3", amount="5")])
+        self.assertEqual([txn["status"] for txn in response.data["data"]], ["A", "R", "A"])
+        self.assertEqual(self.day_spend(), (2500, 2))
+
+
+class TxnReplayTests(CardControlTestCase):
+    def process(self, txn_data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return process_txn(dict(txn_data))
+
+    def test_approved_txn_replayed(self):
+        self.create_card(balance=5000)
+        txn_data = self.txn_data("t1", amount="20")
+        self.assertEqual(self.process(txn_data)["message"], Messages.Transaction.APPROVED)
+        # the decision is replayed from the cache and from the database, the card is debited once
+        self.assertEqual(self.process(txn_data)["message"], Messages.Transaction.APPROVED)
+        cache.clear()
+        self.assertEqual(self.process(txn_data)["message"], Messages.Transaction.APPROVED)
+        self.assertEqual(self.balance(), 3000)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_rejected_txn_replayed(self):
+        self.create_card(balance=1000)
+        txn_data = self.txn_data("t1", amount="20")
+        self.assertEqual(self.process(txn_data)["message"], Messages.Transaction.INSUFFICIENT_BALANCE)
+        # a top up does not change the decision of a transaction already processed
+        Card.objects.filter(id="card").update(balance=5000)
+        self.assertEqual(self.process(txn_data)["message"], Messages.Transaction.INSUFFICIENT_BALANCE)
+        self.assertEqual(self.balance(), 5000)
+
+    def test_replayed_in_batch(self):
+        self.create_card(balance=5000)
+        self.process(self.txn_data("t1", amount="20"))
+        response = self.post_batch([self.txn_data("t1", amount="20")])
+        self.assertEqual(response.data["data"][0]["status"], "A")
+        self.assertEqual(self.balance(), 3000)
+
+
+class TxnQueueTests(CardControlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_card(balance=5000)
+        self.create_card("other", balance=5000)
+
+    def queue(self, txns):
+        response = self.post_batch(txns, QUEUE_URL)
+        self.assertEqual(response.status_code, 202)
+        return response
+
+    def drain(self, index = 0, workers = 1):
+        with self.captureOnCommitCallbacks(execute=True):
+            txn_queue.run_worker(index, workers, threading.Event(), exit_when_empty=True)
+
+    def test_queued_by_card_partition(self):
+        response = self.queue([self.txn_data("t1"), self.txn_data("t2", card_id="other", amount="12.50")])
+        self.assertEqual(response.data["data"], {"queued" : 2})
+        self.assertEqual(list(QueuedTxn.objects.order_by("id").values_list("txn_id", "card", "partition", "attempts")), [
+            ("t1", "card", zlib.crc32(b"card") % settings.QUEUE_PARTITIONS, 0),
+            ("t2", "other", zlib.crc32(b"other") % settings.QUEUE_PARTITIONS, 0)
+        ])
+        # amounts are queued in minor units
+        self.assertEqual(QueuedTxn.objects.get(txn_id="t2").payload["amount"], 1250)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_drained_by_the_partition_owners(self):
+        self.queue([self.txn_data("t1"), self.txn_data("t2", card_id="other"), self.txn_data("t3", amount="45")])
+        workers = 2
+        index = txn_queue.partition_for("card") % workers
+        self.assertNotEqual(txn_queue.partition_for("other") % workers, index)
+        self.drain(index, workers)
+        self.assertEqual(dict(Transaction.objects.values_list("id", "status")), {"t1" : "A", "t3" : "R"})
+        self.assertEqual(list(QueuedTxn.objects.values_list("txn_id", flat=True)), ["t2"])
+        self.drain(1 - index, workers)
+        self.assertFalse(QueuedTxn.objects.exists())
+        self.assertEqual((self.balance(), self.balance("other")), (4000, 4000))
+
+    def test_failed_batch_processed_one_at_a_time(self):
+        self.queue([self.txn_data("t1"), self.txn_data("poison"), self.txn_data("t2")])
+        process_txn_batch = txn_queue.process_txn_batch
+        def process_or_fail(txn_data_list):
+            if any(txn_data["id"] == "poison" for txn_data in txn_data_list):
+                raise ValueError("poison")
+            return process_txn_batch(txn_data_list)
+        partitions = txn_queue.owned_partitions(0, 1)
+        with mock.patch("card_control.txn_queue.process_txn_batch", side_effect=process_or_fail):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(txn_queue.process_next(partitions, settings.QUEUE_BATCH_SIZE), 3)
+            self.assertEqual(set(Transaction.objects.values_list("id", flat=True)), {"t1", "t2"})
+            self.assertEqual(list(QueuedTxn.objects.values_list("txn_id", "attempts", "last_error")), [("poison", 1, "ValueError('poison')")])
+            # retried until QUEUE_MAX_ATTEMPTS, then kept and no longer claimed
+            self.drain()
+        self.assertEqual(QueuedTxn.objects.get().attempts, settings.QUEUE_MAX_ATTEMPTS)
+        self.assertEqual(txn_queue.claim(partitions, settings.QUEUE_BATCH_SIZE), [])
+        self.assertEqual(self.balance(), 3000)
+
+    def test_operational_error_not_an_attempt(self):
+        self.queue([self.txn_data("t1")])
+        with mock.patch("card_control.txn_queue.process_txn_batch", side_effect=OperationalError("database is locked")):
+            with self.assertRaises(OperationalError):
+                txn_queue.process_next(txn_queue.owned_partitions(0, 1), settings.QUEUE_BATCH_SIZE)
+        self.assertEqual(QueuedTxn.objects.get().attempts, 0)
+        self.drain()
+        self.assertFalse(QueuedTxn.objects.exists())
+        self.assertEqual(Transaction.get_decision("t1"), ("A", None))
+
+    def test_pulled_from_divipay(self):
+        with mock.patch("card_control.services_divipay.get_txn", return_value=self.txn_data("t1", amount=12.5)):
+            self.assertTrue(txn_queue.pull())
+        self.assertEqual(QueuedTxn.objects.get().payload["amount"], 1250)
+        with mock.patch("card_control.services_divipay.get_txn", side_effect=errors.TxnFetchError("down")):
+            self.assertFalse(txn_queue.pull())
+        self.assertEqual(QueuedTxn.objects.count(), 1)
+
+    def test_command_arguments(self):
+        for options in ({"workers" : 0}, {"workers" : settings.QUEUE_PARTITIONS + 1}, {"exit_when_empty" : True, "producers" : 1}):
+            with self.subTest(options=options), self.assertRaises(CommandError):
+                call_command("run_txn_workers", **options)
+
+
+class LedgerTests(CardControlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_card("hot", balance=5000)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def queued_txns(self, *txns):
+        return [QueuedTxn(partition=0, txn_id=txn_data["id"], card=txn_data["card"], payload=dict(txn_data, amount=to_minor_units(txn_data["amount"])))
+                for txn_data in txns]
+
+    # Logs the decisions of the transactions and stops like a crashed worker, without checkpointing them
+    def process_and_crash(self, *txns):
+        ledger = Ledger([0], self.directory)
+        ledger.recover()
+        ledger.process(self.queued_txns(*txns))
+        for log in ledger.logs.values():
+            log.close()
+        return ledger
+
+    def recover(self):
+        ledger = Ledger([0], self.directory)
+        ledger.recover()
+        ledger.close()
+
+    def test_recovery(self):
+        ledger = self.process_and_crash(self.txn_data("t1", card_id="hot", amount="20"), self.txn_data("t2", card_id="hot", amount="40"),
+                                        self.txn_data("t3", card_id="hot", amount="30"))
+        self.assertEqual(ledger.balances["hot"], 0)
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(self.balance("hot"), 5000)
+
+        self.recover()
+        self.assertEqual(dict(Transaction.objects.values_list("id", "status")), {"t1" : "A", "t2" : "R", "t3" : "A"})
+        self.assertEqual(self.balance("hot"), 0)
+        self.assertEqual(LedgerCheckpoint.objects.get(partition=0).sequence, 3)
+        self.assertEqual(os.path.getsize(ledger.logs[0].path), 0)
+
+    def test_recovery_idempotent(self):
+        ledger = self.process_and_crash(self.txn_data("t1", card_id="hot", amount="20"))
+        with open(ledger.logs[0].path, "rb") as log_file:
+            logged = log_file.read()
+        self.recover()
+        self.assertEqual(self.balance("hot"), 3000)
+
+        # the log was applied but not truncated before a crash, its entries are up to the checkpoint
+        with open(ledger.logs[0].path, "wb") as log_file:
+            log_file.write(logged)
+        self.recover()
+        self.assertEqual(self.balance("hot"), 3000)
+
+        # without the checkpoint, the stored transaction is neither inserted nor debited again
+        LedgerCheckpoint.objects.all().delete()
+        with open(ledger.logs[0].path, "wb") as log_file:
+            log_file.write(logged)
+        self.recover()
+        self.assertEqual(self.balance("hot"), 3000)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_balance_changed_outside_of_the_ledger(self):
+        ledger = self.process_and_crash(self.txn_data("t1", card_id="hot", amount="20"), self.txn_data("t2", card_id="hot", amount="20"))
+        Card.objects.filter(id="hot").update(balance=2500)
+        self.recover()
+        self.assertEqual(list(Transaction.objects.order_by("id").values_list("id", "status", "reason")), [
+            ("t1", "A", None),
+            ("t2", "R", Messages.Transaction.INSUFFICIENT_BALANCE)
+        ])
+        self.assertEqual(self.balance("hot"), 500)
+        self.assertEqual(Transaction.get_decision("t2"), ("R", Messages.Transaction.INSUFFICIENT_BALANCE))
+
+    def test_only_processed_through_the_queue(self):
+        with mock.patch("card_control.processor_txn.LEDGER_CARD_SET", frozenset(["hot"])):
+            self.assertEqual(process_txn(self.txn_data("t1", card_id="hot"))["message"], Messages.Transaction.QUEUE_ONLY)
+            response = self.post_batch([self.txn_data("t2", card_id="hot")])
+        self.assertEqual(response.data["data"][0]["reason"], Messages.Transaction.QUEUE_ONLY)
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(self.balance("hot"), 5000)
+
+
+@skipIf(backtest.np is None, "numpy is not installed")
+class BacktestTests(CardControlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_card()
+        self.post_batch([self.txn_data("t1"), self.txn_data("t2", amount="30"), self.txn_data("t3", merchant="Aldi"), self.txn_data("t4", amount="60")])
+
+    def test_current_controls(self):
+        result = backtest.backtest({})
+        self.assertEqual((result.total, result.approved_before, result.approved_after, result.newly_rejected, result.newly_approved), (4, 2, 2, 0, 0))
+        self.assertEqual(result.controls, {"MER_NAME" : [1, 0], "MAX_AMT" : [1, 0]})
+
+    def test_overrides(self):
+        result = backtest.backtest({}, {"card" : {"MAX_AMT" : ["20"], "MER_NAME" : ["coles", "ALDI"], "DAY_TXNS" : ["1"]}})
+        self.assertEqual((result.total, result.approved_before, result.approved_after, result.newly_rejected, result.newly_approved), (4, 2, 2, 1, 1))
+        self.assertEqual(result.controls, {"MAX_AMT" : [2, 1], "MER_NAME" : [0, 0]})
+        self.assertEqual(result.skipped, {"DAY_TXNS"})
+
+    def test_filters_and_missing_mandatory(self):
+        result = backtest.backtest(export.parse_filters(status="A"), {"card" : {"MER_NAME" : ["Coles"]}})
+        self.assertEqual((result.total, result.approved_after, result.newly_rejected), (2, 0, 2))
+        self.assertEqual(result.controls, {backtest.MANDATORY : [2, 2]})
+
+    def test_chunks(self):
+        result = backtest.backtest({}, {"card" : {"MAX_AMT" : ["20"], "MER_NAME" : ["Coles"]}}, chunk_size=3)
+        self.assertEqual((result.total, result.approved_after, result.newly_rejected), (4, 1, 1))
+        self.assertEqual(result.controls, {"MAX_AMT" : [2, 1], "MER_NAME" : [1, 0]})
+
+    def test_control_rejections(self):
+        self.assertTrue(backtest.is_control_rejection(Messages.Control.MANDATORY_NOT_CONFIGURED.format("MAX_AMT")))
+        self.assertTrue(backtest.is_control_rejection(Messages.Control.MANDATORY_NOT_CONFIGURED.format(["MER_NAME", "MER_CAT"])))
+        self.assertTrue(backtest.is_control_rejection(Messages.Control.FAILED_TO_COMPLY + "MER_NAME"))
+        for reason in (None, Messages.Transaction.INSUFFICIENT_BALANCE, Messages.Control.FAILED_TO_COMPLY + "DAY_TXNS",
+                       Messages.Control.MANDATORY_NOT_CONFIGURED.format("MER_CAT")):
+            with self.subTest(reason=reason):
+                self.assertFalse(backtest.is_control_rejection(reason))
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "controls.json")
+            for overrides in ([], {"card" : ["MAX_AMT"]}, {"card" : {"UNKNOWN" : ["1"]}}, {"card" : {"MAX_AMT" : "20"}}, {"card" : {"MAX_AMT" : [20]}}):
+                with self.subTest(overrides=overrides), self.assertRaises(CommandError):
+                    with open(path, "w") as controls_file:
+                        json.dump(overrides, controls_file)
+                    call_command("backtest_controls", controls=path, stdout=io.StringIO())
+            with open(path, "w") as controls_file:
+                json.dump({"card" : {"MAX_AMT" : ["20"], "MER_NAME" : ["Coles"]}}, controls_file)
+            output = io.StringIO()
+            call_command("backtest_controls", controls=path, stdout=output)
+        self.assertIn("Approved when made, rejected now 1", output.getvalue())
+
+
+class InternedValueTests(CardControlTestCase):
+    def test_round_trip(self):
+        self.create_card()
+        self.post_batch([self.txn_data("t1", merchant="Coles"), self.txn_data("t2", merchant="COLES"), self.txn_data("t3", merchant="coles")])
+        self.assertEqual(list(InternedValue.objects.filter(variable_name="merchant").values_list("key", "value")), [("COLES", "Coles")])
+        self.assertEqual(set(Transaction.objects.values_list("merchant__value", flat=True)), {"Coles"})
+        # the export returns the spelling seen first
+        lines = list(export.export_lines(export.filter_txns(), "ndjson"))
+        self.assertEqual({json.loads(line)["merchant"] for line in lines}, {"Coles"})
+        self.assertEqual({json.loads(line)["merchant_category"] for line in lines}, {"5411"})
+
+    def test_intern(self):
+        interned_id = InternedValue.intern("merchant", "Aldi")
+        self.assertEqual(InternedValue.intern("merchant", "ALDI"), interned_id)
+        self.assertEqual(InternedValue.intern_many("merchant", ["aldi", "Coles", "COLES"]), {"ALDI" : interned_id, "COLES" : InternedValue.intern("merchant", "coles")})
+        # values are interned per variable
+        self.assertNotEqual(InternedValue.intern("merchant_category", "Aldi"), interned_id)
+        self.assertEqual(InternedValue.objects.count(), 3)
+
+    def test_misses_cached_until_interned(self):
+        self.assertIsNone(InternedValue.get_id("merchant", "Aldi"))
+        with self.assertNumQueries(0):
+            self.assertIsNone(InternedValue.get_id("merchant", "ALDI"))
+        interned_id = InternedValue.intern("merchant", "Aldi")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(InternedValue.get_id("merchant", "aldi"), interned_id)
+        with self.assertNumQueries(0):
+            self.assertEqual(InternedValue.get_id("merchant", "Aldi"), interned_id)
+
+    def test_controls_interned_when_stored(self):
+        self.create_card()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/cardcontrol/api/v1/control/bulk", {"cards" : [{"card_id" : "card", "add" : [{"control_name" : "MER_CAT", "control_value" : "5734"}]}]}, format="json")
+        self.assertEqual(set(InternedValue.objects.values_list("variable_name", "key")), {("merchant", "COLES"), ("merchant_category", "5734")})
+
+    def test_loading_controls_never_writes(self):
+        self.create_card(controls=(("MAX_AMT", "50"), ("MER_NAME", "Coles"), ("MER_NAME", "AWS"), ("MER_CAT", "5411")))
+        ids = dict(InternedValue.objects.values_list("key", "id"))
+        INTERNED_IDS.clear()
+        # a miss remembered before the value was interned by another process
+        INTERNED_MISSES.add(("merchant", "COLES"))
+        with CaptureQueriesContext(connections["default"]) as queries:
+            grouped_controls = Control.load_grouped_controls(["card"])["card"]
+        self.assertEqual(grouped_controls, {"MAX_AMT" : frozenset([5000]), "MER_NAME" : frozenset([ids["COLES"], ids["AWS"]]), "MER_CAT" : frozenset([ids["5411"]])})
+        # the controls and a query per interned control
+        self.assertEqual(len(queries), 3)
+        self.assertTrue(all(query["sql"].startswith("SELECT") for query in queries))
+
+    @skipIf(backtest.np is None, "numpy is not installed")
+    def test_backtest_overrides_not_interned(self):
+        self.create_card()
+        self.post_batch([self.txn_data("t1"), self.txn_data("t2", merchant="Aldi")])
+        interned_count = InternedValue.objects.count()
+        result = backtest.backtest({}, {"card" : {"MAX_AMT" : ["50"], "MER_NAME" : ["Woolworths", "Aldi"]}})
+        self.assertEqual(InternedValue.objects.count(), interned_count)
+        self.assertEqual((result.approved_after, result.newly_rejected, result.newly_approved), (1, 1, 1))
+
+
+class ControlRegistryTests(TestCase):
+    def definition(self, control_name, **changes):
+        definition = copy.deepcopy(settings.CONTROL_DEFINITION)
+        definition[control_name]["src_comparison"].update(changes)
+        return definition
+
+    def test_invalid_settings(self):
+        for invalid_settings in ({"CONTROL_DEFINITION" : self.definition("MER_NAME", operator="LIKE")},
+                                 {"CONTROL_DEFINITION" : self.definition("DAY_AMT", window="WEEK")},
+                                 {"CONTROL_DEFINITION" : dict(settings.CONTROL_DEFINITION, MAX_AMT={"type" : "Str", "src_comparison" : {"variable_name" : "amount", "operator" : "LTE"}})},
+                                 {"MANDATORY_CONTROLS" : ["MAX_AMT", ["UNKNOWN"]]},
+                                 {"MANDATORY_CONTROLS" : ["MAX_AMT", []]}):
+            with self.subTest(invalid_settings=invalid_settings), override_settings(**invalid_settings):
+                with self.assertRaises(ImproperlyConfigured):
+                    apps.get_app_config("card_control").ready()
+        # the registry is built again from the restored settings
+        self.assertEqual(get_processor("MER_NAME").operator, ControlOperator.IN)
+
+    def test_built_once(self):
+        registry = get_registry()
+        self.assertIs(get_registry(), registry)
+        with override_settings(MANDATORY_CONTROLS=["MER_CAT"]):
+            self.assertIsNot(get_registry(), registry)
+            self.assertIsNone(get_registry().missing_mandatory({"MER_CAT" : frozenset(["5411"])}))
+
+    def test_missing_mandatory(self):
+        registry = get_registry()
+        self.assertEqual(registry.missing_mandatory({"MER_NAME" : frozenset()}), "MAX_AMT")
+        self.assertEqual(registry.missing_mandatory({"MAX_AMT" : frozenset()}), ["MER_NAME", "MER_CAT"])
+        self.assertIsNone(registry.missing_mandatory({"MAX_AMT" : frozenset(), "MER_CAT" : frozenset()}))
@@ -0,0 +1,171 @@
+import logging
+import signal
+import zlib
+import multiprocessing
+from django.conf import settings
+from django.db import OperationalError, connections, close_old_connections
+from . import errors
+from . import instrumentation
+from . import services_divipay
+from .ledger import Ledger
+from .models import QueuedTxn
+from .processor_txn import process_txn_batch
+from .utility import to_minor_units
+
+logger = logging.getLogger(__name__)
+
+# Queued ingestion of transactions
+# Producers (the queue API and the Divipay pullers of the run_txn_workers command) only insert transactions in the
+# QueuedTxn table, a pool of worker processes authorizes them with process_txn_batch outside of the request / response cycle
+#
+# Every transaction is assigned to one of QUEUE_PARTITIONS partitions by its card id and every partition is owned by
+# a single worker, which processes its transactions in the order they were queued. Transactions of a card are therefore
+# processed in order by a single worker, and workers never wait for each other on the card row
+# A queued transaction is deleted once processed, a worker stopped in between processes it again, which is safe
+# as transaction processing is idempotent on the transaction id
+# Balances of the cards in LEDGER_CARDS are debited in the memory of the worker owning them, refer ledger.py
+
+# Stable across processes and restarts, unlike hash()
+def partition_for(card_id):
+    return zlib.crc32(card_id.encode("utf-8")) % settings.QUEUE_PARTITIONS
+
+# Partitions owned by the worker with the given index out of workers
+def owned_partitions(index, workers):
+    return [partition for partition in range(settings.QUEUE_PARTITIONS) if partition % workers == index]
+
+# Queues transactions, amounts are expected in minor units
+def enqueue(txn_data_list):
+    QueuedTxn.objects.bulk_create([QueuedTxn(partition=partition_for(txn_data["card"]), txn_id=txn_data["id"], card=txn_data["card"], payload=txn_data)
+                                   for txn_data in txn_data_list], batch_size=settings.QUEUE_BATCH_SIZE)
+    instrumentation.incr("queue.enqueued", len(txn_data_list))
+
+# Fetches a transaction from Divipay and queues it, returns False if it could not be fetched
+def pull():
+    try:
+        txn_data = services_divipay.get_txn()
+        txn_data["amount"] = to_minor_units(txn_data["amount"])
+    except errors.TxnFetchError as e:
+        logger.error("Transaction could not be fetched from divipay %s", e.message)
+        return False
+    enqueue([txn_data])
+    return True
+
+# Query = select * from queued_txn where partition in (...) and attempts < ? order by id limit ?
+def claim(partitions, batch_size):
+    return list(QueuedTxn.objects.filter(partition__in=partitions, attempts__lt=settings.QUEUE_MAX_ATTEMPTS).order_by("id")[:batch_size])
+
+# Processes the next queued transactions of the partitions, returns the number of transactions processed
+# Transactions of ledger cards are authorized by the ledger of the worker, if any
+# When the batch fails, its transactions are processed one at a time so a single bad transaction does not block the others.
+# A transaction failing QUEUE_MAX_ATTEMPTS times is kept in the table with its last error and no longer claimed
+# OperationalError (lost connection, lock timeout) is not counted as an attempt, it is raised and the batch is claimed again
+def process_next(partitions, batch_size, ledger = None):
+    queued_txns = claim(partitions, batch_size)
+    if not queued_txns:
+        return 0
+    try:
+        process_queued(queued_txns, ledger)
+        QueuedTxn.objects.filter(id__in=[queued_txn.id for queued_txn in queued_txns]).delete()
+    except OperationalError:
+        raise
+    except Exception:
+        logger.exception("Batch of %d queued transactions failed, processing them one at a time", len(queued_txns))
+        for queued_txn in queued_txns:
+            process_one(queued_txn, ledger)
+    instrumentation.incr("queue.processed", len(queued_txns))
+    return len(queued_txns)
+
+def process_one(queued_txn, ledger):
+    try:
+        process_queued([queued_txn], ledger)
+        queued_txn.delete()
+    except OperationalError:
+        raise
+    except Exception as e:
+        logger.exception("Queued transaction %s failed", queued_txn.txn_id)
+        close_old_connections()
+        queued_txn.attempts += 1
+        queued_txn.last_error = repr(e)[:1000]
+        queued_txn.save(update_fields=["attempts", "last_error"])
+        instrumentation.incr("queue.failed")
+
+def process_queued(queued_txns, ledger):
+    ledger_txns = [queued_txn for queued_txn in queued_txns if ledger is not None and ledger.owns(queued_txn.card)]
+    if len(ledger_txns) < len(queued_txns):
+        process_txn_batch([queued_txn.payload for queued_txn in queued_txns if ledger is None or not ledger.owns(queued_txn.card)])
+    if ledger_txns:
+        ledger.process(ledger_txns)
+
+# Loop of a worker process, until stop is set
+# With exit_when_empty the worker returns as soon as its partitions have no transaction left
+def run_worker(index, workers, stop, batch_size = None, poll_interval = None, exit_when_empty = False):
+    batch_size = settings.QUEUE_BATCH_SIZE if batch_size is None else batch_size
+    poll_interval = settings.QUEUE_POLL_INTERVAL if poll_interval is None else poll_interval
+    partitions = owned_partitions(index, workers)
+    logger.info("Transaction worker %d started for partitions %s", index, partitions)
+    ledger = None
+    try:
+        if settings.LEDGER_CARDS:
+            ledger = Ledger(partitions)
+            ledger.recover()
+        while not stop.is_set():
+            try:
+                processed = process_next(partitions, batch_size, ledger)
+                if ledger is not None:
+                    ledger.checkpoint_if_due()
+            except Exception:
+                logger.exception("Transaction worker %d failed, retrying in %s seconds", index, poll_interval)
+                close_old_connections()
+                stop.wait(poll_interval)
+                continue
+            if processed == 0:
+                if exit_when_empty:
+                    break
+                stop.wait(poll_interval)
+        if ledger is not None:
+            ledger.close()
+    finally:
+        connections.close_all()
+    logger.info("Transaction worker %d stopped", index)
+
+# Loop of a producer process pulling transactions from Divipay, until stop is set
+def run_producer(index, stop, poll_interval = None):
+    poll_interval = settings.QUEUE_POLL_INTERVAL if poll_interval is None else poll_interval
+    logger.info("Transaction producer %d started", index)
+    try:
+        while not stop.is_set():
+            if not pull():
+                stop.wait(poll_interval)
+    finally:
+        connections.close_all()
+    logger.info("Transaction producer %d stopped", index)
+
+# Runs workers worker processes and producers producer processes and waits for them
+# SIGINT / SIGTERM stop the processes once their current batch is done
+# Processes are forked, so they share the loaded settings and apps of this process but not its database connections
+def run_pool(workers, producers = 0, batch_size = None, poll_interval = None, exit_when_empty = False):
+    context = multiprocessing.get_context("fork")
+    stop = context.Event()
+    connections.close_all()
+    processes = [context.Process(target=child, name="txn_worker_{}".format(index),
+                                 args=(run_worker, index, workers, stop, batch_size, poll_interval, exit_when_empty))
+                 for index in range(workers)]
+    processes += [context.Process(target=child, name="txn_producer_{}".format(index),
+                                  args=(run_producer, index, stop, poll_interval))
+                  for index in range(producers)]
+    for process in processes:
+        process.start()
+
+    handlers = {signum : signal.signal(signum, lambda signum, frame: stop.set()) for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+# Children leave SIGINT / SIGTERM to the parent, which stops them through the stop event
+def child(target, *args):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    target(*args)
@@ -1,12 +1,18 @@
 from django.urls import path
   
 from . import views_control, views_card
-from card_control import views_txn
+from card_control import views_txn, views_metrics
 
 
 urlpatterns = [
         path('stub/card', views_card.create_card.as_view(), name='Create stub Card'),
         path('stub/txn', views_txn.get_dummy_txn, name='Process stub transaction'),  
+        path('stub/txn/async', views_txn.get_dummy_txn_async, name='Process stub transaction async'),
+        path('api/v1/txn/batch', views_txn.process_txns.as_view(), name='processTxns'),
+        path('api/v1/txn/queue', views_txn.queue_txns.as_view(), name='queueTxns'),
+        path('api/v1/txn/export', views_txn.export_txns.as_view(), name='exportTxns'),
         path('api/v1/card/<str:card_id>/control', views_control.get_post_controls.as_view(), name='getPostControls'),
         path('api/v1/card/<str:card_id>/control/<int:pk>', views_control.delete_controls.as_view(), name='deleteControl'),
+        path('api/v1/control/bulk', views_control.bulk_controls.as_view(), name='bulkControls'),
+        path('api/v1/metrics', views_metrics.get_metrics.as_view(), name='getMetrics'),
 ]
\ No newline at end of file
@@ -1,4 +1,5 @@
 from enum import IntEnum
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
 def create_success_response(message, data = None):
     return __api_response(APIStatus.Success, message, data)
@@ -17,4 +18,26 @@ def __api_response(status, message, data):
     }
     if data is not None:
         content["data"] = data
-    return content
\ No newline at end of file
+    return content
+
+# Money is stored and compared as integer minor units (cents)
+MINOR_UNITS = 100
+
+# Converts an amount in major units e.g. "12.50", 12.5 or 12 to integer minor units e.g. 1250
+# Raises ValueError if the amount is not a number
+def to_minor_units(amount):
+    if isinstance(amount, bool):
+        raise ValueError("Not a valid amount {}".format(amount))
+    if isinstance(amount, int):
+        return amount * MINOR_UNITS
+    try:
+        minor_units = (Decimal(str(amount)) * MINOR_UNITS).quantize(Decimal(1), rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        raise ValueError("Not a valid amount {}".format(amount))
+    if not minor_units.is_finite():
+        raise ValueError("Not a valid amount {}".format(amount))
+    return int(minor_units)
+
+# Converts integer minor units e.g. 1250 back to major units Decimal("12.50")
+def to_major_units(minor_units):
+    return (Decimal(minor_units) / MINOR_UNITS).quantize(Decimal(1) / MINOR_UNITS)
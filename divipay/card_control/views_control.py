@@ -1,13 +1,19 @@
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.http.response import Http404
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
 from rest_framework.generics import ListCreateAPIView, DestroyAPIView
+from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 import logging
 from .serializers import ControlSerializer
-from .models import Card, Control
-from .processor_control import ControlProcessor
+from .models import Card, Control, SINGLE_VALUED_CONTROLS
+from .pagination import ControlCursorPagination
+from .processor_control import get_processor
 from . import errors
 from .utility import create_success_response, create_fail_response
 from .messages import Messages
@@ -18,25 +24,37 @@ class get_post_controls(ListCreateAPIView):
     
     serializer_class = ControlSerializer
     permission_classes = (IsAuthenticated, )
+    pagination_class = ControlCursorPagination
     
     def get_queryset(self):
-        
         # card_id is received as part of the URL. Please see urls.py
-        card_id = self.kwargs['card_id']
-        logger.debug("Card id received in the request " + card_id)
+        return Control.objects.filter(card=self.kwargs['card_id'])
+    
+    # Lists a page of controls with the card's control version as ETag
+    # Returns 304 without reading the controls if the client's copy is still current
+    # No Last-Modified: HTTP dates have a resolution of a second, two changes within the same second would look unchanged
+    def list(self, request, card_id):
+        logger.debug("Card id received in the request %s", card_id)
         
         try:
-            # Retrieve card object from database to see if card exists or not 
-            Card.get(card_id)
-            
-            # Retrieve controls from database
-            controls = Control.objects.filter(card=card_id)
-            logger.info("Controls returned for the card")
+            # Retrieve card record from cache / database to see if card exists or not 
+            Card.get_record(card_id)
         except Card.DoesNotExist:
             # card does not exist in the database, return with 404
             logger.error("Card details could not be found")
             raise Http404
-        return controls
+        
+        etag = quote_etag(Control.get_version(card_id))
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            # Retrieve controls from database
+            response = ListCreateAPIView.list(self, request)
+            logger.info("Controls returned for the card")
+        response["ETag"] = etag
+        # clients keep the list but check with the server before using it
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ("Authorization", ))
+        return response
         
 
     def post(self, request, card_id):
@@ -54,15 +72,21 @@ class get_post_controls(ListCreateAPIView):
         control_name = data["control_name"]
         control_value = data["control_value"]
         try:
-            # Retrieve card object from database to see if card exists or not
-            card = Card.get(card_id)
+            # Retrieve card record from cache / database to see if card exists or not
+            card = Card.get_record(card_id)
             # User who has created the card can only create controls. No other user is allowed.
-            if card.creator == request.user:
+            if card.creator_id == request.user.id:
                 # Validate the control_name and control_value
-                if self.validate_control(control_name, control_value, card_id):
+                if self.validate_control(control_name, control_value):
                     logger.info("Control has been successfully validated")
                     # add Control to database
-                    serializer.save()
+                    # control_single_value constraint rejects a second value of a control which can not have multiple values
+                    try:
+                        with transaction.atomic():
+                            serializer.save()
+                    except IntegrityError:
+                        logger.error("Multiple validation check failed. Raising error.")
+                        raise errors.InvalidControlValue(Messages.Control.MULTIPLE_CHECK_FAILED)
                     logger.info("Control object saved to database")
                     content = create_success_response(Messages.Control.CREATION_SUCCESS, serializer.data)
                     status_code = status.HTTP_201_CREATED
@@ -83,7 +107,7 @@ class get_post_controls(ListCreateAPIView):
         return Response(content, status = status_code)
         
         
-    def validate_control(self, control_name, control_value, card_id):
+    def validate_control(self, control_name, control_value):
         # Retrieve control definitions from settings.py
         # see if control with the given name is defined in definition or not
         if control_name not in settings.CONTROL_DEFINITION:
@@ -95,33 +119,13 @@ class get_post_controls(ListCreateAPIView):
         control_def = settings.CONTROL_DEFINITION[control_name]
         
         # validate the value of control against the definition
-        if ControlProcessor.factory(control_def).validate(control_value):
+        if get_processor(control_name).validate(control_value):
             logger.info("control value is validated.")
-            
-            # check if multiple values are allowed for this control
-            if self.check_if_multiple_allowed(control_def, control_name, card_id) == False:
-                logger.error("Multiple validation check failed. Raising error.")
-                raise  errors.InvalidControlValue(Messages.Control.MULTIPLE_CHECK_FAILED)
-            else:
-                logger.info("Multiple validation check passed.")
         else:
             logger.error("control value validation failed. Raising error.")
             raise errors.InvalidControlValue(Messages.Control.VALIDATION_FAILED, control_def["input_validation"])
         return True
     
-    def check_if_multiple_allowed(self, control_def, control_name, card_id):
-        if "input_validation" not in control_def or "can_multiple_exists" not in control_def["input_validation"] or not control_def["input_validation"]["can_multiple_exists"]:
-            # Fetch the count of controls exist for the given card id and control name
-            count = Control.objects.filter(card_id=card_id).filter(control_name=control_name).count()
-            if count == 0:
-                logger.info("multiple not allowed. No previous entry exists in database")
-                return True
-            else:
-                logger.info("multiple not allowed. Previous entry exists in database")
-                return False
-        else:
-            return True
-                    
     
     
 # Class to implement HTTP DELETE method for control
@@ -151,3 +155,96 @@ class delete_controls(DestroyAPIView):
         
         return Response(content, status = status_code)
 
+
+
+# Class to implement HTTP POST method for creating / replacing / deleting controls of many cards at once
+# {"cards": [{"card_id": "...", "controls": [{"control_name": "MAX_AMT", "control_value": "100"}, ...]},
+#            {"card_id": "...", "add": [{"control_name": "MER_NAME", "control_value": "Coles"}, ...], "delete": [<control id>, ...]}]}
+# "controls" replaces every control of the card, "add" / "delete" change the existing controls
+# Everything is validated before anything is written, then all changes are applied in one transaction
+class bulk_controls(APIView):
+    permission_classes = (IsAuthenticated, )
+    
+    def post(self, request):
+        try:
+            card_changes = self.parse_changes(request.data)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return Response(create_fail_response(Messages.Control.INVALID_BULK), status = status.HTTP_400_BAD_REQUEST)
+        logger.info("Applying controls to %d cards", len(card_changes))
+        
+        # Retrieve creators of all the cards with a single query
+        card_ids = [card_id for card_id, controls, delete_ids, replace in card_changes]
+        creators = dict(Card.objects.filter(id__in=card_ids).values_list("id", "creator_id"))
+        validation_errors = []
+        for card_id in card_ids:
+            if card_id not in creators:
+                validation_errors.append({"card_id" : card_id, "message" : Messages.Card.DETAILS_NOT_FOUND})
+            elif creators[card_id] != request.user.id:
+                # User who has created the card can only change its controls
+                return Response(create_fail_response(Messages.Common.AUTHORIZATION_FAILURE, {"card_id" : card_id}), status = status.HTTP_403_FORBIDDEN)
+        
+        # Validate every control in one pass
+        new_controls = []
+        for card_id, controls, delete_ids, replace in card_changes:
+            single_valued = set()
+            for index, (control_name, control_value) in enumerate(controls):
+                message = None
+                if control_name not in settings.CONTROL_DEFINITION:
+                    message = Messages.Control.INVALID_NAME
+                else:
+                    if len(control_value) > Control._meta.get_field("control_value").max_length or not get_processor(control_name).validate(control_value):
+                        message = Messages.Control.VALIDATION_FAILED
+                    elif control_name in SINGLE_VALUED_CONTROLS:
+                        if control_name in single_valued:
+                            message = Messages.Control.MULTIPLE_CHECK_FAILED
+                        single_valued.add(control_name)
+                if message is not None:
+                    validation_errors.append({"card_id" : card_id, "index" : index, "message" : message})
+                else:
+                    new_controls.append(Control(card_id=card_id, control_name=control_name, control_value=control_value))
+        if validation_errors:
+            logger.error("Control validation failed for %d controls", len(validation_errors))
+            return Response(create_fail_response(Messages.Control.INVALID_BULK, validation_errors), status = status.HTTP_400_BAD_REQUEST)
+        
+        replaced_card_ids = [card_id for card_id, controls, delete_ids, replace in card_changes if replace]
+        deletes = Q(card_id__in=replaced_card_ids)
+        for card_id, controls, delete_ids, replace in card_changes:
+            if delete_ids:
+                deletes |= Q(card_id=card_id, id__in=delete_ids)
+        try:
+            with transaction.atomic():
+                # Deletes with a single query, before the inserts so replaced single valued controls do not conflict
+                deleted_count = Control.objects.filter(deletes).delete()[0]
+                # bulk_create does not call Control.save, the values are interned here
+                Control.intern_values([(control.control_name, control.control_value) for control in new_controls])
+                Control.objects.bulk_create(new_controls, batch_size=settings.CONTROL_BULK_BATCH_SIZE)
+                # Cached controls are rebuilt once per card after the changes are committed
+                Control.refresh_cache_many(card_ids)
+        except IntegrityError:
+            # control_single_value constraint, a control which can not have multiple values already exists
+            logger.error("Multiple validation check failed.")
+            return Response(create_fail_response(Messages.Control.MULTIPLE_CHECK_FAILED), status = status.HTTP_400_BAD_REQUEST)
+        logger.info("Created %d and deleted %d controls", len(new_controls), deleted_count)
+        content = create_success_response(Messages.Control.BULK_APPLIED, {"created" : len(new_controls), "deleted" : deleted_count})
+        return Response(content, status = status.HTTP_200_OK)
+    
+    # Returns [(card_id, [(control_name, control_value)], [control ids to delete], replace)] from the request body
+    def parse_changes(self, data):
+        cards = data["cards"]
+        if not isinstance(cards, list) or not 0 < len(cards) <= settings.CONTROL_BULK_MAX_CARDS:
+            raise ValueError(cards)
+        card_changes = []
+        seen_card_ids = set()
+        for card in cards:
+            card_id = str(card["card_id"])
+            if card_id in seen_card_ids:
+                raise ValueError(card_id)
+            seen_card_ids.add(card_id)
+            replace = "controls" in card
+            if replace and ("add" in card or "delete" in card):
+                raise ValueError(card_id)
+            controls = [(str(control["control_name"]).upper(), str(control["control_value"]))
+                        for control in (card["controls"] if replace else card.get("add", []))]
+            delete_ids = [int(control_id) for control_id in card.get("delete", [])]
+            card_changes.append((card_id, controls, delete_ids, replace))
+        return card_changes
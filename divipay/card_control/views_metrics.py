@@ -0,0 +1,19 @@
+from rest_framework.views import APIView
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework import status
+import logging
+from .instrumentation import metrics
+from .utility import create_success_response
+from .messages import Messages
+
+logger = logging.getLogger(__name__)
+
+class get_metrics(APIView):
+    
+    permission_classes = (IsAdminUser, )
+    
+    # Stage timers and counters of this worker process since it started or since the last reset
+    def get(self, request):
+        content = create_success_response(Messages.Metrics.EXPORTED, metrics.snapshot())
+        return Response(content, status = status.HTTP_200_OK)
@@ -1,98 +1,164 @@
-from django.http import JsonResponse
-from django.core.cache import cache
-from django.db import transaction
-from django.db.models import Count
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date, parse_datetime
+from asgiref.sync import sync_to_async
+from rest_framework.views import APIView
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework import status
 import logging
-from enum import Enum
 from . import services_divipay
 from . import errors
-from .models import Card, Control, Transaction
-from .group_concat import GroupConcat
-from .processor_control import processControls
-from .utility import create_success_response, create_fail_response
+from . import export
+from . import instrumentation
+from . import txn_queue
+from .instrumentation import stage_timer
+from .models import InternedValue, Transaction
+from .processor_txn import process_txn, process_txn_in_thread, process_txn_batch
+from .utility import create_success_response, create_fail_response, to_minor_units
 from .messages import Messages
 
 logger = logging.getLogger(__name__)
 
 def get_dummy_txn(request):
-    txn = None
     try:
-        
         # Fetch transaction details from Divipay
-        txn_data = services_divipay.get_txn()
+        with stage_timer(instrumentation.FETCH):
+            txn_data = services_divipay.get_txn()
         logger.debug("Fetched transaction from divipay")
-        card_id = txn_data["card"]
-        txn_amount = float(txn_data["amount"])
-        
-        # Retrieve grouped controls from Database
-        controls = retrieve_grouped_controls(card_id)
-        
-        # Process controls to check whether the transaction can be carried or not
-        logger.info("Processing controls against the transaction object")
-        processControls(txn_data, controls)
-        
-        with transaction.atomic():
-            # Lock the database row for updating balance 
-            card = Card.objects.select_for_update().get(id=card_id)
-            
-            # Check transaction amount against card balance
-            if card.balance < txn_amount:
-                raise errors.InsufficientBalanceError
-            card.balance -= txn_amount
-            card.save()
-            logger.info("Balance updated in the database")
-        txn = __create_txn_object(txn_data, TxnStatus.A)
-        reply = create_success_response(Messages.Transaction.APPROVED)
-        logger.info("Transaction has been approved.")
+        reply = process_txn(txn_data)
     except errors.TxnFetchError as e:
-        logger.error("Transaction could not be fetched from divipay " + e.message)
+        logger.error("Transaction could not be fetched from divipay %s", e.message)
         reply = create_fail_response(e.message)
-    except Card.DoesNotExist:
-        logger.error("Card does not exist, rejecting the transaction")
-        txn = __create_txn_object(txn_data, TxnStatus.R, Messages.Card.DETAILS_NOT_FOUND)
-        reply = create_fail_response(Messages.Card.DETAILS_NOT_FOUND)
-    except errors.ControlException as control_exception:
-        logger.error("Control exception raised " + control_exception.message)
-        txn = __create_txn_object(txn_data, TxnStatus.R, control_exception.message)
-        reply = create_fail_response(control_exception.message, control_exception.errors.control)
-    except errors.InsufficientBalanceError as insufficient_bal_exception:
-        logger.error("Insufficient balance to carry out the transaction")
-        txn = __create_txn_object(txn_data, TxnStatus.R, insufficient_bal_exception.message)
-        reply = create_fail_response(insufficient_bal_exception.message)
-    if txn is not None:
-        # Saving transaction object in the database 
-        txn.save()
     return JsonResponse(reply)
 
-def retrieve_grouped_controls(card_id):
-    # Retrieve query result from cache
-    # This cache is cleared whenever a new control is added / deleted for the particular card
-    # Refer models.py 
-    cached_controls = cache.get("group_control_" + card_id)
-    if cached_controls is not None:
-        return cached_controls
-    else:
-        # Query = select control_name, group_concat(control_value) from controls where card = card_id group by control_name
-        cached_controls = Control.objects.filter(card=card_id).values('control_name').annotate(count=Count('control_name'), control_value_list=GroupConcat('control_value'))
-        grouped_control_dict = dict()
-        for control in cached_controls:
-            grouped_control_dict[control["control_name"]] = control["control_value_list"]
-        cache.set("group_control_" + card_id, grouped_control_dict)
-        return grouped_control_dict    
+# Async variant of get_dummy_txn, requires an ASGI server (see divipay/asgi.py)
+# The fetch from Divipay does not block the worker, so many fetches can be in flight at once
+# Database work runs in a thread pool
+async def get_dummy_txn_async(request):
+    try:
+        # Fetch transaction details from Divipay
+        with stage_timer(instrumentation.FETCH):
+            txn_data = await services_divipay.get_txn_async()
+        logger.debug("Fetched transaction from divipay")
+        reply = await sync_to_async(process_txn_in_thread, thread_sensitive=False)(txn_data)
+    except errors.TxnFetchError as e:
+        logger.error("Transaction could not be fetched from divipay %s", e.message)
+        reply = create_fail_response(e.message)
+    return JsonResponse(reply)
 
-class TxnStatus(Enum):
-    A = 0
-    R = 1
 
-def __create_txn_object(txn_data, txn_status, reason = None):
-    txn = Transaction(id=txn_data["id"],
-                      card=txn_data["card"],
-                      amount=txn_data["amount"],
-                      merchant=txn_data["merchant"], 
-                      merchant_category=txn_data["merchant_category"],
-                      created_at=txn_data["created"], 
-                      updated_at=txn_data["updated"],
-                      status=txn_status.name, 
-                      reason=reason
-            )
-    return txn
\ No newline at end of file
+# Class to implement HTTP POST method for processing a batch of transactions
+# Transactions are received as JSON body of the request {"transactions" : [txn_1, txn_2, ...]}
+class process_txns(APIView):
+    permission_classes = (IsAuthenticated, )
+    
+    TXN_FIELDS = ("id", "card", "amount", "merchant", "merchant_category", "created", "updated")
+    DATE_FIELDS = ("created", "updated")
+    MAX_LENGTHS = {
+        "id" : Transaction._meta.get_field("id").max_length,
+        "card" : Transaction._meta.get_field("card").max_length,
+        "merchant" : InternedValue._meta.get_field("value").max_length,
+        "merchant_category" : InternedValue._meta.get_field("value").max_length
+    }
+    
+    def post(self, request):
+        txn_data_list = request.data.get("transactions") if isinstance(request.data, dict) else None
+        invalid_response = self.validate_txns(txn_data_list)
+        if invalid_response is not None:
+            return invalid_response
+        
+        logger.info("Processing a batch of %d transactions", len(txn_data_list))
+        decisions = process_txn_batch(txn_data_list)
+        data = [{
+                    "id" : txn_data["id"],
+                    "status" : txn_status.name,
+                    "reason" : reason
+                } for txn_data, (txn_status, reason) in zip(txn_data_list, decisions)]
+        content = create_success_response(Messages.Transaction.BATCH_PROCESSED, data)
+        return Response(content, status = status.HTTP_200_OK)
+    
+    # Returns the 400 response of an invalid batch, with the index and the invalid fields of every invalid transaction
+    # Amounts of the transactions are converted to minor units once the whole batch is valid
+    def validate_txns(self, txn_data_list):
+        if not isinstance(txn_data_list, list) or not 0 < len(txn_data_list) <= settings.TXN_BATCH_MAX_SIZE:
+            logger.error("Invalid batch of transactions received")
+            return Response(create_fail_response(Messages.Transaction.INVALID_BATCH), status = status.HTTP_400_BAD_REQUEST)
+        
+        validation_errors = []
+        amounts = []
+        for index, txn_data in enumerate(txn_data_list):
+            if not isinstance(txn_data, dict):
+                validation_errors.append({"index" : index, "fields" : list(self.TXN_FIELDS)})
+                continue
+            invalid_fields = [field for field in self.TXN_FIELDS if not self.validate_field(field, txn_data.get(field))]
+            if invalid_fields:
+                validation_errors.append({"index" : index, "fields" : invalid_fields})
+            else:
+                amounts.append(to_minor_units(txn_data["amount"]))
+        if validation_errors:
+            logger.error("Transaction validation failed for %d transactions", len(validation_errors))
+            return Response(create_fail_response(Messages.Transaction.INVALID_BATCH, validation_errors), status = status.HTTP_400_BAD_REQUEST)
+        
+        for txn_data, amount in zip(txn_data_list, amounts):
+            txn_data["amount"] = amount
+        return None
+    
+    # Strings must fit the columns they are stored in, dates are ISO 8601 strings
+    # Amounts are numbers or decimal strings, positive and up to TXN_MAX_AMOUNT once converted to minor units
+    def validate_field(self, field, value):
+        if field == "amount":
+            if not isinstance(value, (int, float, str)):
+                return False
+            try:
+                return 0 < to_minor_units(value) <= settings.TXN_MAX_AMOUNT
+            except ValueError:
+                return False
+        if not isinstance(value, str):
+            return False
+        if field in self.DATE_FIELDS:
+            try:
+                return (parse_datetime(value) or parse_date(value)) is not None
+            except ValueError:
+                return False
+        return 0 < len(value) <= self.MAX_LENGTHS[field]
+
+
+# Class to implement HTTP POST method for queueing a batch of transactions, processed later by the transaction workers
+# Transactions are received as JSON body of the request {"transactions" : [txn_1, txn_2, ...]}, like process_txns
+class queue_txns(process_txns):
+    
+    def post(self, request):
+        txn_data_list = request.data.get("transactions") if isinstance(request.data, dict) else None
+        invalid_response = self.validate_txns(txn_data_list)
+        if invalid_response is not None:
+            return invalid_response
+        
+        txn_queue.enqueue(txn_data_list)
+        logger.info("Queued a batch of %d transactions", len(txn_data_list))
+        content = create_success_response(Messages.Transaction.QUEUED, {"queued" : len(txn_data_list)})
+        return Response(content, status = status.HTTP_202_ACCEPTED)
+
+
+# Class to implement HTTP GET method for exporting transactions as CSV or NDJSON
+# ?card=<card_id>&status=A|R&from=2019-07-01&to=2019-08-01&output=csv|ndjson
+# The export is streamed, rows are read and written a chunk at a time. Refer export.py
+class export_txns(APIView):
+    permission_classes = (IsAdminUser, )
+    
+    def get(self, request):
+        params = request.query_params
+        export_format = params.get("output", "csv")
+        try:
+            if export_format not in export.FORMATS:
+                raise ValueError(export_format)
+            filters = export.parse_filters(params.get("card"), params.get("status"), params.get("from"), params.get("to"))
+        except ValueError:
+            logger.error("Invalid transaction export filters received")
+            content = create_fail_response(Messages.Transaction.INVALID_EXPORT)
+            return Response(content, status = status.HTTP_400_BAD_REQUEST)
+        
+        logger.info("Exporting transactions %s as %s", filters, export_format)
+        response = StreamingHttpResponse(export.export_lines(export.filter_txns(**filters), export_format), content_type = export.CONTENT_TYPES[export_format])
+        response["Content-Disposition"] = 'attachment; filename="transactions.{}"'.format(export_format)
+        return response
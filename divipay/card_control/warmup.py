@@ -0,0 +1,74 @@
+import datetime
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import connection
+from django.db.models import Count
+from django.utils import timezone
+from .models import Card, Control, Transaction
+
+logger = logging.getLogger(__name__)
+
+# cards warmed per round of bulk queries
+BATCH_SIZE = 500
+
+# Preloads the cache with the cards and grouped controls of the most active cards,
+# ranked by their transactions of the last window_days days
+# Keys already in the cache are read (which fills the local tier of the tiered cache), only the missing ones are loaded
+# from the database, a batch of cards at a time, until max_cards cards are warmed or time_budget seconds have passed
+# Returns the number of cards warmed
+def warm_cache(max_cards = None, window_days = None, time_budget = None):
+    max_cards = settings.CACHE_WARMUP_CARDS if max_cards is None else max_cards
+    window_days = settings.CACHE_WARMUP_WINDOW_DAYS if window_days is None else window_days
+    time_budget = settings.CACHE_WARMUP_SECONDS if time_budget is None else time_budget
+    deadline = time.monotonic() + time_budget
+
+    # Query = select card from transaction where created_at >= ? group by card order by count(*) desc limit ?
+    since = timezone.now() - datetime.timedelta(days=window_days)
+    card_ids = list(Transaction.objects.filter(created_at__gte=since)
+                    .values_list('card', flat=True)
+                    .annotate(txn_count=Count('id'))
+                    .order_by('-txn_count')[:max_cards])
+
+    warmed = 0
+    for start in range(0, len(card_ids), BATCH_SIZE):
+        if time.monotonic() >= deadline:
+            logger.warning("Cache warm up stopped after %d cards, time budget of %s seconds used", warmed, time_budget)
+            break
+        batch = card_ids[start:start + BATCH_SIZE]
+
+        cached_cards = cache.get_many([Card.CACHE_KEY_PREFIX + card_id for card_id in batch], version=Card.CACHE_VERSION)
+        missing_cards = [card_id for card_id in batch if Card.CACHE_KEY_PREFIX + card_id not in cached_cards]
+        if missing_cards:
+            Card.set_cache_many(missing_cards)
+
+        cached_controls = cache.get_many([prefix + card_id for card_id in batch for prefix in (Control.CACHE_KEY_PREFIX, Control.PLAN_CACHE_KEY_PREFIX)], version=Control.CACHE_VERSION)
+        missing_controls = [card_id for card_id in batch
+                            if Control.CACHE_KEY_PREFIX + card_id not in cached_controls or Control.PLAN_CACHE_KEY_PREFIX + card_id not in cached_controls]
+        if missing_controls:
+            Control.set_cache_many(missing_controls)
+        warmed += len(batch)
+        logger.debug("Cache warmed for %d cards, %d cards and %d control sets loaded from the database", len(batch), len(missing_cards), len(missing_controls))
+    return warmed
+
+# Warms the cache in a background thread when the worker process receives its first request,
+# so the warm up neither delays startup nor runs for management commands. Refer apps.py
+def warm_cache_on_first_request():
+    request_started.connect(start_warm_up, dispatch_uid="card_control_warm_up")
+
+def start_warm_up(**kwargs):
+    if request_started.disconnect(dispatch_uid="card_control_warm_up"):
+        threading.Thread(target=run_warm_up, name="card_control_warm_up", daemon=True).start()
+
+def run_warm_up():
+    try:
+        started = time.monotonic()
+        warmed = warm_cache()
+        logger.info("Cache warmed for %d cards in %.2f seconds", warmed, time.monotonic() - started)
+    except Exception:
+        logger.exception("Cache warm up failed")
+    finally:
+        connection.close()
@@ -0,0 +1,17 @@
+"""
+ASGI config for divipay project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Required to serve the async views e.g. stub/txn/async (Django 3.1 or later).
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'divipay.settings')
+
+application = get_asgi_application()
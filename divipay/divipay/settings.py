@@ -37,7 +37,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'card_control',
+    'card_control.apps.CardControlConfig',
     'rest_framework',
     'rest_framework.authtoken',
 ]
@@ -76,10 +76,49 @@ WSGI_APPLICATION = 'divipay.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
+# 'cache' holds the table of the shared cache (refer CACHES), routed there by card_control/db_router.py so the cache uses
+# a connection of its own and is never part of a transaction of 'default'. It can name the same database as 'default',
+# except with SQLite which allows a single writer per file
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    },
+    'cache': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'cache.sqlite3'),
+    }
+}
+
+DATABASE_ROUTERS = ['card_control.db_router.CacheRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+# 'default' keeps a small LRU in every worker process in front of the 'shared' cache
+# and keeps the workers coherent through an invalidation log. Refer card_control/cache_tiered.py
+# Transaction decisions never change once written, so writing them is not published to the other workers
+# 'shared' is a table of the 'cache' database (python manage.py createcachetable --database cache) with atomic add / incr, refer card_control/cache_db.py.
+# Its MAX_ENTRIES has to be larger than LOG_SIZE plus LOCAL_MAX_ENTRIES of 'default', culling drops entries
+# whatever their timeout, including the invalidation log. Memcached can be used as 'shared' instead
+CACHES = {
+    'default': {
+        'BACKEND': 'card_control.cache_tiered.TieredCache',
+        'LOCATION': 'shared',
+        'OPTIONS': {
+            'LOCAL_MAX_ENTRIES': 10000,
+            'LOCAL_TIMEOUT': 5,
+            'SYNC_INTERVAL': 0.5,
+            'LOG_SIZE': 1000,
+            'WRITE_ONCE_PREFIXES': ['txn_decision_'],
+        }
+    },
+    'shared': {
+        'BACKEND': 'card_control.cache_db.DatabaseCache',
+        'LOCATION': 'card_control_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000000,
+        }
     }
 }
 
@@ -144,7 +183,7 @@ LOGGING = {
     'loggers': {
         'card_control': {
             'handlers': ['console'],
-            'level': 'DEBUG',
+            'level': 'INFO',
         },
     },
 }
@@ -160,7 +199,11 @@ CONTROL_MODEL_NAME_CHOICES = [
         ('MER_CAT', 'Merchant Category'),
         ('MIN_AMT', 'Minimum Amount'),
         ('MAX_AMT', 'Maximum Amount'),
-        ("COUNTRY", "Country Name")
+        ("COUNTRY", "Country Name"),
+        ('DAY_AMT', 'Daily Spend'),
+        ('MONTH_AMT', 'Monthly Spend'),
+        ('DAY_TXNS', 'Daily Transactions'),
+        ('MONTH_TXNS', 'Monthly Transactions')
 ]
 
 CONTROL_DEFINITION = {
@@ -188,7 +231,7 @@ CONTROL_DEFINITION = {
                         
                 },
                 "MIN_AMT" : {
-                        "type" : "Integer",
+                        "type" : "Money",
                         "input_validation" : {
                             "min_value" : 0,
                             "max_value" : 100
@@ -199,7 +242,7 @@ CONTROL_DEFINITION = {
                         }
                 },
                 "MAX_AMT" : {
-                        "type" : "Integer",
+                        "type" : "Money",
                         "input_validation" : {
                             "min_value" : 0,
                             "max_value" : 100
@@ -209,11 +252,144 @@ CONTROL_DEFINITION = {
                             "operator" : "LTE"
                         }
                 },
+                "DAY_AMT" : {
+                        "type" : "Velocity",
+                        "input_validation" : {
+                            "min_value" : 0,
+                            "max_value" : 10000
+                        },
+                        "src_comparison" : {
+                            "variable_name" : "amount",
+                            "operator" : "LTE",
+                            "window" : "DAY"
+                        }
+                },
+                "MONTH_AMT" : {
+                        "type" : "Velocity",
+                        "input_validation" : {
+                            "min_value" : 0,
+                            "max_value" : 100000
+                        },
+                        "src_comparison" : {
+                            "variable_name" : "amount",
+                            "operator" : "LTE",
+                            "window" : "MONTH"
+                        }
+                },
+                "DAY_TXNS" : {
+                        "type" : "Velocity",
+                        "input_validation" : {
+                            "min_value" : 0,
+                            "max_value" : 1000
+                        },
+                        "src_comparison" : {
+                            "variable_name" : "count",
+                            "operator" : "LTE",
+                            "window" : "DAY"
+                        }
+                },
+                "MONTH_TXNS" : {
+                        "type" : "Velocity",
+                        "input_validation" : {
+                            "min_value" : 0,
+                            "max_value" : 10000
+                        },
+                        "src_comparison" : {
+                            "variable_name" : "count",
+                            "operator" : "LTE",
+                            "window" : "MONTH"
+                        }
+                }
 }
 
 MANDATORY_CONTROLS = [
     "MAX_AMT", ["MER_NAME", "MER_CAT"]
     ]
 
+# Per stage timers and counters of the authorization pipeline, exported by the metrics API. Refer instrumentation.py
+CARD_CONTROL_METRICS_ENABLED = True
+
+# Controls returned per page by the control list API, clients can ask for up to CONTROL_MAX_PAGE_SIZE with ?page_size=
+CONTROL_PAGE_SIZE = 100
+CONTROL_MAX_PAGE_SIZE = 1000
+
+# Maximum number of cards accepted by the bulk control API, and controls inserted per query
+CONTROL_BULK_MAX_CARDS = 1000
+CONTROL_BULK_BATCH_SIZE = 1000
+
+# When the controls of a card are not cached, one worker loads them while holding a lock for at most
+# CONTROL_CACHE_LOCK_TIMEOUT seconds, the others wait up to CONTROL_CACHE_LOCK_WAIT seconds before loading them as well
+CONTROL_CACHE_LOCK_TIMEOUT = 5
+CONTROL_CACHE_LOCK_WAIT = 1
+
+# Cache warm up with the cards and grouped controls of the CACHE_WARMUP_CARDS cards with the most transactions
+# in the last CACHE_WARMUP_WINDOW_DAYS days, stopping after CACHE_WARMUP_SECONDS seconds. Refer warmup.py
+# CACHE_WARMUP_ON_STARTUP warms every worker process in the background on its first request, python manage.py warm_cache warms on demand
+CACHE_WARMUP_ON_STARTUP = False
+CACHE_WARMUP_CARDS = 10000
+CACHE_WARMUP_WINDOW_DAYS = 7
+CACHE_WARMUP_SECONDS = 30
+
+# Rows fetched from the database at a time by the transaction export. Refer export.py
+EXPORT_CHUNK_SIZE = 2000
+
+# Transactions evaluated at a time by the backtest of controls. Refer backtest.py
+BACKTEST_CHUNK_SIZE = 100000
+
+# Maximum number of transactions accepted by the batch transaction API
+TXN_BATCH_MAX_SIZE = 10000
+
+# Largest amount of a transaction accepted by the batch and queue APIs, in minor units (cents)
+# A card is debited the sum of its transactions of a batch at once, which has to fit the balance column (a 64 bit integer)
+TXN_MAX_AMOUNT = 10 ** 14
+
+# Seconds the decision of a transaction is cached for, retried deliveries of the transaction are answered
+# with the stored decision. Older retries are still found through the primary key of the transaction table
+TXN_DEDUPE_CACHE_TIMEOUT = 86400
+
+# Queued ingestion of transactions. Refer txn_queue.py
+# Transactions are spread over QUEUE_PARTITIONS partitions by card, python manage.py run_txn_workers runs QUEUE_WORKERS
+# worker processes owning a share of the partitions each. Workers process up to QUEUE_BATCH_SIZE transactions at a time
+# and poll every QUEUE_POLL_INTERVAL seconds when their partitions are empty. A transaction failing QUEUE_MAX_ATTEMPTS times
+# is kept in the queue with its last error and no longer processed
+QUEUE_PARTITIONS = 64
+QUEUE_WORKERS = 4
+QUEUE_BATCH_SIZE = 500
+QUEUE_POLL_INTERVAL = 0.5
+QUEUE_MAX_ATTEMPTS = 5
+
+# In memory balance ledger for the cards in LEDGER_CARDS, used by the transaction workers. Refer ledger.py
+# Their balances are debited in the memory of the worker owning the card and logged to a write ahead log per partition
+# in LEDGER_DIR, which is applied to the database every LEDGER_CHECKPOINT_INTERVAL seconds or LEDGER_CHECKPOINT_TXNS
+# transactions. LEDGER_FSYNC syncs the log to disk before the queued transactions are deleted
+LEDGER_CARDS = []
+LEDGER_DIR = os.path.join(BASE_DIR, 'ledger')
+LEDGER_CHECKPOINT_INTERVAL = 1
+LEDGER_CHECKPOINT_TXNS = 10000
+LEDGER_FSYNC = True
+
+# Connection pooling and retries for third party APIs. Refer services.py
+# HTTP_POOL_SIZE is the number of kept-alive connections per host
+# Idempotent GETs are retried HTTP_RETRIES times, sleeping HTTP_BACKOFF_FACTOR * (2 ** retry) seconds in between
+HTTP_POOL_SIZE = 10
+HTTP_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 0.1
+
+# Maximum number of third party API calls in flight per worker process
+HTTP_MAX_CONCURRENT_CALLS = 20
+
+# Circuit breaker around third party APIs, shared by the workers through the cache. Refer services.py
+# The circuit opens after CIRCUIT_FAILURE_THRESHOLD failures within CIRCUIT_FAILURE_WINDOW seconds
+# and lets a trial call through CIRCUIT_RESET_TIMEOUT seconds after opening
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_FAILURE_WINDOW = 30
+CIRCUIT_RESET_TIMEOUT = 30
+
+# (connect timeout, read timeout) in seconds per Divipay endpoint
+DIVIPAY_TIMEOUTS = {
+    "cards" : (3.05, 5),
+    "transaction" : (3.05, 5),
+}
+
 from .settings_local import *
 